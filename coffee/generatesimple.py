@@ -3,43 +3,46 @@
 
 # TODO: rework approach
 
-import string, copy
+import copy, re, os
 from functools import partial
 
 from mutil.mutil import *
 
+# code is collected as a list of lines (ll) that all get indented
+# into the footprint function in one join, and a set of the variable
+# names (vl) that are combined at the end
+
+# keep values that contain newlines indented as well
+def _indent(value):
+  value = "%s" % (value,)
+  if '\n' in value: return value.replace('\n', '\n  ')
+  return value
+
+_invalid_re = re.compile('[^a-zA-Z0-9]')
+
 def valid(varname, g):
-  def make_valid(c):
-    if not c in (string.ascii_letters + string.digits):
-      return "_%s_" % (g.next())
-    else:
-      return c
-  return ''.join([make_valid(x) for x in varname])
+  def make_valid(m):
+    return "_%s_" % (g.next())
+  return _invalid_re.sub(make_valid, varname)
 
 def new_coffee_meta(meta):
-  a = """\
-#format 1.2
-#name %s
-#id %s
-""" % (meta['name'], meta['id'])
-  if meta['desc'] == None: return a
-  for line in meta['desc'].splitlines():
-    a = a + ("#desc %s\n" % (line))
-  return a
-
-def _add_if(x, a, varname, key, quote = False):
-  if key in x:
-    if type(x[key]) == type(42.1):
-      if f_eq(x[key], 0.0):
-        return a
-    if type(x[key]) == type(1):
-      if x[key] == 0:
-        return a
-    if not quote:
-      a = a + "%s.%s = %s\n" % (varname, key, x[key])
-    else:
-      a = a + "%s.%s = '%s'\n" % (varname, key, x[key])
-  return a
+  l = ["#format 1.2\n", "#name %s\n" % (meta['name']), "#id %s\n" % (meta['id'])]
+  if meta['desc'] != None:
+    l.extend(["#desc %s\n" % (line) for line in meta['desc'].splitlines()])
+  return ''.join(l)
+
+def _add_if(x, ll, varname, key, quote = False):
+  if not key in x: return
+  v = x[key]
+  t = type(v)
+  if t == float:
+    if f_eq(v, 0.0): return
+  elif t == int:
+    if v == 0: return
+  if not quote:
+    ll.append("%s.%s = %s\n" % (varname, key, v))
+  else:
+    ll.append("%s.%s = '%s'\n" % (varname, key, _indent(v)))
 
 def _simple_rect(prefix, constructor, x, g, vl, ll):
   if 'name' in x:
@@ -47,18 +50,15 @@ def _simple_rect(prefix, constructor, x, g, vl, ll):
   else:
     name = str(g.next())
   varname = valid("%s%s" % (prefix, name), g)
-  a = """\
-%s = new %s
-""" % (varname, constructor)
-  a = _add_if(x, a, varname, 'dx')
-  a = _add_if(x, a, varname, 'dy')
-  a = _add_if(x, a, varname, 'name', True)
-  a = _add_if(x, a, varname, 'rot')
-  a = _add_if(x, a, varname, 'ro')
-  a = _add_if(x, a, varname, 'x')
-  a = _add_if(x, a, varname, 'y')
-  vl.append(varname)
-  ll.append(a)
+  ll.append("%s = new %s\n" % (varname, constructor))
+  _add_if(x, ll, varname, 'dx')
+  _add_if(x, ll, varname, 'dy')
+  _add_if(x, ll, varname, 'name', True)
+  _add_if(x, ll, varname, 'rot')
+  _add_if(x, ll, varname, 'ro')
+  _add_if(x, ll, varname, 'x')
+  _add_if(x, ll, varname, 'y')
+  vl.add(varname)
   return varname
 
 def simple_smd_rect(g, x, vl, ll):
@@ -74,50 +74,41 @@ def simple_pad_rect(g, x, vl, ll):
   if 'ro' in x:
     ro = x['ro']
   if dx == dy:
-    a = """\
-%s = new SquarePad %s, %s
-""" % (varname, dx, drill)
-    a = _add_if(x, a, varname, 'ro')
+    ll.append("%s = new SquarePad %s, %s\n" % (varname, dx, drill))
+    _add_if(x, ll, varname, 'ro')
   elif dx == 2*dy and ro == 100:
     if 'drill_dx' in x and x['drill_dx'] == -dy/2:
-      a = """\
-%s = new OffsetPad %s, %s
-""" % (varname, dy, drill)
+      ll.append("%s = new OffsetPad %s, %s\n" % (varname, dy, drill))
     else:
-      a = """\
-%s = new LongPad %s, %s
-""" % (varname, dy, drill)
+      ll.append("%s = new LongPad %s, %s\n" % (varname, dy, drill))
   else:
-    a = """\
-%s = new Pad
-"""
-    a = _add_if(x, a, varname, 'ro')
-
-  a = _add_if(x, a, varname, 'name', True)
-  a = _add_if(x, a, varname, 'rot')
-  a = _add_if(x, a, varname, 'x')
-  a = _add_if(x, a, varname, 'y')
-  vl.append(varname)
-  ll.append(a)
+    ll.append("%s = new Pad\n" % (varname))
+    ll.append("%s.shape = 'rect'\n" % (varname))
+    _add_if(x, ll, varname, 'dx')
+    _add_if(x, ll, varname, 'dy')
+    _add_if(x, ll, varname, 'drill')
+    _add_if(x, ll, varname, 'drill_dx')
+    _add_if(x, ll, varname, 'ro')
+  _add_if(x, ll, varname, 'name', True)
+  _add_if(x, ll, varname, 'rot')
+  _add_if(x, ll, varname, 'x')
+  _add_if(x, ll, varname, 'y')
+  vl.add(varname)
     
 def _simple_t_rect(t, g, x, vl, ll):
   varname = _simple_rect(t, 'Rect', x, g, vl, ll)
-  a = "%s.type = '%s'\n" % (varname, t)
-  ll.append(a)
+  ll.append("%s.type = '%s'\n" % (varname, t))
 
 def _simple_pad_disc_octagon(g, constructor, x, vl, ll):
   name = str(g.next())
   varname = valid("pad%s" % (name), g)
-  a = """\
-%s = new %s %s, %s
-""" % (varname, constructor, x['r'], x['drill'])
-  a = _add_if(x, a, varname, 'drill_dx')
-  a = _add_if(x, a, varname, 'name', True)
-  a = _add_if(x, a, varname, 'x')
-  a = _add_if(x, a, varname, 'y')
-  a = _add_if(x, a, varname, 'rot')
-  vl.append(varname)
-  ll.append(a)
+  ll.append("%s = new %s %s, %s\n" % (varname, constructor, x['r'], x['drill']))
+  _add_if(x, ll, varname, 'drill_dx')
+  _add_if(x, ll, varname, 'name', True)
+  _add_if(x, ll, varname, 'x')
+  _add_if(x, ll, varname, 'y')
+  _add_if(x, ll, varname, 'rot')
+  vl.add(varname)
 
 def simple_pad_disc(g, x, vl, ll):
   _simple_pad_disc_octagon(g, 'RoundPad', x, vl, ll)
@@ -125,87 +116,64 @@ def simple_pad_disc(g, x, vl, ll):
 def simple_pad_octagon(g, x, vl, ll):
   _simple_pad_disc_octagon(g, 'OctagonPad', x, vl, ll)
 
-def _simple_circle(prefix, g, x):
+def _simple_circle(prefix, g, x, ll):
   varname = "%s%s" % (prefix, g.next())
-  a = """\
-%s = new Circle %s
-%s.x = %s
-%s.y = %s
-%s.r = %s
-""" % (varname, x['w'], varname, x['x'],
-       varname, x['y'], varname, x['r'])
-  return (varname, a)
+  ll.append("%s = new Circle %s\n" % (varname, x['w']))
+  ll.append("%s.x = %s\n" % (varname, x['x']))
+  ll.append("%s.y = %s\n" % (varname, x['y']))
+  ll.append("%s.r = %s\n" % (varname, x['r']))
+  return varname
 
 def simple_silk_circle(g, x, vl, ll):
-  (varname, a) = _simple_circle('silk', g, x)
-  vl.append(varname)
-  ll.append(a)
+  vl.add(_simple_circle('silk', g, x, ll))
 
 def _simple_t_circle(t, g, x, vl, ll):
-  (varname, a) = _simple_circle(t, g, x)
-  a = a + ("%s.type = '%s'\n" % (varname, t))
-  vl.append(varname)
-  ll.append(a)
+  varname = _simple_circle(t, g, x, ll)
+  ll.append("%s.type = '%s'\n" % (varname, t))
+  vl.add(varname)
 
-def _simple_line(prefix, g, x):
+def _simple_line(prefix, g, x, ll):
   varname = "%s%s" % (prefix, g.next())
-  a = """\
-%s = new Line %s
-%s.x1 = %s
-%s.y1 = %s
-%s.x2 = %s
-%s.y2 = %s
-""" % (varname, x['w'], varname, x['x1'],
-       varname, x['y1'], varname, x['x2'],
-       varname, x['y2'])
-  return (varname, a)
+  ll.append("%s = new Line %s\n" % (varname, x['w']))
+  ll.append("%s.x1 = %s\n" % (varname, x['x1']))
+  ll.append("%s.y1 = %s\n" % (varname, x['y1']))
+  ll.append("%s.x2 = %s\n" % (varname, x['x2']))
+  ll.append("%s.y2 = %s\n" % (varname, x['y2']))
+  return varname
 
 def simple_silk_line(g, x, vl, ll):
-  (varname, a) = _simple_line('silk', g, x)
-  vl.append(varname)
-  ll.append(a)
+  vl.add(_simple_line('silk', g, x, ll))
 
 def simple_silk_rect(g, x, vl, ll):
   varname = "silk%s" % (g.next())
-  a = """\
-%s = new Rect
-""" % (varname)
-  a = _add_if(x, a, varname, 'x')
-  a = _add_if(x, a, varname, 'y')
-  a = _add_if(x, a, varname, 'dx')
-  a = _add_if(x, a, varname, 'dy')
-  vl.append(varname)
-  ll.append(a)
+  ll.append("%s = new Rect\n" % (varname))
+  _add_if(x, ll, varname, 'x')
+  _add_if(x, ll, varname, 'y')
+  _add_if(x, ll, varname, 'dx')
+  _add_if(x, ll, varname, 'dy')
+  vl.add(varname)
 
 def _simple_t_line(t, g, x, vl, ll):
-  (varname, a) = _simple_line(t, g, x)
-  a = a + ("%s.type = '%s'\n" % (varname, t))
-  vl.append(varname)
-  ll.append(a)
+  varname = _simple_line(t, g, x, ll)
+  ll.append("%s.type = '%s'\n" % (varname, t))
+  vl.add(varname)
 
 def _simple_name_value(prefix, constructor, g, x, vl, ll):
   y = 0
   if x.has_key('y'):
     y = x['y']
   varname = "%s%s" % (prefix, g.next())
-  a = """\
-%s = new %s %s
-""" % (varname, constructor, y)
-  a = _add_if(x, a, varname, 'x')
-  vl.append(varname)
-  ll.append(a)
+  ll.append("%s = new %s %s\n" % (varname, constructor, y))
+  _add_if(x, ll, varname, 'x')
+  vl.add(varname)
 
 def _simple_silk_label(g, x, vl, ll):
   varname = "label%s" % (g.next())
-  a = """\
-%s = new Label '%s'
-%s.x = %s
-%s.y = %s
-%s.dy = %s
-""" % (varname, x['value'], varname, x['x'], varname, x['y'],
-       varname, x['dy'])
-  vl.append(varname)
-  ll.append(a)
+  ll.append("%s = new Label '%s'\n" % (varname, _indent(x['value'])))
+  ll.append("%s.x = %s\n" % (varname, x['x']))
+  ll.append("%s.y = %s\n" % (varname, x['y']))
+  ll.append("%s.dy = %s\n" % (varname, x['dy']))
+  vl.add(varname)
 
 def simple_silk_label(g, x, vl, ll):
   v = x['value']
@@ -218,6 +186,12 @@ def simple_silk_label(g, x, vl, ll):
   else:
     _simple_silk_label(g, x, vl, ll)
 
+# the pads made by a special replace the reference pad
+def _special(var, code, vl, ll):
+  ll.append(code + "\n")
+  vl.remove(var)
+  vl.add('l')
+
 def simple_special_single(g, x, vl, ll):
   direction = x['direction']
   if direction == 'x':
@@ -228,12 +202,7 @@ def simple_special_single(g, x, vl, ll):
   var = "%s1" % (x['ref'])
   num = x['num']
   e = x['e']
-  a = """\
-l = %s [%s], %s, %s
-""" % (f, var, num, e)
-  vl.remove(var)
-  vl.append('l')
-  ll.append(a)
+  _special(var, "l = %s [%s], %s, %s" % (f, var, num, e), vl, ll)
 
 def simple_special_dual(g, x, vl, ll):
   direction_is_x = x['direction'] == 'x'
@@ -246,12 +215,7 @@ def simple_special_dual(g, x, vl, ll):
   num = x['num']
   e = x['e']
   between = x['between']
-  a = """\
-l = %s [%s], %s, %s, %s
-""" % (f, var, num, e, between)
-  vl.remove(var)
-  vl.append('l')
-  ll.append(a)
+  _special(var, "l = %s [%s], %s, %s, %s" % (f, var, num, e, between), vl, ll)
 
 def simple_special_quad(g, x, vl, ll):
   # varname selection here is not perfect; should depend on actual naming
@@ -259,13 +223,22 @@ def simple_special_quad(g, x, vl, ll):
   num = x['num']
   e = x['e']
   between = x['between']
-  a = """\
-l = quad [%s], %s, %s, %s
-""" % (var, num, e, between)
-  vl.remove(var)
-  vl.append('l')
-  ll.append(a)
+  _special(var, "l = quad [%s], %s, %s, %s" % (var, num, e, between), vl, ll)
     
+def simple_special_grid(g, x, vl, ll):
+  # varname selection here is not perfect; should depend on actual naming
+  var = "%s1" % (x['ref'])
+  if x['alpha']:
+    f = 'bga'
+    skip = ["'%s'" % (_indent(name)) for name in x['skip']]
+  else:
+    f = 'grid'
+    skip = x['skip']
+  args = "[%s], %s, %s, %s, %s" % (var, x['nx'], x['ny'], x['ex'], x['ey'])
+  if skip != []:
+    args = args + ", [%s]" % (', '.join(skip))
+  _special(var, "l = %s %s" % (f, args), vl, ll)
+
 def simple_special_mod(g, x, vl, ll):
   x2 = copy.deepcopy(x)
   i = x2['index']
@@ -275,21 +248,18 @@ def simple_special_mod(g, x, vl, ll):
   if 'real_shape' in x2:
     x2['shape'] = x2['real_shape']
     del x2['real_shape']
-  a = ""
   for (k,v) in x2.items():
     if type(v) == type("") or k == 'name':
-      a = a + "l[%s].%s = '%s'\n" % (i, k, v)
+      ll.append("l[%s].%s = '%s'\n" % (i, k, _indent(v)))
     else:
-      a = a + "l[%s].%s = %s\n" % (i, k, v)
-  ll.append(a)
+      ll.append("l[%s].%s = %s\n" % (i, k, _indent(v)))
 
 def simple_unknown(g, x, vl, ll):
   varname = "unknown%s" % (g.next())
-  a = "%s = new Object\n" % (varname)
+  ll.append("%s = new Object\n" % (varname))
   for k in x.keys():
-    a = a + "%s.%s = '%s'\n" % (varname, k, x[k])
-  vl.append(varname)
-  ll.append(a)
+    ll.append("%s.%s = '%s'\n" % (varname, k, _indent(x[k])))
+  vl.add(varname)
 
 # add as needed...
 simple_dispatch = {
@@ -313,6 +283,7 @@ simple_dispatch = {
  'special_single': simple_special_single,
  'special_dual': simple_special_dual,
  'special_quad': simple_special_quad,
+ 'special_grid': simple_special_grid,
  'special_mod': simple_special_mod,
  'vrestrict_circle': partial(_simple_t_circle, 'vrestrict'),
  'vrestrict_line': partial(_simple_t_line, 'vrestrict'),
@@ -322,7 +293,9 @@ simple_dispatch = {
  'keepout_rect': partial(_simple_t_rect, 'keepout'),
 }
 
-def generate_coffee(interim):
+# the code in pieces, shape by shape, so it can be written out
+# without ever having all of it in memory
+def iter_coffee(interim):
   generators = {
    'smd': generate_ints(),
    'pad': generate_ints(),
@@ -336,20 +309,41 @@ def generate_coffee(interim):
    'unknown': generate_ints(),
    'special': generate_ints(),
   }
-  varnames = []
-  lines = []
+  varnames = set()
   meta = None
+  for x in interim:
+    if x['type'] == 'meta': meta = x
+  yield new_coffee_meta(meta)
+  yield "footprint = () ->\n"
+  lines = []
   for x in interim:
     t = x['type']
-    if t == 'meta': meta = new_coffee_meta(x)
-    else:
-      shape = x['shape']
-      key = "%s_%s" % (t, shape)
-      g = generators[t]
-      simple_dispatch.get(key, simple_unknown)(g, x, varnames, lines)
-  varnames.sort()
-  combine = 'combine ['+ (','.join(varnames)) + ']\n'
-  lines_joined = ''.join(lines)
-  lines_joined = '  ' + lines_joined.replace('\n', '\n  ')
-  return meta + "footprint = () ->\n" + lines_joined + combine
-    
+    if t == 'meta': continue
+    shape = x['shape']
+    key = "%s_%s" % (t, shape)
+    g = generators[t]
+    simple_dispatch.get(key, simple_unknown)(g, x, varnames, lines)
+    if lines != []:
+      yield '  ' + '  '.join(lines)
+      del lines[:]
+  yield '  combine ['+ (','.join(sorted(varnames))) + ']\n'
+
+def write_coffee(interim, f):
+  for piece in iter_coffee(interim):
+    f.write(piece)
+
+def generate_coffee(interim):
+  return ''.join(iter_coffee(interim))
+
+# write the footprint as <id>.coffee in directory; returns the file name
+def save_coffee(interim, directory):
+  meta = filter(lambda x: x['type'] == 'meta', interim)[0]
+  fn = os.path.join(directory, "%s.coffee" % (meta['id']))
+  try:
+    with open(fn, 'w+') as f:
+      write_coffee(interim, f)
+  except:
+    # don't leave a half written footprint behind
+    if os.path.exists(fn): os.remove(fn)
+    raise
+  return fn
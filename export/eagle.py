@@ -1,11 +1,13 @@
 # (c) 2013 Joost Yervante Damad <joost@damad.be>
 # License: GPL
 
-import StringIO, uuid, re, copy
+import StringIO, uuid, re, copy, os, sys, shutil, tempfile, hashlib
 
 from xml.sax.saxutils import escape
 
 from bs4 import BeautifulSoup, Tag
+import xml.etree.cElementTree as ElementTree
+import xml.parsers.expat
 
 from mutil.mutil import *
 
@@ -14,74 +16,547 @@ from inter import inter
 # TODO: get from eagle XML isof hardcoded; 
 # however in practice this is quite low prio as everybody probably
 # uses the same layer numbers
+_type_to_layer_number = {
+  'smd': 1,
+  'pad': 17,
+  'silk': 21,
+  'name': 25,
+  'value': 27,
+  'stop': 29,
+  'glue': 35,
+  'keepout': 39,
+  'restrict': 41,
+  'vrestrict': 43,
+  'docu': 51,
+  }
+
+# assymetric
+_layer_number_to_type = {
+  1: 'smd',
+  16: 'pad',
+  21: 'silk',
+  25: 'silk',
+  27: 'silk',
+  29: 'stop',
+  35: 'glue',
+  39: 'keepout',
+  41: 'restrict',
+  43: 'vrestrict',
+  51: 'docu',
+  }
+
 def type_to_layer_number(layer):
-  type_to_layer_number_dict = {
-    'smd': 1,
-    'pad': 17,
-    'silk': 21,
-    'name': 25,
-    'value': 27,
-    'stop': 29,
-    'glue': 35,
-    'keepout': 39,
-    'restrict': 41,
-    'vrestrict': 43,
-    'docu': 51,
-    }
-  return type_to_layer_number_dict[layer]
+  return _type_to_layer_number[layer]
 
 def layer_number_to_type(layer):
-  # assymetric
-  layer_number_to_type_dict = {
-    1: 'smd',
-    16: 'pad',
-    21: 'silk',
-    25: 'silk',
-    27: 'silk',
-    29: 'stop',
-    35: 'glue',
-    39: 'keepout',
-    41: 'restrict',
-    43: 'vrestrict',
-    51: 'docu',
-    }
-  return layer_number_to_type_dict[layer]
+  return _layer_number_to_type[layer]
 
 def _load_xml_file(fn):
   with open(fn) as f:
     return BeautifulSoup(f, 'xml')
   
-def _save_xml_file(fn, soup):
-  with open(fn, 'w+') as f:
-    f.write(str(soup))
-
-def _check_xml(soup):
-  if soup.eagle == None:
-    raise Exception("Unknown file format")
-  v = soup.eagle.get('version')
+# the new content is written to a temporary file in the same
+# directory which then replaces the library in one rename, so the
+# library is never left half written
+def _atomic_write(fn, write, fsync=False):
+  (fd, tmp_fn) = tempfile.mkstemp(prefix='.' + os.path.basename(fn) + '.',
+    dir=os.path.dirname(os.path.abspath(fn)))
+  try:
+    with os.fdopen(fd, 'w') as f:
+      write(f)
+      if fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(fn):
+      shutil.copymode(fn, tmp_fn)
+      # rename doesn't replace an existing file on windows
+      if sys.platform == 'win32':
+        os.remove(fn)
+    os.rename(tmp_fn, fn)
+  except:
+    if os.path.exists(tmp_fn):
+      os.remove(tmp_fn)
+    raise
+
+_split_marker = u'\ufdd0'
+
+# the start and end tag of a tag, without its contents
+def _start_end_tags(tag, builder):
+  shell = Tag(builder=builder, name=tag.name, prefix=tag.prefix, attrs=tag.attrs)
+  shell.append(_split_marker)
+  (start, _, end) = shell.decode().rpartition(_split_marker)
+  return (start, end)
+
+# same output as str(soup), but written piece by piece instead
+# of first building the whole document in memory; the pieces are
+# the children of eagle/drawing/library/packages and the like
+def _write_soup(f, soup, depth=4):
+  def _write(node, depth):
+    if isinstance(node, Tag):
+      if depth == 0 or len(node.contents) == 0:
+        f.write(node.decode().encode('utf-8'))
+        return
+      (start, end) = _start_end_tags(node, soup.builder)
+      f.write(start.encode('utf-8'))
+      for child in node.contents:
+        _write(child, depth-1)
+      f.write(end.encode('utf-8'))
+    else:
+      f.write(node.output_ready().encode('utf-8'))
+  f.write('<?xml version="1.0" encoding="utf-8"?>\n')
+  for child in soup.contents:
+    _write(child, depth)
+
+def _save_xml_file(fn, soup, fsync=False):
+  _atomic_write(fn, lambda f: _write_soup(f, soup), fsync)
+
+def _check_version(v):
   if v == None:
     raise Exception("Unknown file format (no eagle XML?)")
   if float(v) < 6:
     raise Exception("Eagle 6.0 or later is required.")
   return v
 
+def _check_xml(soup):
+  if soup.eagle == None:
+    raise Exception("Unknown file format")
+  return _check_version(soup.eagle.get('version'))
+
+# only looks at the root element, the rest of the file is not parsed
+def _check_xml_stream(fn):
+  with open(fn) as f:
+    try:
+      for (event, elem) in ElementTree.iterparse(f, events=('start',)):
+        if elem.tag != 'eagle':
+          raise Exception("Unknown file format")
+        return _check_version(elem.get('version'))
+    except ElementTree.ParseError:
+      pass
+  raise Exception("Unknown file format")
+
+# stream the packages of a library one by one; everything
+# outside of the package being looked at is dropped right
+# away so memory use doesn't depend on the library size
+def _iter_packages(fn):
+  with open(fn) as f:
+    parents = []
+    in_package = 0
+    for (event, elem) in ElementTree.iterparse(f, events=('start', 'end')):
+      if event == 'start':
+        parents.append(elem)
+        if elem.tag == 'package': in_package += 1
+        continue
+      parents.pop()
+      if elem.tag == 'package':
+        in_package -= 1
+        yield elem
+      if in_package == 0 and len(parents) > 0:
+        elem.clear()
+        parents[-1].remove(elem)
+
 def check_xml_file(fn):
-  soup = _load_xml_file(fn)
-  v = _check_xml(soup)
+  v = _check_xml_stream(fn)
   return "Eagle CAD %s library" % (v)
 
 
 ### EXPORT
 
+def add_ats_to_names(interim):
+  t = {}
+  for x in interim:
+    if x['type'] == 'smd' or x['type'] == 'pad':
+      name = x['name']
+      if not name in t:
+        t[name] = 0
+      t[name] = t[name] + 1
+  multi_names = {}
+  for k in t.keys():
+    if t[k] > 1:
+      multi_names[k] = 1
+  def adapt(x):
+    if x['type'] == 'smd' or x['type'] == 'pad':
+      name = re.sub(' ','_', str(x['name']))
+      if name in multi_names:
+        x['name'] = "%s@%d" % (name, multi_names[name])
+        multi_names[name] = multi_names[name] + 1
+    return x
+  return [adapt(x) for x in interim]
+
+# the contents of a package are described as a list of
+# (tag, attributes, text) rows, independent of the XML library
+# used to write them; every shape is converted by a row function
+# looked up in the tables below
+
+def _pad_row(shape):
+  pad = {}
+  pad['name'] = shape['name']
+  # don't set layer in a pad, it is implicit
+  pad['x'] = fget(shape, 'x')
+  pad['y'] = fget(shape, 'y')
+  drill = fget(shape, 'drill')
+  pad['drill'] = drill
+  pad['rot'] = "R%d" % (fget(shape, 'rot'))
+  r = fget(shape, 'r')
+  shape2 = shape.get('shape', 'disc') # disc is the default
+  if shape2 == 'disc':
+    pad['shape'] = 'round'
+    if f_neq(r, drill*1.5):
+      pad['diameter'] = r*2
+  elif shape2 == 'octagon':
+    pad['shape'] = 'octagon'
+    if f_neq(r, drill*1.5):
+      pad['diameter'] = r*2
+  elif shape2 == 'rect':
+    ro = iget(shape, 'ro')
+    if ro == 0: 
+      pad['shape'] = 'square'
+      if f_neq(shape['dx'], drill*1.5):
+        pad['diameter'] = float(shape['dx'])
+    elif 'drill_dx' in shape:
+      pad['shape'] = 'offset'
+      if f_neq(shape['dy'], drill*1.5):
+        pad['diameter'] = float(shape['dy'])
+    else:
+      pad['shape'] = 'long'
+      if f_neq(shape['dy'], drill*1.5):
+        pad['diameter'] = float(shape['dy'])
+  return ('pad', pad, None)
+
+def _smd_row(shape):
+  smd = {}
+  smd['name'] = shape['name']
+  smd['x'] = fget(shape, 'x')
+  smd['y'] = fget(shape, 'y')
+  smd['dx'] = fget(shape, 'dx')
+  smd['dy'] = fget(shape, 'dy')
+  smd['roundness'] = iget(shape, 'ro')
+  smd['rot'] = "R%d" % (fget(shape, 'rot'))
+  smd['layer'] = _type_to_layer_number['smd']
+  return ('smd', smd, None)
+
+def _rect_row(shape, layer):
+  rect = {}
+  x = fget(shape, 'x')
+  y = fget(shape, 'y')
+  dx = fget(shape, 'dx')
+  dy = fget(shape, 'dy')
+  rect['x1'] = x - dx/2
+  rect['x2'] = x + dx/2
+  rect['y1'] = y - dy/2
+  rect['y2'] = y + dy/2
+  rect['rot'] = "R%d" % (fget(shape, 'rot'))
+  rect['layer'] = layer
+  return ('rectangle', rect, None)
+
+def _label_row(shape, layer):
+  label = {}
+  s = shape['value']
+  if s.upper() == "NAME": 
+    s = ">NAME"
+    layer = _type_to_layer_number['name']
+  if s.upper() == "VALUE": 
+    s = ">VALUE"
+    layer = _type_to_layer_number['value']
+  label['x'] = fget(shape,'x')
+  label['y'] = fget(shape,'y')
+  label['size'] = fget(shape,'dy', 1)
+  label['layer'] = layer
+  label['align'] = 'center'
+  return ('text', label, s)
+
+def _disc_row(shape, layer):
+  r = fget(shape, 'r')
+  # a disc is just a circle with a
+  # clever radius and width
+  disc = {}
+  disc['x'] = fget(shape,'x')
+  disc['y'] = fget(shape,'y')
+  disc['radius'] = r/2
+  disc['width'] = r/2
+  disc['layer'] = layer
+  return ('circle', disc, None)
+
+def _circle_row(shape, layer):
+  circle = {}
+  circle['x'] = fget(shape,'x')
+  circle['y'] = fget(shape,'y')
+  circle['radius'] = fget(shape, 'r')
+  circle['width'] = fget(shape,'w')
+  circle['layer'] = layer
+  return ('circle', circle, None)
+
+def _line_row(shape, layer):
+  line = {}
+  line['x1'] = fget(shape, 'x1')
+  line['y1'] = fget(shape, 'y1')
+  line['x2'] = fget(shape, 'x2')
+  line['y2'] = fget(shape, 'y2')
+  line['width'] = fget(shape, 'w')
+  line['layer'] = layer
+  return ('wire', line, None)
+
+_silk_rows = {
+  'line': _line_row,
+  'circle': _circle_row,
+  'disc': _disc_row,
+  'label': _label_row,
+  'rect': _rect_row,
+  }
+
+def _silk_row(shape):
+  row = _silk_rows.get(shape.get('shape'))
+  if row == None: return None
+  return row(shape, _type_to_layer_number[shape['type']])
+
+# TODO rework to be shape+type based ?
+_type_rows = {
+  'pad': _pad_row,
+  'silk': _silk_row,
+  'docu': _silk_row,
+  'keepout': _silk_row,
+  'stop': _silk_row,
+  'restrict': _silk_row,
+  'vrestrict': _silk_row,
+  'smd': _smd_row,
+  }
+
+def _description_row(meta):
+  idx = eget(meta, 'id', 'Id not found')
+  desc = oget(meta, 'desc', '')
+  parent_idx = oget(meta, 'parent', None)
+  parent_str = ""
+  if parent_idx != None:
+    parent_str = " parent: %s" % parent_idx
+  return ('description', {}, desc + "\n<br/><br/>\nGenerated by 'madparts'.<br/>\nId: " + idx   +"\n" + parent_str)
+
+def package_rows(interim):
+  # make a deep copy so we can make mods without harm
+  interim = copy.deepcopy(interim)
+  interim = add_ats_to_names(interim)
+  meta = inter.get_meta(interim)
+  name = eget(meta, 'name', 'Name not found')
+  # make name eagle compatible
+  name = re.sub(' ','_',name)
+  rows = [_description_row(meta)]
+  for shape in interim:
+    row = _type_rows.get(shape.get('type'))
+    if row == None: continue
+    r = row(shape)
+    if r != None: rows.append(r)
+  return (name, rows)
+
+# XML attributes quoted and escaped like BeautifulSoup does it
+def xml_attributes(attrs):
+  l = []
+  for (k, v) in sorted(attrs.items()):
+    v = escape(unicode(v))
+    if '"' in v:
+      if "'" in v:
+        v = '"%s"' % (v.replace('"', '&quot;'))
+      else:
+        v = "'%s'" % (v)
+    else:
+      v = '"%s"' % (v)
+    l.append(u' %s=%s' % (k, v))
+  return u''.join(l)
+
+# the package as (utf-8) XML text, written straight from the rows;
+# the same as what BeautifulSoup makes of it
+def package_xml(name, rows):
+  out = [u'<package%s>' % (xml_attributes({'name': name}))]
+  for (tag, attrs, text) in rows:
+    if text == None:
+      out.append(u'<%s%s/>' % (tag, xml_attributes(attrs)))
+    else:
+      out.append(u'<%s%s>%s</%s>' % (tag, xml_attributes(attrs), escape(text), tag))
+  out.append(u'</package>')
+  return u''.join(out).encode('utf-8')
+
+def _fill_package(soup, package, rows):
+  for (tag, attrs, text) in rows:
+    element = soup.new_tag(tag)
+    for (k, v) in attrs.items():
+      element[k] = v
+    if text != None:
+      element.string = text
+    package.append(element)
+
+# find the packages named in names (not case sensitive) in the library
+# with a streaming scan; returns (ranges, insert) where ranges maps
+# the lowercase name to (start, end, name) with the byte range of the
+# package and its actual name, and insert is the place to add new
+# packages (None if there is no such place)
+def _package_byte_ranges(fn, names):
+  names = set([name.lower() for name in names])
+  parser = xml.parsers.expat.ParserCreate()
+  ranges = {}
+  state = { 'open': None, 'closing': None, 'packages': None, 'insert': None, 'done': False }
+  # a range ends where the next event starts
+  def _next_event(*args):
+    closing = state['closing']
+    if closing != None:
+      closing[1] = parser.CurrentByteIndex
+      state['closing'] = None
+      parser.CharacterDataHandler = None
+      parser.CommentHandler = None
+      parser.ProcessingInstructionHandler = None
+      # stop as soon as all packages are found
+      if len(ranges) == len(names):
+        state['done'] = None not in [r[1] for r in ranges.values()]
+  def _start(tag, attrs):
+    _next_event()
+    if tag == 'packages':
+      state['packages'] = parser.CurrentByteIndex
+    elif tag == 'package':
+      name = attrs.get('name', '').lower()
+      if name in names and not name in ranges:
+        ranges[name] = [parser.CurrentByteIndex, None, attrs['name']]
+        state['open'] = ranges[name]
+  def _end(tag):
+    _next_event()
+    if tag == 'package' and state['open'] != None:
+      state['closing'] = state['open']
+      state['open'] = None
+      # only needed from here on, the scan is a lot faster without
+      parser.CharacterDataHandler = _next_event
+      parser.CommentHandler = _next_event
+      parser.ProcessingInstructionHandler = _next_event
+    elif tag == 'packages':
+      # <packages/> has no place to insert into
+      if parser.CurrentByteIndex != state['packages']:
+        state['insert'] = parser.CurrentByteIndex
+      state['done'] = True
+  parser.StartElementHandler = _start
+  parser.EndElementHandler = _end
+  with open(fn, 'rb') as f:
+    while not state['done']:
+      data = f.read(65536)
+      parser.Parse(data, data == '')
+      if data == '': break
+  return (dict([(k, tuple(r)) for (k, r) in ranges.items()]), state['insert'])
+
+def _copy_bytes(src, dst, n):
+  while n > 0:
+    data = src.read(min(n, 65536))
+    if data == '': break
+    dst.write(data)
+    n = n - len(data)
+
+# replace (or add) the packages, given as (name, rows), in the library
+# file; everything else is copied byte for byte; returns False when
+# there is no place to add a new package
+def _splice_packages(fn, packages, fsync=False):
+  (ranges, insert) = _package_byte_ranges(fn, [name for (name, rows) in packages])
+  pieces = {}
+  added = []
+  for (name, rows) in packages:
+    r = ranges.get(name.lower())
+    if r != None:
+      (start, end, old_name) = r
+      # like export_footprint, keep the name of a replaced package
+      pieces[start] = (end, package_xml(old_name, rows))
+    else:
+      if insert == None: return False
+      # a later package with the same name replaces an added one
+      added = [(n, d) for (n, d) in added if n != name.lower()]
+      added.append((name.lower(), package_xml(name, rows)))
+  if added != []:
+    pieces[insert] = (insert, ''.join([d for (n, d) in added]))
+  def _write(f):
+    with open(fn, 'rb') as src:
+      pos = 0
+      for start in sorted(pieces.keys()):
+        (end, data) = pieces[start]
+        _copy_bytes(src, f, start - pos)
+        f.write(data)
+        src.seek(end)
+        pos = end
+      shutil.copyfileobj(src, f)
+  _atomic_write(fn, _write, fsync)
+  return True
+
+# export footprints by only replacing (or adding) their packages in the
+# library file; everything else is copied byte for byte
+def splice_footprints(fn, interims, fsync=False):
+  _check_xml_stream(fn)
+  packages = [package_rows(interim) for interim in interims]
+  if not _splice_packages(fn, packages, fsync):
+    exporter = Export(fn)
+    exporter.export_many(interims)
+    exporter.save(fsync)
+  return [name for (name, rows) in packages]
+
+def splice_footprint(fn, interim, fsync=False):
+  return splice_footprints(fn, [interim], fsync)[0]
+
+def _canonical_value(v):
+  try:
+    return repr(float(v))
+  except ValueError:
+    return unicode(v)
+
+def _canonical(element):
+  attrs = sorted([(k, _canonical_value(v)) for (k, v) in element.attrib.items()])
+  children = [_canonical(child) for child in element]
+  return (element.tag, attrs, unicode(element.text or '').strip(),
+    children, unicode(element.tail or '').strip())
+
+# hash of the contents of a package that doesn't depend on formatting,
+# attribute order or the way numbers are written
+def package_hash(package):
+  data = repr([_canonical(child) for child in package])
+  return hashlib.sha1(data).hexdigest()
+
+# bring the library up to date with the footprints: only the packages
+# that differ are replaced or added, the library isn't written at all
+# if nothing changed; returns the names of the added, changed,
+# unchanged and orphaned (only in the library) packages
+def sync_footprints(fn, interims, fsync=False):
+  _check_xml_stream(fn)
+  existing = {}
+  names = []
+  for package in _iter_packages(fn):
+    name = package.get('name')
+    if not name.lower() in existing:
+      existing[name.lower()] = package_hash(package)
+      names.append(name)
+  report = { 'added': [], 'changed': [], 'unchanged': [], 'orphaned': [] }
+  todo = []
+  for interim in interims:
+    (name, rows) = package_rows(interim)
+    # a later footprint with the same name wins
+    todo = [t for t in todo if t[0] != name.lower()]
+    h = package_hash(ElementTree.fromstring(package_xml(name, rows)))
+    if not name.lower() in existing:
+      report['added'].append(name)
+    elif existing[name.lower()] != h:
+      report['changed'].append(name)
+    else:
+      report['unchanged'].append(name)
+      continue
+    todo.append((name.lower(), interim, (name, rows)))
+  generated = set([name.lower() for name in report['added'] + report['changed'] + report['unchanged']])
+  report['orphaned'] = [name for name in names if not name.lower() in generated]
+  if todo != []:
+    if not _splice_packages(fn, [p for (n, i, p) in todo], fsync):
+      exporter = Export(fn)
+      exporter.export_many([i for (n, i, p) in todo])
+      exporter.save(fsync)
+  return report
+
 class Export:
 
-  def __init__(self, fn):
+  # soup can be passed in if the library is already parsed
+  def __init__(self, fn, soup=None):
     self.fn = fn
-    self.soup = _load_xml_file(fn)
+    if soup == None:
+      soup = _load_xml_file(fn)
+    self.soup = soup
     _check_xml(self.soup)
+    self.index = self._package_index()
 
-  def save(self):
-    _save_xml_file(self.fn, self.soup)
+  def save(self, fsync=False):
+    _save_xml_file(self.fn, self.soup, fsync)
 
   def get_data(self):
    return str(self.soup)
@@ -92,412 +567,253 @@ class Export:
    return str(self.soup.prettify())
 
   def get_pretty_footprint(self, eagle_name):
-    packages = self.soup.eagle.drawing.packages('package')
-    for some_package in packages:
-      if some_package['name'].lower() == eagle_name.lower():
-        return str(some_package.prettify())
-    raise Exception("Footprint not found")
+    package = self.index.get(eagle_name.lower())
+    if package == None:
+      raise Exception("Footprint not found")
+    return str(package.prettify())
    
 
+  # lowercase name -> package, kept up to date by export_footprint
+  def _package_index(self):
+    index = {}
+    for package in self.soup.eagle.drawing.packages('package'):
+      index.setdefault(package['name'].lower(), package)
+    return index
+
+  # export a list of footprints; returns the list of package names
+  def export_many(self, interims):
+    return [self.export_footprint(interim) for interim in interims]
+
   def export_footprint(self, interim):
-    # make a deep copy so we can make mods without harm
-    interim = copy.deepcopy(interim)
-    interim = self.add_ats_to_names(interim)
-    meta = inter.get_meta(interim)
-    name = eget(meta, 'name', 'Name not found')
-    # make name eagle compatible
-    name = re.sub(' ','_',name)
+    (name, rows) = package_rows(interim)
     # check if there is an existing package
     # and if so, replace it
-    packages = self.soup.eagle.drawing.packages('package')
-    package = None
-    for some_package in packages:
-      if some_package['name'].lower() == name.lower():
-        package = some_package
-        package.clear()
-        break
-    if package == None:
+    package = self.index.get(name.lower())
+    if package != None:
+      package.clear()
+    else:
       package = self.soup.new_tag('package')
       self.soup.eagle.drawing.packages.append(package)
       package['name'] = name
-
-    def pad(shape):
-      pad = self.soup.new_tag('pad')
-      pad['name'] = shape['name']
-      # don't set layer in a pad, it is implicit
-      pad['x'] = fget(shape, 'x')
-      pad['y'] = fget(shape, 'y')
-      drill = fget(shape, 'drill')
-      pad['drill'] = drill
-      pad['rot'] = "R%d" % (fget(shape, 'rot'))
-      r = fget(shape, 'r')
-      shape2 = 'disc' # disc is the default
-      if 'shape' in shape:
-        shape2 = shape['shape']
-      if shape2 == 'disc':
-        pad['shape'] = 'round'
-        if f_neq(r, drill*1.5):
-          pad['diameter'] = r*2
-      elif shape2 == 'octagon':
-        pad['shape'] = 'octagon'
-        if f_neq(r, drill*1.5):
-          pad['diameter'] = r*2
-      elif shape2 == 'rect':
-        ro = iget(shape, 'ro')
-        if ro == 0: 
-          pad['shape'] = 'square'
-          if f_neq(shape['dx'], drill*1.5):
-            pad['diameter'] = float(shape['dx'])
-        elif 'drill_dx' in shape:
-          pad['shape'] = 'offset'
-          if f_neq(shape['dy'], drill*1.5):
-            pad['diameter'] = float(shape['dy'])
-        else:
-          pad['shape'] = 'long'
-          if f_neq(shape['dy'], drill*1.5):
-            pad['diameter'] = float(shape['dy'])
-      package.append(pad)
-
-    def smd(shape):
-      smd = self.soup.new_tag('smd')
-      smd['name'] = shape['name']
-      smd['x'] = fget(shape, 'x')
-      smd['y'] = fget(shape, 'y')
-      smd['dx'] = fget(shape, 'dx')
-      smd['dy'] = fget(shape, 'dy')
-      smd['roundness'] = iget(shape, 'ro')
-      smd['rot'] = "R%d" % (fget(shape, 'rot'))
-      smd['layer'] = type_to_layer_number('smd')
-      package.append(smd)
-
-    def rect(shape, layer):
-      rect = self.soup.new_tag('rectangle')
-      x = fget(shape, 'x')
-      y = fget(shape, 'y')
-      dx = fget(shape, 'dx')
-      dy = fget(shape, 'dy')
-      rect['x1'] = x - dx/2
-      rect['x2'] = x + dx/2
-      rect['y1'] = y - dy/2
-      rect['y2'] = y + dy/2
-      rect['rot'] = "R%d" % (fget(shape, 'rot'))
-      rect['layer'] = layer
-      package.append(rect)
-
-    def label(shape, layer):
-      label = self.soup.new_tag('text')
-      x = fget(shape,'x')
-      y = fget(shape,'y')
-      dy = fget(shape,'dy', 1)
-      s = shape['value']
-      if s.upper() == "NAME": 
-        s = ">NAME"
-        layer = type_to_layer_number('name')
-      if s.upper() == "VALUE": 
-        s = ">VALUE"
-        layer = type_to_layer_number('value')
-      label['x'] = x
-      label['y'] = y
-      label['size'] = dy
-      label['layer'] = layer
-      label['align'] = 'center'
-      label.string = s
-      package.append(label)
-    
-    def disc(shape, layer):
-      r = fget(shape, 'r')
-      rx = fget(shape, 'rx', r)
-      ry = fget(shape, 'ry', r)
-      x = fget(shape,'x')
-      y = fget(shape,'y')
-      # a disc is just a circle with a
-      # clever radius and width
-      disc = self.soup.new_tag('circle')
-      disc['x'] = x
-      disc['y'] = y
-      disc['radius'] = r/2
-      disc['width'] = r/2
-      disc['layer'] = layer
-      package.append(disc)
-  
-    def circle(shape, layer):
-      r = fget(shape, 'r')
-      rx = fget(shape, 'rx', r)
-      ry = fget(shape, 'ry', r)
-      x = fget(shape,'x')
-      y = fget(shape,'y')
-      w = fget(shape,'w')
-      circle = self.soup.new_tag('circle')
-      circle['x'] = x
-      circle['y'] = y
-      circle['radius'] = r
-      circle['width'] = w
-      circle['layer'] = layer
-      package.append(circle)
-
-    def line(shape, layer):
-      x1 = fget(shape, 'x1')
-      y1 = fget(shape, 'y1')
-      x2 = fget(shape, 'x2')
-      y2 = fget(shape, 'y2')
-      w = fget(shape, 'w')
-      line = self.soup.new_tag('wire')
-      line['x1'] = x1
-      line['y1'] = y1
-      line['x2'] = x2
-      line['y2'] = y2
-      line['width'] = w
-      line['layer'] = layer
-      package.append(line)
-  
-    def silk(shape):
-      if not 'shape' in shape: return
-      layer = type_to_layer_number(shape['type'])
-      s = shape['shape']
-      if s == 'line': line(shape, layer)
-      elif s == 'circle': circle(shape, layer)
-      elif s == 'disc': disc(shape, layer)
-      elif s == 'label': label(shape, layer)
-      elif s == 'rect': rect(shape, layer)
-
-    def unknown(shape):
-      pass
-
-    idx = eget(meta, 'id', 'Id not found')
-    desc = oget(meta, 'desc', '')
-    parent_idx = oget(meta, 'parent', None)
-    description = self.soup.new_tag('description')
-    package.append(description)
-    parent_str = ""
-    if parent_idx != None:
-      parent_str = " parent: %s" % parent_idx
-    description.string = desc + "\n<br/><br/>\nGenerated by 'madparts'.<br/>\nId: " + idx   +"\n" + parent_str
-    # TODO rework to be shape+type based ?
-    for shape in interim:
-      if 'type' in shape:
-        {
-          'pad': pad,
-          'silk': silk,
-          'docu': silk,
-          'keepout': silk,
-          'stop': silk,
-          'restrict': silk,
-          'vrestrict': silk,
-          'smd': smd,
-          }.get(shape['type'], unknown)(shape)
+      self.index[name.lower()] = package
+    _fill_package(self.soup, package, rows)
     return name
 
   def add_ats_to_names(self, interim):
-    t = {}
-    for x in interim:
-      if x['type'] == 'smd' or x['type'] == 'pad':
-        name = x['name']
-        if not name in t:
-          t[name] = 0
-        t[name] = t[name] + 1
-    multi_names = {}
-    for k in t.keys():
-      if t[k] > 1:
-        multi_names[k] = 1
-    def adapt(x):
-      if x['type'] == 'smd' or x['type'] == 'pad':
-        name = re.sub(' ','_', str(x['name']))
-        if name in multi_names:
-          x['name'] = "%s@%d" % (name, multi_names[name])
-          multi_names[name] = multi_names[name] + 1
-      return x
-    return [adapt(x) for x in interim]
+    return add_ats_to_names(interim)
 
 ### IMPORT
 
+def _import_package(package):
+  meta = {}
+  meta['type'] = 'meta'
+  meta['name'] = package.get('name')
+  meta['id'] = uuid.uuid4().hex
+  meta['desc'] = None
+  l = [meta]
+
+  def clean_name(name):
+    if len(name) > 2 and name[0:1] == 'P$':
+      name = name[2:]
+      # this might cause name clashes :(
+      # get rid of @ suffixes
+    return re.sub('@\d+$', '', name)
+
+  def text(text):
+    res = {}
+    res['type'] = 'silk'
+    res['shape'] = 'label'
+    s = text.text
+    layer = int(text.get('layer'))
+    size = float(text.get('size'))
+    align = 'bottom-left' # eagle default
+    if 'align' in text.attrib:
+      align = text.get('align')
+    if align == 'center':
+      x = float(text.get('x'))
+      y = float(text.get('y'))
+    elif align == 'bottom-left':
+      x = float(text.get('x')) + len(s)*size/2
+      y = float(text.get('y')) + size/2
+    else:
+      # TODO deal with all other cases
+      # eagle supports: bottom-left | bottom-center | bottom-right | center-left | center | center-right | top-left | top-center | top-right
+      x = float(text.get('x')) + len(s)*size/2
+      y = float(text.get('y')) + size/2
+    res['value'] = s
+    if layer == 25 and s.upper() == '>NAME':
+      res['value'] = 'NAME'
+    elif layer == 27 and s.upper() == '>VALUE':
+      res['value'] = 'VALUE'
+    if x != 0: res['x'] = x
+    if y != 0: res['y'] = y
+    if 'size' in text.attrib:
+      res['dy'] = float(text.get('size'))
+    return res
+
+  def smd(smd):
+    res = {}
+    res['type'] = 'smd'
+    res['shape'] = 'rect'
+    res['name'] = clean_name(smd.get('name'))
+    res['dx'] = float(smd.get('dx'))
+    res['dy'] = float(smd.get('dy'))
+    res['x'] = float(smd.get('x'))
+    res['y'] = float(smd.get('y'))
+    if 'rot' in smd.attrib:
+      res['rot'] = int(smd.get('rot')[1:])
+    if 'roundness' in smd.attrib:
+      if smd.get('roundness') != '0':
+        res['ro'] = int(smd.get('roundness'))
+    return res
+
+  def rect(rect):
+    res = {}
+    res['type'] = layer_number_to_type(int(rect.get('layer')))
+    res['shape'] = 'rect'
+    x1 = float(rect.get('x1'))
+    y1 = float(rect.get('y1'))
+    x2 = float(rect.get('x2'))
+    y2 = float(rect.get('y2'))
+    res['x'] = (x1+x2)/2
+    res['y'] = (y1+y2)/2
+    res['dx'] = abs(x1-x2)
+    res['dy'] = abs(y1-y2)
+    if 'rot' in rect.attrib:
+      res['rot'] = int(rect.get('rot')[1:])
+    return res
+
+  def wire(wire):
+    res = {}
+    res['type'] = layer_number_to_type(int(wire.get('layer')))
+    res['shape'] = 'line'
+    res['x1'] = float(wire.get('x1'))
+    res['y1'] = float(wire.get('y1'))
+    res['x2'] = float(wire.get('x2'))
+    res['y2'] = float(wire.get('y2'))
+    res['w'] = float(wire.get('width'))
+    return res
+
+  def circle(circle):
+    res = {}
+    res['type'] = layer_number_to_type(int(circle.get('layer')))
+    res['shape'] = 'circle'
+    w =float(circle.get('width'))
+    res['w'] = w
+    res['r'] = float(circle.get('radius')) + w/2
+    res['x'] = float(circle.get('x'))
+    res['y'] = float(circle.get('y'))
+    return res
+
+  def description(desc):
+    meta['desc'] = desc.text
+    return None
+
+  def pad(pad):
+    res = {}
+    res['type'] = 'pad'
+    res['name'] = clean_name(pad.get('name'))
+    res['x'] = float(pad.get('x'))
+    res['y'] = float(pad.get('y'))
+    drill = float(pad.get('drill'))
+    res['drill'] = drill
+    if 'diameter' in pad.attrib:
+      dia = float(pad.get('diameter'))
+    else:
+      dia = res['drill'] * 1.5
+    if 'rot' in pad.attrib:
+      res['rot'] = int(pad.get('rot')[1:])
+    shape = 'round'
+    if 'shape' in pad.attrib:
+      shape = pad.get('shape')
+    if shape == 'round':
+      res['shape'] = 'disc'
+      res['r'] = 0.0
+      #if dia/2 > drill:
+      res['r'] = dia/2
+    elif shape == 'square':
+      res['shape'] = 'rect'
+      res['dx'] = dia
+      res['dy'] = dia
+    elif shape == 'long':
+      res['shape'] = 'rect'
+      res['ro'] = 100
+      res['dx'] = 2*dia
+      res['dy'] = dia
+    elif shape == 'offset':
+      res['shape'] = 'rect'
+      res['ro'] = 100
+      res['dx'] = 2*dia
+      res['dy'] = dia
+      res['drill_dx'] = -dia/2
+    elif shape == 'octagon':
+      res['shape'] = 'octagon'
+      res['r'] = dia/2
+    return res
+    
+
+  def unknown(x):
+    res = {}
+    res['type'] = 'unknown'
+    res['value'] = ElementTree.tostring(x)
+    res['shape'] = 'unknown'
+    return res
+
+  for x in package:
+    result = {
+      'circle': circle,
+      'description': description,
+      'pad': pad,
+      'smd': smd,
+      'text': text,
+      'wire': wire,
+      'rectangle': rect,
+      }.get(x.tag, unknown)(x)
+    if result != None: l.append(result)
+  return l
+
+# import a package from its XML, as given by Import.package_xml
+def import_package_xml(data):
+  return _import_package(ElementTree.fromstring(data))
+
 class Import:
 
   def __init__(self, fn):
-    self.soup = _load_xml_file(fn)
-    _check_xml(self.soup)
+    self.fn = fn
+    _check_xml_stream(fn)
+
+  def _packages(self):
+    return _iter_packages(self.fn)
+
+  # (name, package XML) of all packages in the library
+  def package_xml(self):
+    for p in self._packages():
+      yield (p.get('name'), self._tostring(p))
+
+  _tostring = staticmethod(ElementTree.tostring)
 
   def list_names(self):
-    packages = self.soup.eagle.drawing.packages('package')
     def desc(p):
-      if p.description != None: return p.description.string
+      description = p.find('description')
+      if description != None: return description.text
       else: return None
-    return [(p['name'], desc(p)) for p in packages]
+    return [(p.get('name'), desc(p)) for p in self._packages()]
 
   def import_footprint(self, name):
-
-    packages = self.soup.eagle.drawing.packages('package')
-    package = None
-    for p in packages:
-       if p['name'] == name:
-         package = p
-         break
-    if package == None:
-      raise Exception("footprint not found %s " % (name))
-    meta = {}
-    meta['type'] = 'meta'
-    meta['name'] = name
-    meta['id'] = uuid.uuid4().hex
-    meta['desc'] = None
-    l = [meta]
-
-    def clean_name(name):
-      if len(name) > 2 and name[0:1] == 'P$':
-        name = name[2:]
-        # this might cause name clashes :(
-        # get rid of @ suffixes
-      return re.sub('@\d+$', '', name)
-
-    def text(text):
-      res = {}
-      res['type'] = 'silk'
-      res['shape'] = 'label'
-      s = text.string
-      layer = int(text['layer'])
-      size = float(text['size'])
-      align = 'bottom-left' # eagle default
-      if text.has_key('align'):
-        align = text['align']
-      if align == 'center':
-        x = float(text['x'])
-        y = float(text['y'])
-      elif align == 'bottom-left':
-        x = float(text['x']) + len(s)*size/2
-        y = float(text['y']) + size/2
-      else:
-        # TODO deal with all other cases
-        # eagle supports: bottom-left | bottom-center | bottom-right | center-left | center | center-right | top-left | top-center | top-right
-        x = float(text['x']) + len(s)*size/2
-        y = float(text['y']) + size/2
-      res['value'] = s
-      if layer == 25 and s.upper() == '>NAME':
-        res['value'] = 'NAME'
-      elif layer == 27 and s.upper() == '>VALUE':
-        res['value'] = 'VALUE'
-      if x != 0: res['x'] = x
-      if y != 0: res['y'] = y
-      if text.has_key('size'):
-        res['dy'] = text['size']
-      return res
-
-    def smd(smd):
-      res = {}
-      res['type'] = 'smd'
-      res['shape'] = 'rect'
-      res['name'] = clean_name(smd['name'])
-      res['dx'] = float(smd['dx'])
-      res['dy'] = float(smd['dy'])
-      res['x'] = float(smd['x'])
-      res['y'] = float(smd['y'])
-      if smd.has_key('rot'):
-        res['rot'] = int(smd['rot'][1:])
-      if smd.has_key('roundness'):
-        if smd['roundness'] != '0':
-          res['ro'] = smd['roundness']
-      return res
-
-    def rect(rect):
-      res = {}
-      res['type'] = layer_number_to_type(int(rect['layer']))
-      res['shape'] = 'rect'
-      x1 = float(rect['x1'])
-      y1 = float(rect['y1'])
-      x2 = float(rect['x2'])
-      y2 = float(rect['y2'])
-      res['x'] = (x1+x2)/2
-      res['y'] = (y1+y2)/2
-      res['dx'] = abs(x1-x2)
-      res['dy'] = abs(y1-y2)
-      if rect.has_key('rot'):
-        res['rot'] = int(rect['rot'][1:])
-      return res
-
-    def wire(wire):
-      res = {}
-      res['type'] = layer_number_to_type(int(wire['layer']))
-      res['shape'] = 'line'
-      res['x1'] = float(wire['x1'])
-      res['y1'] = float(wire['y1'])
-      res['x2'] = float(wire['x2'])
-      res['y2'] = float(wire['y2'])
-      res['w'] = float(wire['width'])
-      return res
-
-    def circle(circle):
-      res = {}
-      res['type'] = layer_number_to_type(int(circle['layer']))
-      res['shape'] = 'circle'
-      w =float(circle['width'])
-      res['w'] = w
-      res['r'] = float(circle['radius']) + w/2
-      res['x'] = float(circle['x'])
-      res['y'] = float(circle['y'])
-      return res
-
-    def description(desc):
-      meta['desc'] = desc.string
-      return None
-
-    def pad(pad):
-      res = {}
-      res['type'] = 'pad'
-      res['name'] = clean_name(pad['name'])
-      res['x'] = float(pad['x'])
-      res['y'] = float(pad['y'])
-      drill = float(pad['drill'])
-      res['drill'] = drill
-      if pad.has_key('diameter'):
-        dia = float(pad['diameter'])
-      else:
-        dia = res['drill'] * 1.5
-      if pad.has_key('rot'):
-        res['rot'] = int(pad['rot'][1:])
-      shape = 'round'
-      if pad.has_key('shape'):
-        shape = pad['shape']
-      if shape == 'round':
-        res['shape'] = 'disc'
-        res['r'] = 0.0
-        #if dia/2 > drill:
-        res['r'] = dia/2
-      elif shape == 'square':
-        res['shape'] = 'rect'
-        res['dx'] = dia
-        res['dy'] = dia
-      elif shape == 'long':
-        res['shape'] = 'rect'
-        res['ro'] = 100
-        res['dx'] = 2*dia
-        res['dy'] = dia
-      elif shape == 'offset':
-        res['shape'] = 'rect'
-        res['ro'] = 100
-        res['dx'] = 2*dia
-        res['dy'] = dia
-        res['drill_dx'] = -dia/2
-      elif shape == 'octagon':
-        res['shape'] = 'octagon'
-        res['r'] = dia/2
-      return res
-      
-
-    def unknown(x):
-      res = {}
-      res['type'] = 'unknown'
-      res['value'] = str(x)
-      res['shape'] = 'unknown'
-      return res
-
-    for x in package.contents:
-      if type(x) == Tag:
-        result = {
-          'circle': circle,
-          'description': description,
-          'pad': pad,
-          'smd': smd,
-          'text': text,
-          'wire': wire,
-          'rectangle': rect,
-          }.get(x.name, unknown)(x)
-        if result != None: l.append(result)
-    return l
-
+    return self.import_footprints([name])[0]
+
+  # import a list of footprints in a single pass over the library;
+  # like in eagle, names are not case sensitive
+  def import_footprints(self, names):
+    wanted = {}
+    for (i, name) in enumerate(names):
+      wanted.setdefault(name.lower(), []).append(i)
+    result = [None] * len(names)
+    for p in self._packages():
+      for i in wanted.pop(p.get('name').lower(), []):
+        result[i] = _import_package(p)
+      if len(wanted) == 0: break
+    if len(wanted) > 0:
+      name = names[min(map(min, wanted.values()))]
+      raise Exception("Footprint %s not found in %s." % (name, self.fn))
+    return result
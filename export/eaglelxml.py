@@ -0,0 +1,168 @@
+# (c) 2013 Joost Yervante Damad <joost@damad.be>
+# License: GPL
+#
+# eagle library support using lxml directly instead of BeautifulSoup;
+# same API as export.eagle but a lot faster on big libraries
+
+from xml.sax.saxutils import escape
+
+from lxml import etree
+
+import eagle
+from eagle import check_xml_file, splice_footprint, splice_footprints, sync_footprints, import_package_xml
+
+def _load_xml_file(fn):
+  return etree.parse(fn)
+
+def _save_xml_file(fn, tree, fsync=False):
+  def _write(f):
+    tree.write(f, xml_declaration=True, encoding='UTF-8')
+  eagle._atomic_write(fn, _write, fsync)
+
+def _check_xml(tree):
+  root = tree.getroot()
+  if root.tag != 'eagle':
+    raise Exception("Unknown file format")
+  return eagle._check_version(root.get('version'))
+
+def _iter_packages(fn):
+  context = etree.iterparse(fn, events=('end',), tag='package', remove_comments=True)
+  for (event, elem) in context:
+    yield elem
+    # drop the packages already looked at
+    elem.clear()
+    while elem.getprevious() is not None:
+      del elem.getparent()[0]
+
+def _attribute_value(v):
+  if not isinstance(v, basestring):
+    v = unicode(v)
+  return v
+
+# pretty printing that gives exactly the same result as
+# BeautifulSoup's prettify(), so both backends can be used
+# interchangeably
+
+def _pretty_attributes(element):
+  return eagle.xml_attributes(element.attrib)
+
+def _pretty_text(text, level, out):
+  text = text.strip()
+  if text != '':
+    out.append(' ' * (level - 1))
+    out.append(text)
+    out.append('\n')
+
+def _pretty_contents(element, level, out):
+  if element.text != None:
+    _pretty_text(escape(element.text), level, out)
+  for child in element:
+    if child.tag is etree.Comment:
+      _pretty_text('<!--%s-->' % (child.text), level, out)
+    else:
+      _pretty(child, level, out)
+    if child.tail != None:
+      _pretty_text(escape(child.tail), level, out)
+
+def _pretty(element, level, out):
+  indent = ' ' * (level - 1)
+  empty = element.text == None and len(element) == 0
+  out.append(indent)
+  out.append('<%s%s' % (element.tag, _pretty_attributes(element)))
+  if empty:
+    out.append('/>\n')
+    return
+  out.append('>\n')
+  start = len(out)
+  _pretty_contents(element, level + 1, out)
+  if len(out) > start and not out[-1].endswith('\n'):
+    out.append('\n')
+  out.append(indent)
+  out.append('</%s>' % (element.tag))
+  if element.tail != None or element.getnext() is not None:
+    out.append('\n')
+
+def _prettify_element(element):
+  out = []
+  _pretty(element, 1, out)
+  return ''.join(out).encode('utf-8')
+
+def _prettify_tree(tree):
+  out = ['<?xml version="1.0" encoding="utf-8"?>\n']
+  if tree.docinfo.doctype != '':
+    _pretty_text(tree.docinfo.doctype, 1, out)
+  _pretty(tree.getroot(), 1, out)
+  return ''.join(out).encode('utf-8')
+
+### EXPORT
+
+class Export:
+
+  # tree can be passed in if the library is already parsed
+  def __init__(self, fn, tree=None):
+    self.fn = fn
+    if tree == None:
+      tree = _load_xml_file(fn)
+    self.tree = tree
+    _check_xml(self.tree)
+    self.packages = self.tree.getroot().find('drawing').find('.//packages')
+    self.index = self._package_index()
+
+  def save(self, fsync=False):
+    _save_xml_file(self.fn, self.tree, fsync)
+
+  def get_data(self):
+    return etree.tostring(self.tree, xml_declaration=True, encoding='UTF-8')
+
+  # remark that this pretty formatting is NOT what is used in the final
+  # eagle XML as eagle does not get rid of heading and trailing \n and such
+  def get_pretty_data(self):
+    return _prettify_tree(self.tree)
+
+  def get_pretty_footprint(self, eagle_name):
+    package = self.index.get(eagle_name.lower())
+    if package == None:
+      raise Exception("Footprint not found")
+    return _prettify_element(package)
+
+  # lowercase name -> package, kept up to date by export_footprint
+  def _package_index(self):
+    index = {}
+    for package in self.packages.iter('package'):
+      index.setdefault(package.get('name').lower(), package)
+    return index
+
+  # export a list of footprints; returns the list of package names
+  def export_many(self, interims):
+    return [self.export_footprint(interim) for interim in interims]
+
+  def export_footprint(self, interim):
+    (name, rows) = eagle.package_rows(interim)
+    # check if there is an existing package
+    # and if so, replace it
+    package = self.index.get(name.lower())
+    if package != None:
+      for child in list(package):
+        package.remove(child)
+      package.text = None
+    else:
+      package = etree.SubElement(self.packages, 'package', name=name)
+      self.index[name.lower()] = package
+    for (tag, attrs, text) in rows:
+      element = etree.SubElement(package, tag)
+      for (k, v) in sorted(attrs.items()):
+        element.set(k, _attribute_value(v))
+      element.text = text
+    return name
+
+  def add_ats_to_names(self, interim):
+    return eagle.add_ats_to_names(interim)
+
+### IMPORT
+
+class Import(eagle.Import):
+
+  def _packages(self):
+    return _iter_packages(self.fn)
+
+  _tostring = staticmethod(etree.tostring)
@@ -21,6 +21,7 @@ color_schemes['default'] = {
   'keepout':  (1.0, 0.0, 0.5, 0.7),
   'unknown':  (1.0, 0.0, 1.0, 0.7),
   'hole': (1.0, 1.0, 1.0, 0.7),
+  'drc': (1.0, 0.0, 0.0, 0.9),
   }
 
 def _inverse(color_scheme):
@@ -42,5 +43,6 @@ default_settings = {
   'gui/displayrestrict': False,
   'gui/displaystop': False,
   'gui/displaykeepout': False,
+  'gui/displaydrc': False,
   'gui/autocompile': True,
 }
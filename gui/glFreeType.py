@@ -8,7 +8,8 @@
 # We are going to use Python Image Library's font handling
 # From PIL 1.1.4:
 
-import sys
+import sys, os, os.path
+import hashlib, tempfile
 
 if sys.platform == 'win32':
   # we're using pillow 2.0 on win32
@@ -18,6 +19,8 @@ else:
   
 from OpenGL.GL import *
 
+import numpy
+
 def is_font_available (ft, facename):
     """ Returns true if FreeType can find the requested face name 
         Pass the basname of the font e.g. "arial" or "times new roman"
@@ -36,174 +39,45 @@ def next_p2 (num):
 
 
 
-def make_dlist (ft, ch, list_base, tex_base_list):
-    """ Given an integer char code, build a GL texture into texture_array,
-        build a GL display list for display list number display_list_base + ch.
-        Populate the glTexture for the integer ch and construct a display
-        list that renders the texture for ch.
-        Note, that display_list_base and texture_base are supposed
-        to be preallocated for 128 consecutive display lists and and 
-        array of textures.
+def glyph_bitmap (ft, ch):
+    """ Renders the integer char code ch with PIL's FreeType wrapper;
+        returns (width, height, rows) with rows a numpy uint8 array
+        of height rows of width luminance values.
     """
-
-    # //The first thing we do is get FreeType to render our character
-    # //into a bitmap.  This actually requires a couple of FreeType commands:
-    # //Load the Glyph for our character.
-    # //Move the face's glyph into a Glyph object.
-    # //Convert the glyph to a bitmap.
-    # //This reference will make accessing the bitmap easier
-    # - This is the 2 dimensional Numeric array
-
-    # Use our helper function to get the widths of
-    # the bitmap data that we will need in order to create
-    # our texture.
     glyph = ft.getmask (chr (ch))
-    glyph_width, glyph_height = glyph.size 
-    # We are using PIL's wrapping for FreeType. As a result, we don't have 
-    # direct access to glyph.advance or other attributes, so we add a 1 pixel pad.
-    width = next_p2 (glyph_width + 1)
-    height = next_p2 (glyph_height + 1)
-
-
-    # python GL will accept lists of integers or strings, but not Numeric arrays
-    # so, we buildup a string for our glyph's texture from the Numeric bitmap 
-
-    # Here we fill in the data for the expanded bitmap.
-    # Notice that we are using two channel bitmap (one for
-    # luminocity and one for alpha), but we assign
-    # both luminocity and alpha to the value that we
-    # find in the FreeType bitmap. 
-    # We use the ?: operator so that value which we use
-    # will be 0 if we are in the padding zone, and whatever
-    # is the the Freetype bitmap otherwise.
-    expanded_data = ""
-    for j in xrange (height):
-        for i in xrange (width):
-            if (i >= glyph_width) or (j >= glyph_height):
-                value = chr (0)
-                expanded_data += value
-                expanded_data += value
-            else:
-                value = chr (glyph.getpixel ((i, j)))
-                expanded_data += value
-                expanded_data += value
-
-    # -------------- Build the gl texture ------------
-
-    # Now we just setup some texture paramaters.
-    ID = glGenTextures (1)
-    tex_base_list [ch] = ID
-    glBindTexture (GL_TEXTURE_2D, ID)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
-    glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
-
-    border = 0
-    # Here we actually create the texture itself, notice
-    # that we are using GL_LUMINANCE_ALPHA to indicate that
-    # we are using 2 channel data.
-    glTexImage2D( GL_TEXTURE_2D, 0, GL_RGBA, width, height,
-        border, GL_LUMINANCE_ALPHA, GL_UNSIGNED_BYTE, expanded_data )
-
-    # With the texture created, we don't need to expanded data anymore
-    expanded_data = None
-
-
-
-    # --- Build the gl display list that draws the texture for this character ---
-
-    # So now we can create the display list
-    glNewList (list_base + ch, GL_COMPILE)
-
-    if (ch == ord (" ")):
-        glyph_advance = glyph_width
-        glTranslatef(glyph_advance, 0, 0)
-        glEndList()
-    else:
+    glyph_width, glyph_height = glyph.size
+    rows = numpy.array (list (glyph), dtype=numpy.uint8)
+    return (glyph_width, glyph_height, rows.reshape (glyph_height, glyph_width))
 
-        glBindTexture (GL_TEXTURE_2D, ID)
-
-        glPushMatrix()
-
-        # // first we need to move over a little so that
-        # // the character has the right amount of space
-        # // between it and the one before it.
-        # glyph_left = glyph.bbox [0]
-        # glTranslatef(glyph_left, 0, 0)
-
-        # // Now we move down a little in the case that the
-        # // bitmap extends past the bottom of the line 
-        # // this is only true for characters like 'g' or 'y'.
-        # glyph_descent = glyph.decent
-        # glTranslatef(0, glyph_descent, 0)
-
-        # //Now we need to account for the fact that many of
-        # //our textures are filled with empty padding space.
-        # //We figure what portion of the texture is used by 
-        # //the actual character and store that information in 
-        # //the x and y variables, then when we draw the
-        # //quad, we will only reference the parts of the texture
-        # //that we contain the character itself.
-        x=float (glyph_width) / float (width)
-        y=float (glyph_height) / float (height)
-
-        # //Here we draw the texturemaped quads.
-        # //The bitmap that we got from FreeType was not 
-        # //oriented quite like we would like it to be,
-        # //so we need to link the texture to the quad
-        # //so that the result will be properly aligned.
-        glBegin(GL_QUADS)
-        glTexCoord2f(0,0), glVertex2f(0,glyph_height)
-        glTexCoord2f(0,y), glVertex2f(0,0)
-        glTexCoord2f(x,y), glVertex2f(glyph_width,0)
-        glTexCoord2f(x,0), glVertex2f(glyph_width, glyph_height)
-        glEnd()
-        glPopMatrix()
-
-        # Note, PIL's FreeType interface hides the advance from us.
-        # Normal PIL clients are rendering an entire string through FreeType, not
-        # a single character at a time like we are doing here.
-        # Because the advance value is hidden from we will advance
-        # the "pen" based upon the rendered glyph's width. This is imperfect.
-        glTranslatef(glyph_width + 0.75, 0, 0)
-
-        # //increment the raster position as if we were a bitmap font.
-        # //(only needed if you want to calculate text length)
-        # //glBitmap(0,0,0,0,face->glyph->advance.x >> 6,0,NULL)
-
-        # //Finnish the display list
-        glEndList()
-
-    return
-
-# /// A fairly straight forward function that pushes
-# /// a projection matrix that will make object world 
-# /// coordinates identical to window coordinates.
-def pushScreenCoordinateMatrix():
-    glPushAttrib(GL_TRANSFORM_BIT)
-    [left,bottom,right,top] = glGetIntegerv(GL_VIEWPORT)
-    glMatrixMode(GL_PROJECTION)
-    glPushMatrix()
-    glLoadIdentity()
-    dx = (right-left)/2
-    dy = (top-bottom)/2
-    glOrtho( -dx, +dx, -dy, +dy, -1,+1)
-    glPopAttrib()
-    return
-
-
-# Pops the projection matrix without changing the current
-# MatrixMode.
-def pop_projection_matrix():
-    glPushAttrib(GL_TRANSFORM_BIT)
-    glMatrixMode(GL_PROJECTION)
-    glPopMatrix()
-    glPopAttrib()
-    return
+
+# bump when the layout of the atlas cache files changes
+cache_version = 1
+
+def cache_file_name (cache_dir, facename, pixel_height):
+    """ The atlas cache file of a font, keyed by the font file (path,
+        size and modification time) and the pixel height.
+    """
+    st = os.stat (facename)
+    key = "%d %s %d %d %d" % (cache_version, os.path.abspath (facename),
+        st.st_size, int (st.st_mtime), pixel_height)
+    if isinstance (key, unicode):
+        key = key.encode ('utf-8')
+    return os.path.join (cache_dir, "glyphs-%s.npz" % (hashlib.sha1 (key).hexdigest ()))
 
 
 class font_data:
-    def __init__ (self, facename, pixel_height):
-        # We haven't yet allocated textures or display lists
+    """ The 128 ASCII glyphs of a font in a single texture, the atlas,
+        with a fixed cell per char code. Glyphs are rendered the first
+        time they are used and the texture is only updated on bind.
+        With a cache_dir, the glyphs rendered so far are kept on disk
+        so a next run doesn't have to render them again.
+        Text is not drawn here: string_quads gives the textured quads
+        for a string, so a caller can put the quads of many strings
+        in one buffer and draw them all at once with the atlas bound.
+    """
+
+    def __init__ (self, facename, pixel_height, cache_dir=None):
+        # We haven't yet allocated the texture
         self.m_allocated = False
         self.m_font_height = pixel_height
         self.m_facename = facename
@@ -214,104 +88,210 @@ class font_data:
         except:
             raise ValueError, "Unable to locate true type font '%s'" % (facename)
 
-        # Here we ask opengl to allocate resources for
-        # all the textures and displays lists which we
-        # are about to create.  
-        self.m_list_base = glGenLists (128)
+        # string -> size and string -> quads
+        self.sizes = {}
+        self.quads = {}
+
+        # the cells are pixel_height squares in a 16x8 grid; the glyphs
+        # are clipped to leave a 1 pixel empty border so linear
+        # filtering doesn't pick up the neighbours
+        self.cell_width = pixel_height
+        self.cell_height = pixel_height
+        self.width = next_p2 (self.cell_width * 16)
+        self.height = next_p2 (self.cell_height * 8)
+
+        # one channel, it is used for both luminance and alpha
+        self.atlas = numpy.zeros ((self.height, self.width), dtype=numpy.uint8)
 
-        # Consturct a list of 128 elements. This
-        # list will be assigned the texture IDs we create for each glyph
-        self.textures = [None] * 128
+        # ch -> (glyph width, glyph height, char width, char height)
+        # with the char size as reported by PIL, None if not rendered yet
+        self.metrics = [None] * 128
 
-        # This is where we actually create each of the fonts display lists.
-        for i in xrange (128):
-            make_dlist (self.ft, i, self.m_list_base, self.textures);
+        # the range of atlas rows not uploaded yet
+        self.dirty = None
+        self.texture = None
 
-        self.m_allocated = True
+        self.cache_file = None
+        self.cache_dirty = False
+        if cache_dir != None:
+            self.cache_file = cache_file_name (cache_dir, facename, pixel_height)
+            self._load_cache ()
 
         return
 
-    def glPrint (self, x, y, string, scale):
+    def _load_cache (self):
+        if not os.path.exists (self.cache_file):
+            return
+        # a broken cache file is simply rendered again
+        try:
+            cache = numpy.load (self.cache_file)
+            atlas = cache ['atlas']
+            metrics = cache ['metrics']
+        except:
+            return
+        if atlas.shape != self.atlas.shape or metrics.shape != (128, 4):
+            return
+        self.atlas = atlas
+        for ch in xrange (128):
+            if metrics [ch, 0] >= 0:
+                self.metrics [ch] = tuple ([int (m) for m in metrics [ch]])
+
+    def _save_cache (self):
+        metrics = numpy.array ([m or (-1, -1, -1, -1) for m in self.metrics], dtype=numpy.int32)
+        # the cache only makes startup faster, failing to write it is fine
+        try:
+            cache_dir = os.path.dirname (self.cache_file)
+            if not os.path.isdir (cache_dir):
+                os.makedirs (cache_dir)
+            (fd, tmp_fn) = tempfile.mkstemp (suffix='.npz', dir=cache_dir)
+        except (IOError, OSError):
+            return
+        try:
+            with os.fdopen (fd, 'wb') as f:
+                numpy.savez_compressed (f, atlas=self.atlas, metrics=metrics)
+            # rename doesn't replace an existing file on windows
+            if sys.platform == 'win32' and os.path.exists (self.cache_file):
+                os.remove (self.cache_file)
+            os.rename (tmp_fn, self.cache_file)
+        except (IOError, OSError):
+            # don't leave the temporary file behind, e.g. when another
+            # instance has the cache file open on windows
+            try:
+                os.remove (tmp_fn)
+            except OSError:
+                pass
+            return
+        self.cache_dirty = False
+
+    def _render (self, ch):
+        (glyph_width, glyph_height, rows) = glyph_bitmap (self.ft, ch)
+        glyph_width = min (glyph_width, self.cell_width - 1)
+        glyph_height = min (glyph_height, self.cell_height - 1)
+        x = (ch % 16) * self.cell_width
+        y = (ch / 16) * self.cell_height
+        self.atlas [y:y+glyph_height, x:x+glyph_width] = rows [:glyph_height, :glyph_width]
+        (char_width, char_height) = self.ft.getsize (chr (ch))
+        self.metrics [ch] = (glyph_width, glyph_height, char_width, char_height)
+        if self.dirty == None:
+            self.dirty = (y, y + self.cell_height)
+        else:
+            self.dirty = (min (self.dirty [0], y), max (self.dirty [1], y + self.cell_height))
+        self.cache_dirty = True
+
+    def glyph (self, ch):
+        """ Returns (glyph width, glyph height, u0, v0, u1, v1) for the
+            integer char code ch, with (u0, v0) the top left corner of
+            the glyph in the atlas; the glyph is rendered if needed.
         """
-        # ///Much like Nehe's glPrint function, but modified to work
-        # ///with freetype fonts.
+        if self.metrics [ch] == None:
+            self._render (ch)
+        (glyph_width, glyph_height, char_width, char_height) = self.metrics [ch]
+        x = (ch % 16) * self.cell_width
+        y = (ch / 16) * self.cell_height
+        return (glyph_width, glyph_height,
+            float (x) / self.width, float (y) / self.height,
+            float (x + glyph_width) / self.width, float (y + glyph_height) / self.height)
+
+    def char_size (self, ch):
+        """ The (width, height) in pixels PIL reports for char code ch """
+        if self.metrics [ch] == None:
+            self._render (ch)
+        return self.metrics [ch] [2:]
+
+    def bind (self):
+        """ Binds the atlas texture, first uploading the glyphs rendered
+            since the last bind. Needs the GL context to be current.
         """
-        # We want a coordinate system where things coresponding to window pixels.
-        pushScreenCoordinateMatrix()
-    
+        if self.texture == None:
+            self.texture = glGenTextures (1)
+            glBindTexture (GL_TEXTURE_2D, self.texture)
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+            glTexParameterf(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+            glPixelStorei (GL_UNPACK_ALIGNMENT, 1)
+            glTexImage2D( GL_TEXTURE_2D, 0, GL_RGBA, self.width, self.height,
+                0, GL_LUMINANCE_ALPHA, GL_UNSIGNED_BYTE, self._texture_data (0, self.height))
+            self.m_allocated = True
+            self.dirty = None
+        else:
+            glBindTexture (GL_TEXTURE_2D, self.texture)
+        if self.dirty != None:
+            (y1, y2) = self.dirty
+            glPixelStorei (GL_UNPACK_ALIGNMENT, 1)
+            glTexSubImage2D (GL_TEXTURE_2D, 0, 0, y1, self.width, y2 - y1,
+                GL_LUMINANCE_ALPHA, GL_UNSIGNED_BYTE, self._texture_data (y1, y2))
+            self.dirty = None
+        if self.cache_dirty and self.cache_file != None:
+            self._save_cache ()
+
+    def _texture_data (self, y1, y2):
+        # luminance and alpha both get the glyph value
+        return numpy.repeat (self.atlas [y1:y2, :, None], 2, axis=2).tostring ()
+
+    def string_size (self, string):
+        """ The (width, height) in pixels of string, based on what PIL
+            reports for the separate characters; asking PIL for the
+            size of every string is a lot slower.
+        """
+        size = self.sizes.get (string)
+        if size == None:
+            width = 0
+            height = 0
+            for line in string.split ("\n"):
+                sizes = [self.char_size (ord (c)) for c in line if ord (c) < 128]
+                width = max (width, sum ([w for (w, h) in sizes]))
+                height = max ([height] + [h for (w, h) in sizes])
+            size = (width, height)
+            self.sizes [string] = size
+        return size
+
+    def string_quads (self, string):
+        """ Returns a float32 numpy array with a row (x, y, u, v) per quad
+            corner to draw string with GL_QUADS, in pixels with the
+            origin at the bottom left of the first line.
+            The array is cached and shared, so don't modify it.
+        """
+        quads = self.quads.get (string)
+        if quads is not None:
+            return quads
         # //We make the height about 1.5* that of
-        h = float (self.m_font_height) / 0.63        
-    
-        # If There's No Text
-        # Do Nothing
-        if (string == None):
-            pop_projection_matrix()
-            return
-        if (string == ""):
-            pop_projection_matrix()
-            return
-
-        # //Here is some code to split the text that we have been
-        # //given into a set of lines.  
-        # //This could be made much neater by using
-        # //a regular expression library such as the one avliable from
-        # //boost.org (I've only done it out by hand to avoid complicating
-        # //this tutorial with unnecessary library dependencies).
-        # //Note: python string object has convenience method for this :)
-        lines = string.split ("\n")
-
-        glPushAttrib(GL_LIST_BIT | GL_CURRENT_BIT  | GL_ENABLE_BIT | GL_TRANSFORM_BIT)
-        glMatrixMode(GL_MODELVIEW)
-        glDisable(GL_LIGHTING)
-        glEnable(GL_TEXTURE_2D)
-        glDisable(GL_DEPTH_TEST)
-        glEnable(GL_BLEND)
-        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-
-        glListBase(self.m_list_base)
-        modelview_matrix = glGetFloatv(GL_MODELVIEW_MATRIX)
-
-        # //This is where the text display actually happens.
-        # //For each line of text we reset the modelview matrix
-        # //so that the line's text will start in the correct position.
-        # //Notice that we need to reset the matrix, rather than just translating
-        # //down by h. This is because when each character is
-        # //draw it modifies the current matrix so that the next character
-        # //will be drawn immediatly after it.  
-        for i in xrange (len (lines)):
-            line = lines [i]
-            glPushMatrix ()
-            glLoadIdentity ()
-            glTranslatef (x,y-h*i,0)
-            glScalef (scale, scale, 0)
-            glMultMatrixf (modelview_matrix)
-
-            # //  The commented out raster position stuff can be useful if you need to
-            # //  know the length of the text that you are creating.
-            # //  If you decide to use it make sure to also uncomment the glBitmap command
-            # //  in make_dlist().
-            # //    glRasterPos2f(0,0);
-            glCallLists (line)
-            # //    rpos = glGetFloatv (GL_CURRENT_RASTER_POSITION)
-            # //    float len=x-rpos[0];
-            glPopMatrix()
-
-        glPopAttrib()
-        pop_projection_matrix()
-        return
+        h = float (self.m_font_height) / 0.63
+        rows = []
+        for (i, line) in enumerate (string.split ("\n")):
+            x = 0.0
+            y = -h * i
+            for c in line:
+                ch = ord (c)
+                if ch >= 128:
+                    continue
+                (glyph_width, glyph_height, u0, v0, u1, v1) = self.glyph (ch)
+                if c == " ":
+                    x += glyph_width
+                    continue
+                # The bitmap that we got from FreeType is upside down
+                # compared to GL, hence v0 at the top of the quad.
+                if glyph_height > 0:
+                    rows.extend ([
+                        (x, y + glyph_height, u0, v0),
+                        (x, y, u0, v1),
+                        (x + glyph_width, y, u1, v1),
+                        (x + glyph_width, y + glyph_height, u1, v0)])
+                # Note, PIL's FreeType interface hides the advance from us.
+                # Because the advance value is hidden from us we will advance
+                # the "pen" based upon the rendered glyph's width. This is imperfect.
+                x += glyph_width + 0.75
+        quads = numpy.array (rows, dtype=numpy.float32).reshape (-1, 4)
+        self.quads [string] = quads
+        return quads
 
     def release (self):
         """ Release the gl resources for this Face.
             (This provides the functionality of KillFont () and font_data::clean ()
         """
         if (self.m_allocated):
-            # Free up the glTextures and the display lists for our face
-            glDeleteLists ( self.m_list_base, 128);
-            for ID in self.textures:
-                glDeleteTextures (ID);
-            # Extra defensive. Clients that continue to try and use this object
-            # will now trigger exceptions.
-            self.list_base = None
+            # Free up the glyph atlas
+            glDeleteTextures (self.texture);
+            # A next bind creates the texture again from the atlas.
+            self.texture = None
             self.m_allocated = False
         return
 
@@ -18,6 +18,7 @@ from defaultsettings import color_schemes
 from inter import inter
 
 import glFreeType
+from glgeom import *
 
 def make_shader(name):
   print "compiling %s shaders" % (name)
@@ -31,6 +32,17 @@ def make_shader(name):
   print p.log()
   return p
 
+# the per shape parameters of the batched shaders, all vec2
+batch_attributes = {
+  'circle': ['move', 'radius', 'inner', 'drill', 'drill_offset'],
+  'rect': ['move', 'size', 'round', 'drill', 'drill_offset'],
+  'octagon': ['move', 'size', 'drill', 'drill_offset'],
+  'hole': ['move', 'radius'],
+}
+
+# the order in which the batches of a run of shapes are drawn
+batch_order = ['line', 'circle', 'rect', 'octagon', 'hole', 'text']
+
 class GLDraw:
 
   def __init__(self, glw, font, colorscheme):
@@ -38,29 +50,20 @@ class GLDraw:
     self.font = font
     self.color = colorscheme
 
-    self.circle_shader = make_shader("circle")
-    self.circle_move_loc = self.circle_shader.uniformLocation("move")
-    self.circle_radius_loc = self.circle_shader.uniformLocation("radius")
-    self.circle_inner_loc = self.circle_shader.uniformLocation("inner")
-    self.circle_drill_loc = self.circle_shader.uniformLocation("drill")
-    self.circle_drill_offset_loc = self.circle_shader.uniformLocation("drill_offset")
-    self.rect_shader = make_shader("rect")
-    self.rect_size_loc = self.rect_shader.uniformLocation("size")
-    self.rect_move_loc = self.rect_shader.uniformLocation("move")
-    self.rect_round_loc = self.rect_shader.uniformLocation("round")
-    self.rect_drill_loc = self.rect_shader.uniformLocation("drill")
-    self.rect_drill_offset_loc = self.rect_shader.uniformLocation("drill_offset")
-    self.octagon_shader = make_shader("octagon")
-    self.octagon_size_loc = self.octagon_shader.uniformLocation("size")
-    self.octagon_move_loc = self.octagon_shader.uniformLocation("move")
-    self.octagon_drill_loc = self.octagon_shader.uniformLocation("drill")
-    self.octagon_drill_offset_loc = self.octagon_shader.uniformLocation("drill_offset")
-    self.hole_shader = make_shader("hole")
-    self.hole_move_loc = self.hole_shader.uniformLocation("move")
-    self.hole_radius_loc = self.hole_shader.uniformLocation("radius")
-
-    self.square_data = np.array([[-0.5,0.5],[-0.5,-0.5],[0.5,-0.5],[0.5,0.5]], dtype=np.float32)
-    self.square_data_vbo = vbo.VBO(self.square_data)
+    self.shaders = {}
+    self.attribute_locs = {}
+    for (name, attributes) in batch_attributes.items():
+      shader = make_shader(name)
+      self.shaders[name] = shader
+      self.attribute_locs[name] = [shader.attributeLocation(a) for a in attributes]
+
+    # the retained scene: the shapes compiled into vertex data per
+    # run, replayed on every paint; the colors are only applied while
+    # replaying so a color scheme change needs no new scene
+    self.scene_shapes = None
+    self.runs = []
+    self.upload_needed = False
+    self.stale_buffers = []
 
   def set_color(self, t):
     (r,g,b,a) = self.color.get(t, self.color['unknown'])
@@ -69,63 +72,41 @@ class GLDraw:
   def zoom(self):
     return float(self.glw.zoomfactor)
 
-  def _txt(self, shape, dx, dy, x, y, on_pad=False):
+  # the quads (x, y, u, v) of the text of a shape, centered on (x, y)
+  # and scaled to fit in dx by dy, and the height of the text; as the
+  # scaling is done in mm the quads don't depend on the zoom
+  def _txt(self, shape, dx, dy, x, y):
     if 'name' in shape:
       s = str(shape['name'])
     elif 'value' in shape:
       s = str(shape['value'])
-    else: return
-    if not on_pad:
-      self.set_color(shape['type'])
-    else:
-      self.set_color('silk')
-    l = len(s)
-    dxp = dx * self.zoom() # dx in pixels
-    dyp = dy * self.zoom() # dy in pixels
-    (fdx, fdy) = self.font.ft.getsize(s)
-    scale = 1.6*min(dxp / fdx, dyp / fdy)
-    sdx = -scale*fdx/2
-    sdy = -scale*fdy/2
-    glEnable(GL_TEXTURE_2D) # Enables texture mapping
-    glPushMatrix()
-    glLoadIdentity()
-    self.font.glPrint(x*self.zoom()+sdx, y*self.zoom()+sdy, s, scale)
-    glPopMatrix ()
-    glDisable(GL_TEXTURE_2D)
-
-  def label(self, shape, labels):
+    else: return None
+    (fdx, fdy) = self.font.string_size(s)
+    if fdx == 0 or fdy == 0: return None
+    scale = 1.6*min(dx / fdx, dy / fdy)
+    quads = self.font.string_quads(s) * np.array([scale, scale, 1.0, 1.0], dtype=np.float32)
+    quads[:, 0] += x - scale*fdx/2
+    quads[:, 1] += y - scale*fdy/2
+    return (quads, scale*fdy)
+
+  # the shape functions below add the shape to the batches of
+  # the run it is in; text is drawn right after the run and pad
+  # names after everything else
+
+  def label(self, shape, run, labels):
     x = fget(shape,'x')
     y = fget(shape,'y')
     dy = fget(shape,'dy', 1)
     dx = fget(shape,'dx', 100.0) # arbitrary large number
-    self._txt(shape, dx, dy, x, y)
-    return labels
+    run['text'].append(self._txt(shape, dx, dy, x, y))
 
-  def _disc(self, x, y, rx, ry, drill, drill_dx, drill_dy, irx = 0.0, iry = 0.0):
-    self.circle_shader.bind()
-    self.circle_shader.setUniformValue(self.circle_move_loc, x, y)
-    self.square_data_vbo.bind()
-    glEnableClientState(GL_VERTEX_ARRAY)
-    glVertexPointer(2, GL_FLOAT, 0, self.square_data_vbo)
-    self.circle_shader.setUniformValue(self.circle_radius_loc, rx, ry)
-    self.circle_shader.setUniformValue(self.circle_inner_loc, irx, iry)
-    self.circle_shader.setUniformValue(self.circle_drill_loc, drill, 0.0)
-    self.circle_shader.setUniformValue(self.circle_drill_offset_loc, drill_dx, drill_dy)
-    glDrawArrays(GL_QUADS, 0, 4)
-    self.circle_shader.release() 
-
-  def _hole(self, x, y, rx, ry):
-    self.set_color('hole')
-    self.hole_shader.bind()
-    self.hole_shader.setUniformValue(self.hole_move_loc, x, y)
-    self.square_data_vbo.bind()
-    glEnableClientState(GL_VERTEX_ARRAY)
-    glVertexPointer(2, GL_FLOAT, 0, self.square_data_vbo)
-    self.hole_shader.setUniformValue(self.hole_radius_loc, rx, ry)
-    glDrawArrays(GL_QUADS, 0, 4)
-    self.hole_shader.release() 
+  def _disc(self, run, x, y, rx, ry, drill, drill_dx, drill_dy, irx = 0.0, iry = 0.0):
+    run['circle'].append((x, y, rx, ry, irx, iry, drill, 0.0, drill_dx, drill_dy))
 
-  def disc(self, shape, labels):
+  def _hole(self, run, x, y, rx, ry):
+    run['hole'].append((x, y, rx, ry))
+
+  def disc(self, shape, run, labels):
     r = fget(shape, 'r')
     rx = fget(shape, 'rx', r)
     ry = fget(shape, 'ry', r)
@@ -135,14 +116,13 @@ class GLDraw:
     drill_dx = fget(shape,'drill_dx')
     drill_dy = fget(shape,'drill_dy')
  
-    self._disc(x, y, rx, ry, drill, drill_dx, drill_dy)
+    self._disc(run, x, y, rx, ry, drill, drill_dx, drill_dy)
     if drill > 0.0:
-      self._hole(x,y, drill/2, drill/2)
+      self._hole(run, x,y, drill/2, drill/2)
     if 'name' in shape:
-      labels.append(lambda: self._txt(shape, max(rx*1.5, drill), max(ry*1.5, drill), x, y, True))
-    return labels
+      labels.append(self._txt(shape, max(rx*1.5, drill), max(ry*1.5, drill), x, y))
 
-  def circle(self, shape, labels):
+  def circle(self, shape, run, labels):
     r = fget(shape, 'r')
     rx = fget(shape, 'rx', r)
     ry = fget(shape, 'ry', r)
@@ -155,24 +135,11 @@ class GLDraw:
     iry = fget(shape, 'iry', ry)
     ry = ry + w/2
     iry = iry - w/2
-    self._disc(x, y, rx, ry, 0.0, 0.0, 0.0, irx, iry)
+    self._disc(run, x, y, rx, ry, 0.0, 0.0, 0.0, irx, iry)
     if 'name' in shape:
-      labels.append(lambda: self._txt(shape, rx*1.5, ry*1.5, x, y, True))
-    return labels
+      labels.append(self._txt(shape, rx*1.5, ry*1.5, x, y))
 
-  def _octagon(self, x, y, dx, dy, drill, drill_dx, drill_dy):
-    self.octagon_shader.bind()
-    self.octagon_shader.setUniformValue(self.octagon_move_loc, x, y)
-    self.square_data_vbo.bind()
-    glEnableClientState(GL_VERTEX_ARRAY)
-    glVertexPointer(2, GL_FLOAT, 0, self.square_data_vbo)
-    self.octagon_shader.setUniformValue(self.octagon_size_loc, dx, dy)
-    self.octagon_shader.setUniformValue(self.octagon_drill_loc, drill, 0.0)
-    self.octagon_shader.setUniformValue(self.octagon_drill_offset_loc, drill_dx, drill_dy)
-    glDrawArrays(GL_QUADS, 0, 4)
-    self.octagon_shader.release() 
-
-  def octagon(self, shape, labels):
+  def octagon(self, shape, run, labels):
     r = fget(shape, 'r', 0.0)
     dx = fget(shape, 'dx', r*2)
     dy = fget(shape, 'dy', r*2)
@@ -182,14 +149,13 @@ class GLDraw:
     drill_dx = fget(shape,'drill_dx')
     drill_dy = fget(shape,'drill_dy')
  
-    self._octagon(x, y, dx, dy, drill, drill_dx, drill_dy)
+    run['octagon'].append((x, y, dx, dy, drill, 0.0, drill_dx, drill_dy))
     if drill > 0.0:
-      self._hole(x,y, drill/2, drill/2)
+      self._hole(run, x,y, drill/2, drill/2)
     if 'name' in shape:
-      labels.append(lambda: self._txt(shape, dx/1.5, dy/1.5, x, y, True))
-    return labels
+      labels.append(self._txt(shape, dx/1.5, dy/1.5, x, y))
 
-  def rect(self, shape, labels):
+  def rect(self, shape, run, labels):
     x = fget(shape, 'x')
     y = fget(shape, 'y')
     dx = fget(shape, 'dx')
@@ -209,66 +175,155 @@ class GLDraw:
       (drill_dx, drill_dy) = (-drill_dx, drill_dy)
     if rot == 270:
       (drill_dx, drill_dy) = (-drill_dy, -drill_dx)
-    self.rect_shader.bind()
-    self.rect_shader.setUniformValue(self.rect_size_loc, dx, dy)
-    self.rect_shader.setUniformValue(self.rect_move_loc, x, y)
-    self.rect_shader.setUniformValue(self.rect_round_loc, ro, 0)
-    self.rect_shader.setUniformValue(self.rect_drill_loc, drill, 0)
-    self.rect_shader.setUniformValue(self.rect_drill_offset_loc, drill_dx, drill_dy)
-    self.square_data_vbo.bind()
-    glEnableClientState(GL_VERTEX_ARRAY)
-    glVertexPointer(2, GL_FLOAT, 0, self.square_data_vbo)
-    glDrawArrays(GL_QUADS, 0, 4)
-    self.rect_shader.release()
+    run['rect'].append((x, y, dx, dy, ro, 0.0, drill, 0.0, drill_dx, drill_dy))
     if drill > 0.0:
-      self._hole(x,y, drill/2, drill/2)
+      self._hole(run, x,y, drill/2, drill/2)
     if 'name' in shape:
       m = min(dx, dy)/1.5
-      labels.append(lambda: self._txt(shape ,m, m, x, y, True))
-    return labels
+      labels.append(self._txt(shape, m, m, x, y))
 
-  def line(self, shape, labels):
+  def line(self, shape, run, labels):
     x1 = fget(shape, 'x1')
     y1 = fget(shape, 'y1')
     x2 = fget(shape, 'x2')
     y2 = fget(shape, 'y2')
     w = fget(shape, 'w')
-    r = w/2
-
-    dx = x2-x1
-    dy = y2-y1
-    l = math.sqrt(dx*dx + dy*dy)
-    px = dy * r / l # trigoniometrics
-    py = dx * r / l # trigoniometrics
-    glBegin(GL_QUADS)
-    glVertex3f(x1-px, y1+py, 0)
-    glVertex3f(x1+px, y1-py, 0)
-    glVertex3f(x2+px, y2-py, 0)
-    glVertex3f(x2-px, y2+py, 0)
-    glEnd()
-    self._disc(x1, y1, r, r, 0.0, 0.0, 0.0)
-    self._disc(x2, y2, r, r, 0.0, 0.0, 0.0)
-    return labels
+    run['line'].append((x1, y1, x2, y2, w/2))
  
-  def skip(self, shape, labels):
-    return labels
-   
-  def draw(self, shapes):
+  def skip(self, shape, run, labels):
+    pass
+
+  # compile the shapes into the scene; consecutive shapes of the same
+  # type form a run, the shapes of a run all have the same color so
+  # they can be drawn in any order, one batch per shader; the buffers
+  # are uploaded by the next draw
+  def set_shapes(self, shapes):
+    if shapes is self.scene_shapes: return
+    # a recompile often gives the very same shapes
+    if shapes == self.scene_shapes:
+      self.scene_shapes = shapes
+      return
+    # buffers can only be deleted with the GL context current
+    for run in self.runs:
+      self.stale_buffers.extend(run['vbos'].values())
+    runs = []
     labels = []
+    run = None
+    dispatch = {
+      'circle': self.circle,
+      'disc': self.disc,
+      'label': self.label,
+      'line': self.line,
+      'octagon': self.octagon,
+      'rect': self.rect,
+    }
     for shape in shapes:
-      self.set_color(shape['type'])
-      if 'shape' in shape:
-        dispatch = {
-          'circle': self.circle,
-          'disc': self.disc,
-          'label': self.label,
-          'line': self.line,
-          'octagon': self.octagon,
-          'rect': self.rect,
-        }
-        labels = dispatch.get(shape['shape'], self.skip)(shape, labels)
-    for draw_label in labels:
-      draw_label()
+      if not 'shape' in shape: continue
+      t = shape['type']
+      if run == None or run['type'] != t:
+        run = { 'type': t }
+        for name in batch_order: run[name] = []
+        runs.append(run)
+      dispatch.get(shape['shape'], self.skip)(shape, run, labels)
+    # pad names go on top of everything, in the silk color
+    run = { 'type': 'silk' }
+    for name in batch_order: run[name] = []
+    run['text'] = labels
+    runs.append(run)
+    for run in runs:
+      run['vbos'] = {}
+      run['data'] = {}
+      run['tiles'] = {}
+      for name in batch_order:
+        instances = run.pop(name)
+        if name == 'text':
+          instances = [q for q in instances if q is not None]
+        if instances == []: continue
+        (data, counts, bounds, sizes) = batch_vertices(name, instances)
+        (run['data'][name], run['tiles'][name]) = tile_batch(data, counts, bounds, sizes)
+    self.runs = runs
+    self.scene_shapes = shapes
+    self.upload_needed = True
+
+  def _upload(self):
+    for buf in self.stale_buffers:
+      buf.delete()
+    self.stale_buffers = []
+    for run in self.runs:
+      for (name, data) in run['data'].items():
+        run['vbos'][name] = vbo.VBO(data)
+    self.upload_needed = False
+
+  def _draw_ranges(self, mode, ranges):
+    for (start, end) in ranges:
+      glDrawArrays(mode, start, end - start)
+
+  def _draw_lines(self, buf, ranges):
+    buf.bind()
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 0, buf)
+    self._draw_ranges(GL_TRIANGLES, ranges)
+    buf.unbind()
+
+  # quads of (x, y, u, v) textured with the glyph atlas
+  def _draw_text(self, buf, ranges):
+    glEnable(GL_TEXTURE_2D)
+    self.font.bind()
+    buf.bind()
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+    glVertexPointer(2, GL_FLOAT, 16, buf)
+    glTexCoordPointer(2, GL_FLOAT, 16, buf + 8)
+    self._draw_ranges(GL_QUADS, ranges)
+    glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+    buf.unbind()
+    glDisable(GL_TEXTURE_2D)
+
+  def _draw_batch(self, name, buf, ranges):
+    shader = self.shaders[name]
+    locs = self.attribute_locs[name]
+    shader.bind()
+    buf.bind()
+    # corner, then a vec2 per attribute
+    stride = (2 + 2*len(locs))*4
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(2, GL_FLOAT, stride, buf)
+    for (i, loc) in enumerate(locs):
+      if loc < 0: continue # not used by the shader
+      glEnableVertexAttribArray(loc)
+      glVertexAttribPointer(loc, 2, GL_FLOAT, GL_FALSE, stride, buf + (2 + 2*i)*4)
+    self._draw_ranges(GL_QUADS, ranges)
+    for loc in locs:
+      if loc >= 0: glDisableVertexAttribArray(loc)
+    buf.unbind()
+    shader.release()
+
+  # the part of the scene in view, in mm
+  def view(self):
+    (vx, vy) = self.glw.visible
+    return (-vx/2, -vy/2, vx/2, vy/2)
+
+  # replay the part of the scene that is in view
+  def draw(self):
+    if self.upload_needed:
+      self._upload()
+    view = self.view()
+    zoom = self.zoom()
+    for run in self.runs:
+      for name in batch_order:
+        if not name in run['vbos']: continue
+        min_size = batch_min_pixels.get(name, 0.0) / zoom
+        ranges = visible_ranges(run['tiles'][name], view, min_size)
+        if ranges == []: continue
+        if name == 'hole': self.set_color('hole')
+        else: self.set_color(run['type'])
+        buf = run['vbos'][name]
+        if name == 'line':
+          self._draw_lines(buf, ranges)
+        elif name == 'text':
+          self._draw_text(buf, ranges)
+        else:
+          self._draw_batch(name, buf, ranges)
 
 class JYDGLWidget(QGLWidget):
 
@@ -282,19 +337,29 @@ class JYDGLWidget(QGLWidget):
     self.auto_zoom = bool(parent.setting('gl/autozoom'))
     data_dir = os.environ['DATA_DIR']
     self.font_file = os.path.join(data_dir, 'gui', 'FreeMonoBold.ttf')
+    # the rendered glyphs are cached here between runs
+    self.font_cache_dir = QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.CacheLocation)
+    if self.font_cache_dir == '': self.font_cache_dir = None
     self.shapes = []
-    self.make_dot_field()
+    # the mm visible in x and y, set by resizeGL
+    self.visible = (1.0, 1.0)
+    # the dot field is only rebuilt when the grid settings or the
+    # visible part change
+    self.dot_field_key = None
+    self.dot_field_vbo = None
     self.called_by_me = False
 
-  def make_dot_field(self):
+  def update_dot_field(self):
     gldx = int(self.parent.setting('gl/dx'))
     gldy = int(self.parent.setting('gl/dy'))
-    self.dot_field_data = np.array(
-      [[x,y] for x in range(-gldx/2, gldx/2) for y in range(-gldy/2, gldy/2)],
-      dtype=np.float32)
-
-  def make_dot_field_vbo(self):
-    self.dot_field_vbo = vbo.VBO(self.dot_field_data)
+    key = (gldx, gldy, self.visible)
+    if key == self.dot_field_key: return
+    if self.dot_field_vbo != None:
+      self.dot_field_vbo.delete()
+    data = dot_field(gldx, gldy, self.visible[0], self.visible[1])
+    self.dot_field_vbo = vbo.VBO(data)
+    self.dot_field_count = len(data)
+    self.dot_field_key = key
 
   def initializeGL(self):
     self.glversion = glGetString(GL_VERSION)
@@ -307,13 +372,14 @@ class JYDGLWidget(QGLWidget):
     glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
     #glEnable(GL_TEXTURE_2D) # Enables texture mapping
     glEnable(GL_LINE_SMOOTH)
-    self.font = glFreeType.font_data(self.font_file, 64)
+    self.font = glFreeType.font_data(self.font_file, 64, self.font_cache_dir)
     #glEnable(GL_POLYGON_STIPPLE)
     #pattern=np.fromfunction(lambda x,y: 0xAA, (32,32), dtype=uint1)
     #glPolygonStipple(pattern)
     (r,g,b,a) = self.colorscheme['background']
     glClearColor(r, g, b, a)
-    self.make_dot_field_vbo()
+    self.axes_vbo = vbo.VBO(np.array(
+      [[-100, 0], [100, 0], [0, -100], [0, 100]], dtype=np.float32))
     self.gldraw = GLDraw(self, self.font, self.colorscheme)
 
   def paintGL(self):
@@ -333,26 +399,25 @@ class JYDGLWidget(QGLWidget):
     glClear(GL_COLOR_BUFFER_BIT)
     (r, g, b, a) = self.colorscheme['grid']
     glColor4f(r, g, b, a)
+    self.update_dot_field()
     self.dot_field_vbo.bind() # make this vbo the active one
     glEnableClientState(GL_VERTEX_ARRAY)
     glVertexPointer(2, GL_FLOAT, 0, self.dot_field_vbo)
-    gldx = int(self.parent.setting('gl/dx'))
-    gldy = int(self.parent.setting('gl/dy'))
-    glDrawArrays(GL_POINTS, 0, gldx * gldy)
+    glDrawArrays(GL_POINTS, 0, self.dot_field_count)
+    self.dot_field_vbo.unbind()
 
     (r, g, b, a) = self.colorscheme['axes']
     glColor4f(r, g, b, a)
     glLineWidth(1)
-    glBegin(GL_LINES)
-    glVertex3f(-100, 0, 0)
-    glVertex3f(100, 0, 0)
-    glEnd()
-    glBegin(GL_LINES)
-    glVertex3f(0, -100, 0)
-    glVertex3f(0, 100, 0)
-    glEnd()
+    self.axes_vbo.bind()
+    glVertexPointer(2, GL_FLOAT, 0, self.axes_vbo)
+    glDrawArrays(GL_LINES, 0, 4)
+    self.axes_vbo.unbind()
         
-    if self.shapes != None: self.gldraw.draw(self.shapes)
+    if self.shapes != None:
+      # only does something for new shapes
+      self.gldraw.set_shapes(self.shapes)
+      self.gldraw.draw()
 
   def resizeGL(self, w, h):
     glMatrixMode(GL_PROJECTION)
@@ -363,6 +428,7 @@ class JYDGLWidget(QGLWidget):
     mm_visible_y = float(h)/self.zoomfactor
     if mm_visible_y < 1: mm_visible_y = 1.0
     glOrtho(-mm_visible_x/2, mm_visible_x/2, -mm_visible_y/2, mm_visible_y/2, -1, 1)
+    self.visible = (mm_visible_x, mm_visible_y)
     glViewport(0, 0, w, h)
     if not self.called_by_me:
       self.parent.compile()
@@ -0,0 +1,163 @@
+# (c) 2013 Joost Yervante Damad <joost@damad.be>
+# License: GPL
+#
+# the geometry behind gldraw: vertex data, tiling and culling of the
+# batches and the dot grid; plain numpy, no GL, so it can be tested
+
+import bisect, math
+
+import numpy as np
+
+square_data = np.array([[-0.5,0.5],[-0.5,-0.5],[0.5,-0.5],[0.5,0.5]], dtype=np.float32)
+
+# vertex data for a batch of quads; every row of instances (the
+# shader parameters) is used for the 4 corners of the unit square
+def pack_instances(instances):
+  a = np.array(instances, dtype=np.float32)
+  corners = np.tile(square_data, (len(instances), 1))
+  return np.ascontiguousarray(np.hstack([corners, np.repeat(a, 4, axis=0)]))
+
+# triangles per round line end
+cap_segments = 8
+
+# triangles for lines with round ends, given as rows of
+# (x1, y1, x2, y2, half width); the ends are half discs so
+# nothing is drawn twice, which matters for translucent colors
+def tessellate_lines(lines):
+  a = np.array(lines, dtype=np.float64).reshape(-1, 5)
+  (x1, y1, x2, y2, r) = a.T
+  dx = x2 - x1
+  dy = y2 - y1
+  l = np.hypot(dx, dy)
+  # a line of length 0 is a disc, in any direction
+  point = l == 0.0
+  dx[point] = 1.0
+  dy[point] = 0.0
+  l[point] = 1.0
+  nx = -dy / l * r
+  ny = dx / l * r
+  p1 = np.column_stack([x1, y1])
+  p2 = np.column_stack([x2, y2])
+  n = np.column_stack([nx, ny])
+  body = np.stack([p1 + n, p1 - n, p2 - n, p1 + n, p2 - n, p2 + n], axis=1)
+  # half circle fans, around p1 facing away from p2 and the other way around
+  phi = np.arctan2(dy, dx)
+  t = np.linspace(0.0, math.pi, cap_segments + 1)
+  def _cap(center, start):
+    angles = start[:, None] + t[None, :]
+    rim = center[:, None, :] + r[:, None, None] * \
+      np.stack([np.cos(angles), np.sin(angles)], axis=2)
+    centers = np.repeat(center[:, None, :], cap_segments, axis=1)
+    return np.stack([centers, rim[:, :-1], rim[:, 1:]], axis=2).reshape(len(a), -1, 2)
+  caps1 = _cap(p1, phi + math.pi/2)
+  caps2 = _cap(p2, phi - math.pi/2)
+  return np.ascontiguousarray(np.concatenate([body, caps1, caps2], axis=1).reshape(-1, 2), dtype=np.float32)
+
+# the batches are split in tiles of this many mm, so only the tiles
+# in view need to be drawn
+tile_size = 5.0
+
+# level of detail: text lower than min_text_pixels is not drawn, nor
+# are holes smaller than min_detail_pixels; lines thinner than that
+# are drawn without their round ends
+min_text_pixels = 6.0
+min_detail_pixels = 2.0
+
+batch_min_pixels = {
+  'line': min_detail_pixels,
+  'hole': min_detail_pixels,
+  'text': min_text_pixels,
+}
+
+# half the size in x and y of a shape as a factor of the 3rd and 4th
+# value of its instance
+batch_extent = {
+  'circle': 1.0,
+  'rect': 0.5,
+  'octagon': 0.5,
+  'hole': 1.0,
+}
+
+# the vertex data of a batch and per instance its number of vertices,
+# bounding box (x1, y1, x2, y2) and size in mm for the level of detail
+def batch_vertices(name, instances):
+  if name == 'line':
+    a = np.array(instances, dtype=np.float64).reshape(-1, 5)
+    v = tessellate_lines(a).reshape(len(a), -1, 2)
+    # the bodies and the ends are separate instances so the ends can
+    # be left out
+    data = np.concatenate([v[:, :6].reshape(-1, 2), v[:, 6:].reshape(-1, 2)])
+    counts = np.array([6]*len(a) + [v.shape[1] - 6]*len(a))
+    (x1, y1, x2, y2, r) = a.T
+    bounds = np.column_stack([np.minimum(x1, x2) - r, np.minimum(y1, y2) - r,
+      np.maximum(x1, x2) + r, np.maximum(y1, y2) + r])
+    bounds = np.concatenate([bounds, bounds])
+    sizes = np.concatenate([np.repeat(np.inf, len(a)), 2*r])
+  elif name == 'text':
+    data = np.concatenate([q for (q, h) in instances])
+    counts = np.array([len(q) for (q, h) in instances])
+    bounds = np.array([[q[:, 0].min(), q[:, 1].min(), q[:, 0].max(), q[:, 1].max()]
+      for (q, h) in instances]).reshape(-1, 4)
+    sizes = np.array([h for (q, h) in instances], dtype=np.float64)
+  else:
+    data = pack_instances(instances)
+    a = np.array(instances, dtype=np.float64)
+    counts = np.repeat(4, len(a))
+    half = a[:, 2:4] * batch_extent[name]
+    bounds = np.hstack([a[:, 0:2] - half, a[:, 0:2] + half])
+    if name == 'hole':
+      sizes = 2*half.max(axis=1)
+    else:
+      sizes = np.repeat(np.inf, len(a))
+  return (data, counts, bounds, sizes)
+
+# reorder the vertex data of a batch by tile and give the index of the
+# tiles: their bounding boxes and per tile the first vertex and for
+# every instance the negated size and the vertex after it; within a
+# tile the instances are sorted by size, largest first, so the level
+# of detail only has to cut off the end of a tile
+def tile_batch(data, counts, bounds, sizes):
+  starts = np.cumsum(counts) - counts
+  centers = (bounds[:, 0:2] + bounds[:, 2:4]) / 2
+  t = np.floor(centers / tile_size).astype(np.int64)
+  order = np.lexsort((-sizes, t[:, 0], t[:, 1]))
+  counts = counts[order]
+  ends = np.cumsum(counts)
+  new_starts = ends - counts
+  data = np.ascontiguousarray(data[np.repeat(starts[order] - new_starts, counts) + np.arange(ends[-1])])
+  (t, bounds, sizes) = (t[order], bounds[order], sizes[order])
+  first = np.flatnonzero(np.concatenate([[True], (t[1:] != t[:-1]).any(axis=1)]))
+  last = np.concatenate([first[1:], [len(t)]])
+  tile_bounds = np.column_stack([
+    np.minimum.reduceat(bounds[:, 0], first), np.minimum.reduceat(bounds[:, 1], first),
+    np.maximum.reduceat(bounds[:, 2], first), np.maximum.reduceat(bounds[:, 3], first)])
+  tiles = [(int(new_starts[f]), (-sizes[f:l]).tolist(), ends[f:l].tolist())
+    for (f, l) in zip(first, last)]
+  return (data, (tile_bounds, tiles))
+
+# the (start, end) vertex ranges of the tiles of a batch that are in
+# view (x1, y1, x2, y2), leaving out instances smaller than min_size
+def visible_ranges(index, view, min_size):
+  (tile_bounds, tiles) = index
+  (x1, y1, x2, y2) = view
+  in_view = np.flatnonzero((tile_bounds[:, 0] <= x2) & (tile_bounds[:, 2] >= x1) &
+    (tile_bounds[:, 1] <= y2) & (tile_bounds[:, 3] >= y1))
+  ranges = []
+  for i in in_view:
+    (start, neg_sizes, ends) = tiles[i]
+    n = bisect.bisect_right(neg_sizes, -min_size)
+    if n == 0: continue
+    # neighbouring tiles are drawn in one go
+    if ranges != [] and ranges[-1][1] == start:
+      ranges[-1] = (ranges[-1][0], ends[n-1])
+    else:
+      ranges.append((start, ends[n-1]))
+  return ranges
+
+# the dots of the background grid: every mm of a gldx by gldy field
+# around the origin, limited to the vx by vy mm visible
+def dot_field(gldx, gldy, vx, vy):
+  xs = np.arange(max(-gldx/2, int(math.ceil(-vx/2))), min(gldx/2, int(math.floor(vx/2)) + 1))
+  ys = np.arange(max(-gldy/2, int(math.ceil(-vy/2))), min(gldy/2, int(math.floor(vy/2)) + 1))
+  (x, y) = np.meshgrid(xs, ys, indexing='ij')
+  return np.ascontiguousarray(np.column_stack([x.ravel(), y.ravel()]), dtype=np.float32)
@@ -0,0 +1,248 @@
+# (c) 2013 Joost Yervante Damad <joost@damad.be>
+# License: GPL
+#
+# design rule checks on the intermediate format
+
+import math
+
+from mutil.mutil import *
+
+import inter
+
+# distances in mm
+default_rules = {
+  'clearance': 0.2,       # copper to copper
+  'silk_clearance': 0.15, # silk to copper
+  'annular_ring': 0.25,   # copper left around a drill
+}
+
+# every shape is reduced to either a 'seg': a line segment with a
+# radius around it (a disc is a segment of length 0), or a 'box': an
+# axis aligned rectangle; this is conservative for round corners and
+# octagons
+
+def _rotated_size(shape, dx, dy):
+  if fget(shape, 'rot') in [90, 270]:
+    return (dy, dx)
+  return (dx, dy)
+
+def _copper_prim(shape):
+  s = shape.get('shape', 'disc')
+  x = fget(shape, 'x')
+  y = fget(shape, 'y')
+  if s == 'disc':
+    r = fget(shape, 'r')
+    return ('seg', x, y, x, y, max(fget(shape, 'rx', r), fget(shape, 'ry', r)))
+  if s == 'octagon':
+    r = fget(shape, 'r')
+    (dx, dy) = _rotated_size(shape, fget(shape, 'dx', r*2), fget(shape, 'dy', r*2))
+  elif s == 'rect':
+    (dx, dy) = _rotated_size(shape, fget(shape, 'dx'), fget(shape, 'dy'))
+  else:
+    return None
+  return ('box', x - dx/2, y - dy/2, x + dx/2, y + dy/2, 0.0)
+
+def _silk_prims(shape):
+  s = shape.get('shape')
+  if s == 'line':
+    return [('seg', fget(shape, 'x1'), fget(shape, 'y1'),
+      fget(shape, 'x2'), fget(shape, 'y2'), fget(shape, 'w')/2)]
+  if s == 'circle':
+    # approximate the outline with a polygon
+    r = fget(shape, 'r')
+    x = fget(shape, 'x')
+    y = fget(shape, 'y')
+    w = fget(shape, 'w')
+    n = 16
+    pts = [(x + r*math.cos(2*math.pi*i/n), y + r*math.sin(2*math.pi*i/n)) for i in range(n+1)]
+    return [('seg', a[0], a[1], b[0], b[1], w/2) for (a, b) in zip(pts, pts[1:])]
+  if s == 'disc':
+    r = fget(shape, 'r')
+    x = fget(shape, 'x')
+    y = fget(shape, 'y')
+    return [('seg', x, y, x, y, r)]
+  if s == 'rect':
+    (x1, y1, x2, y2) = inter.shape_bounding_box(shape)
+    return [('box', x1, y1, x2, y2, 0.0)]
+  if s == 'label':
+    # NAME and VALUE end up on their own layers
+    if shape['value'] in ['NAME', 'VALUE']: return []
+    (x1, y1, x2, y2) = inter.shape_bounding_box(shape)
+    return [('box', x1, y1, x2, y2, 0.0)]
+  return []
+
+def _prim_bounding_box(p):
+  (kind, x1, y1, x2, y2, r) = p
+  return (min(x1, x2) - r, min(y1, y2) - r, max(x1, x2) + r, max(y1, y2) + r)
+
+def _point_segment_distance(px, py, x1, y1, x2, y2):
+  dx = x2 - x1
+  dy = y2 - y1
+  l2 = dx*dx + dy*dy
+  t = 0.0
+  if l2 > 0.0:
+    t = max(0.0, min(1.0, ((px-x1)*dx + (py-y1)*dy) / l2))
+  return math.hypot(px - (x1 + t*dx), py - (y1 + t*dy))
+
+def _point_box_distance(px, py, x1, y1, x2, y2):
+  gx = max(x1 - px, 0.0, px - x2)
+  gy = max(y1 - py, 0.0, py - y2)
+  return math.hypot(gx, gy)
+
+def _orientation(ax, ay, bx, by, cx, cy):
+  v = (bx-ax)*(cy-ay) - (by-ay)*(cx-ax)
+  if abs(v) < 1E-12: return 0
+  if v > 0: return 1
+  return -1
+
+def _segments_intersect(a, b):
+  (ax1, ay1, ax2, ay2) = a
+  (bx1, by1, bx2, by2) = b
+  o1 = _orientation(ax1, ay1, ax2, ay2, bx1, by1)
+  o2 = _orientation(ax1, ay1, ax2, ay2, bx2, by2)
+  o3 = _orientation(bx1, by1, bx2, by2, ax1, ay1)
+  o4 = _orientation(bx1, by1, bx2, by2, ax2, ay2)
+  return o1*o2 < 0 and o3*o4 < 0
+
+def _segment_segment_distance(a, b):
+  if _segments_intersect(a, b): return 0.0
+  (ax1, ay1, ax2, ay2) = a
+  (bx1, by1, bx2, by2) = b
+  return min(
+    _point_segment_distance(ax1, ay1, bx1, by1, bx2, by2),
+    _point_segment_distance(ax2, ay2, bx1, by1, bx2, by2),
+    _point_segment_distance(bx1, by1, ax1, ay1, ax2, ay2),
+    _point_segment_distance(bx2, by2, ax1, ay1, ax2, ay2))
+
+def _segment_box_distance(s, b):
+  (sx1, sy1, sx2, sy2) = s
+  (x1, y1, x2, y2) = b
+  if _point_box_distance(sx1, sy1, x1, y1, x2, y2) == 0.0: return 0.0
+  edges = [(x1, y1, x2, y1), (x2, y1, x2, y2), (x2, y2, x1, y2), (x1, y2, x1, y1)]
+  return min([_segment_segment_distance(s, e) for e in edges])
+
+def _box_box_distance(a, b):
+  gx = max(a[0] - b[2], 0.0, b[0] - a[2])
+  gy = max(a[1] - b[3], 0.0, b[1] - a[3])
+  return math.hypot(gx, gy)
+
+def _distance(a, b):
+  if a[0] == 'box' and b[0] == 'seg': (a, b) = (b, a)
+  d = {
+    ('seg', 'seg'): _segment_segment_distance,
+    ('seg', 'box'): _segment_box_distance,
+    ('box', 'box'): _box_box_distance,
+  }[(a[0], b[0])](a[1:5], b[1:5])
+  return max(0.0, d - a[5] - b[5])
+
+def _annular_ring(shape):
+  drill = fget(shape, 'drill')
+  if drill <= 0.0: return None
+  drill_dx = fget(shape, 'drill_dx')
+  drill_dy = fget(shape, 'drill_dy')
+  s = shape.get('shape', 'disc')
+  if s == 'disc':
+    r = fget(shape, 'r')
+    return r - math.hypot(drill_dx, drill_dy) - drill/2
+  if s == 'octagon':
+    r = fget(shape, 'r')
+    dx = fget(shape, 'dx', r*2)
+    dy = fget(shape, 'dy', r*2)
+  elif s == 'rect':
+    dx = fget(shape, 'dx')
+    dy = fget(shape, 'dy')
+  else:
+    return None
+  return min(dx/2 - abs(drill_dx), dy/2 - abs(drill_dy)) - drill/2
+
+def _violation(rule, limit, distance, items, x, y):
+  return {
+    'rule': rule,
+    'limit': limit,
+    'distance': distance,
+    'items': items,
+    'x': x,
+    'y': y,
+  }
+
+def _pair_rule(a, b):
+  if a['copper'] and b['copper']:
+    # pads with the same name are connected
+    if a['shape'].get('name') == b['shape'].get('name'): return None
+    return 'clearance'
+  if a['copper'] or b['copper']:
+    return 'silk_clearance'
+  return None
+
+def check(inter, rules=None):
+  r = dict(default_rules)
+  if rules != None: r.update(rules)
+  items = []
+  violations = []
+  for shape in inter:
+    t = shape.get('type')
+    if t in ['smd', 'pad']:
+      p = _copper_prim(shape)
+      if p != None:
+        items.append({'shape': shape, 'prim': p, 'copper': True})
+      if t == 'pad':
+        ring = _annular_ring(shape)
+        if ring != None and ring < r['annular_ring']:
+          violations.append(_violation('annular_ring', r['annular_ring'], ring,
+            (shape,), fget(shape, 'x'), fget(shape, 'y')))
+    elif t == 'silk':
+      for p in _silk_prims(shape):
+        items.append({'shape': shape, 'prim': p, 'copper': False})
+  for item in items:
+    item['bb'] = _prim_bounding_box(item['prim'])
+  # sweep line over x: only pairs whose bounding boxes come within the
+  # largest clearance of each other are examined in detail
+  margin = max(r['clearance'], r['silk_clearance'])
+  items.sort(key=lambda item: item['bb'][0])
+  seen = set()
+  for i in range(len(items)):
+    a = items[i]
+    (ax1, ay1, ax2, ay2) = a['bb']
+    for j in range(i+1, len(items)):
+      b = items[j]
+      (bx1, by1, bx2, by2) = b['bb']
+      if bx1 > ax2 + margin: break
+      if by1 > ay2 + margin or ay1 > by2 + margin: continue
+      rule = _pair_rule(a, b)
+      if rule == None: continue
+      d = _distance(a['prim'], b['prim'])
+      if d >= r[rule]: continue
+      # a silk shape can consist of multiple primitives
+      key = (rule, id(a['shape']), id(b['shape']))
+      if key in seen or (rule, id(b['shape']), id(a['shape'])) in seen: continue
+      seen.add(key)
+      # mark the middle of the overlap (or gap) of both bounding boxes
+      x = (max(ax1, bx1) + min(ax2, bx2)) / 2
+      y = (max(ay1, by1) + min(ay2, by2)) / 2
+      violations.append(_violation(rule, r[rule], d, (a['shape'], b['shape']), x, y))
+  return violations
+
+def _describe_shape(shape):
+  if 'name' in shape:
+    return "%s %s" % (shape['type'], shape['name'])
+  return "%s %s" % (shape['type'], shape.get('shape', ''))
+
+def describe(violation):
+  items = ' and '.join([_describe_shape(s) for s in violation['items']])
+  return "%s: %.3f < %.3f for %s at (%.3f, %.3f)" % (violation['rule'],
+    violation['distance'], violation['limit'], items,
+    violation['x'], violation['y'])
+
+# convert violations into shapes that can be displayed on top of
+# the footprint
+def markers(violations, r = 0.3):
+  def _marker(v):
+    return {
+      'type': 'drc',
+      'shape': 'circle',
+      'x': v['x'],
+      'y': v['y'],
+      'r': r,
+      'w': r/3,
+    }
+  return [_marker(v) for v in violations]
@@ -3,7 +3,11 @@
 #
 # functions that operate on the intermediate format
 
-import copy
+import operator
+from itertools import compress, count, imap, izip
+
+import numpy as np
+
 from mutil.mutil import *
 
 def cleanup_js(inter):
@@ -14,9 +18,6 @@ def cleanup_js(inter):
   return filter(_remove_constructor, inter)
 
 def add_names(inter):
-  def generate_ints():
-    for i in xrange(1, 10000):
-      yield i
   g = generate_ints()
   def _c(x):
     if 'type' in x:
@@ -57,103 +58,104 @@ def prepare_for_display(inter, filter_out):
     return x
   return map(convert, sinter)
 
-# this method has a bunch of code duplication of gldraw...
-def bounding_box(inter):
-  def oget(m, k, d):
-    if k in m: return m[k]
-    return d
-  def fget(m, k, d = 0.0):
-    return float(oget(m, k, d))
-  def circle(shape):
-    r = fget(shape, 'r')
-    rx = fget(shape, 'rx', r)
-    ry = fget(shape, 'ry', r)
-    x = fget(shape,'x')
-    y = fget(shape,'y')
-    w = fget(shape,'w')
-    x1 = x - rx - w/2
-    x2 = x + rx + w/2
-    y1 = y - ry - w/2
-    y2 = y + ry + w/2
-    return (x1, y1, x2, y2)
-
-  def disc(shape):
-    r = fget(shape, 'r')
-    rx = fget(shape, 'rx', r)
-    ry = fget(shape, 'ry', r)
-    x = fget(shape,'x')
-    y = fget(shape,'y')
-    x1 = x - rx
-    x2 = x + rx
-    y1 = y - ry
-    y2 = y + ry
-    return (x1, y1, x2, y2)
-    
-  def label(shape):
-    x = fget(shape,'x')
-    y = fget(shape,'y')
-    dy = fget(shape,'dy', 1)
-    dx = dy * len(shape['value'])
-    x1 = x - dx/2
-    x2 = x + dx/2
-    y1 = y - dy/2
-    y2 = y + dy/2
-    return (x1, y1, x2, y2)
-    
-  def line(shape):
-    x1 = fget(shape, 'x1')
-    y1 = fget(shape, 'y1')
-    x2 = fget(shape, 'x2')
-    y2 = fget(shape, 'y2')
-    w = fget(shape, 'w')
-    x1a = min(x1, x2) - w/2
-    x2a = max(x1, x2) + w/2
-    y1a = min(y1, y2) - w/2
-    y2a = max(y1, y2) + w/2
-    return (x1a, y1a, x2a, y2a)
-
-  def octagon(shape):
-    r = fget(shape, 'r', 0.0)
-    dx = fget(shape, 'dx', r*2)
-    dy = fget(shape, 'dy', r*2)
-    x = fget(shape,'x')
-    y = fget(shape,'y')
-    x1 = x - dx/2
-    x2 = x + dx/2
-    y1 = y - dy/2
-    y2 = y + dy/2
-    return (x1, y1, x2, y2)
-
-  def rect(shape):
-    x = fget(shape, 'x')
-    y = fget(shape, 'y')
-    dx = fget(shape, 'dx')
-    dy = fget(shape, 'dy')
-    x1 = x - dx/2
-    x2 = x + dx/2
-    y1 = y - dy/2
-    y2 = y + dy/2
-    return (x1, y1, x2, y2)
-
-  def unknown(shape):
-    return (0,0,0,0)
+# these functions have a bunch of code duplication of gldraw...
+def _bb_circle(shape):
+  r = fget(shape, 'r')
+  rx = fget(shape, 'rx', r)
+  ry = fget(shape, 'ry', r)
+  x = fget(shape,'x')
+  y = fget(shape,'y')
+  w = fget(shape,'w')
+  x1 = x - rx - w/2
+  x2 = x + rx + w/2
+  y1 = y - ry - w/2
+  y2 = y + ry + w/2
+  return (x1, y1, x2, y2)
+
+def _bb_disc(shape):
+  r = fget(shape, 'r')
+  rx = fget(shape, 'rx', r)
+  ry = fget(shape, 'ry', r)
+  x = fget(shape,'x')
+  y = fget(shape,'y')
+  x1 = x - rx
+  x2 = x + rx
+  y1 = y - ry
+  y2 = y + ry
+  return (x1, y1, x2, y2)
+
+def _bb_label(shape):
+  x = fget(shape,'x')
+  y = fget(shape,'y')
+  dy = fget(shape,'dy', 1)
+  dx = dy * len(shape['value'])
+  x1 = x - dx/2
+  x2 = x + dx/2
+  y1 = y - dy/2
+  y2 = y + dy/2
+  return (x1, y1, x2, y2)
+
+def _bb_line(shape):
+  x1 = fget(shape, 'x1')
+  y1 = fget(shape, 'y1')
+  x2 = fget(shape, 'x2')
+  y2 = fget(shape, 'y2')
+  w = fget(shape, 'w')
+  x1a = min(x1, x2) - w/2
+  x2a = max(x1, x2) + w/2
+  y1a = min(y1, y2) - w/2
+  y2a = max(y1, y2) + w/2
+  return (x1a, y1a, x2a, y2a)
+
+def _bb_octagon(shape):
+  r = fget(shape, 'r', 0.0)
+  dx = fget(shape, 'dx', r*2)
+  dy = fget(shape, 'dy', r*2)
+  x = fget(shape,'x')
+  y = fget(shape,'y')
+  x1 = x - dx/2
+  x2 = x + dx/2
+  y1 = y - dy/2
+  y2 = y + dy/2
+  return (x1, y1, x2, y2)
+
+def _bb_rect(shape):
+  x = fget(shape, 'x')
+  y = fget(shape, 'y')
+  dx = fget(shape, 'dx')
+  dy = fget(shape, 'dy')
+  if fget(shape, 'rot') in [90, 270]:
+    (dx, dy) = (dy, dx)
+  x1 = x - dx/2
+  x2 = x + dx/2
+  y1 = y - dy/2
+  y2 = y + dy/2
+  return (x1, y1, x2, y2)
+
+def _bb_unknown(shape):
+  return (0,0,0,0)
+
+_bb_dispatch = {
+  'circle': _bb_circle,
+  'disc': _bb_disc,
+  'label': _bb_label,
+  'line': _bb_line,
+  'octagon': _bb_octagon,
+  'rect': _bb_rect,
+}
+
+def shape_bounding_box(shape):
+  return _bb_dispatch.get(shape['shape'], _bb_unknown)(shape)
 
+def bounding_box(inter):
   x1 = 0
   y1 = 0
   x2 = 0
   y2 = 0
-  dispatch = {
-    'circle': circle,
-    'disc': disc,
-    'label': label,
-    'line': line,
-    'octagon': octagon,
-    'rect': rect,
-  }
   if inter == None or inter == []: return (-1,-1,1,1)
   for x in inter:
     if 'shape' in x:
-       (xx1, xy1, xx2, xy2) = dispatch.get(x['shape'], unknown)(x)
+       (xx1, xy1, xx2, xy2) = shape_bounding_box(x)
        x1 = min(x1, xx1)
        y1 = min(y1, xy1)
        x2 = max(x2, xx2)
@@ -183,68 +185,81 @@ def sort_by_type(inter):
     return cmp(t1, t2)
   return sorted(inter, _sort)
 
-def _count_num_values(pads, param):
-  res = {}
-  for pad in pads:
-    v = pad[param]
-    if not v in res:
-      res[v] = 1
-    else:
-      res[v] = res[v] + 1
-  i = len(res.keys())
-  return (i, res)
-
-def _equidistant(pads, direction):
-  if len(pads) < 2: return False
-  expected = abs(pads[1][direction] - pads[0][direction])
-  prev = pads[1][direction]
-  for item in pads[2:]:
-    cur = item[direction]
-    if f_neq(abs(cur - prev), expected):
-      return False
-    prev = cur
-  return True
+# pattern detection works on integer coordinates in nanometres,
+# snapped to a grid of pattern_grid nanometres; coordinates that are
+# only one grid step apart are considered equal
+pattern_grid = 10
 
-def _all_equal(pads, direction):
-  first = pads[0][direction]
-  return reduce(lambda a, p: a and f_eq(p[direction], first), pads, True)
+def _quantize(values, grid):
+  q = np.round(np.asarray(values, dtype=np.float64) * 1E6 / grid).astype(np.int64)
+  if len(q) == 0: return q
+  # merge values that fell on neighbouring grid points
+  order = np.argsort(q, kind='mergesort')
+  s = q[order]
+  first = np.concatenate([[True], np.diff(s) > 1])
+  q[order] = s[first][np.cumsum(first) - 1]
+  return q * grid
 
-def _sort_by_field(pads, field, reverse=False):
-  def _sort_by(a, b):
-    return cmp(a[field], b[field])
-  return sorted(pads, cmp=_sort_by, reverse=reverse)
+def _to_mm(nm):
+  return float(nm) / 1E6
 
-def _clone_pad(pad_in, remove):
-  pad = copy.deepcopy(pad_in)
-  for x in remove:
-    if x in pad: del pad[x]
-  if 'name' in pad: del pad['name']
-  return pad
+def _count_num_values(values):
+  return len(np.unique(values))
+
+def _equidistant(values, grid):
+  if len(values) < 2: return False
+  d = np.abs(np.diff(values))
+  # allow for rounding of pitches that are not a multiple of the grid
+  return bool(np.all(np.abs(d - d[0]) <= grid))
+
+def _all_equal(values):
+  return bool(np.all(values == values[0]))
+
+def _order(values, reverse=False):
+  # stable, like sorted()
+  if reverse:
+    return np.argsort(-values, kind='mergesort')
+  return np.argsort(values, kind='mergesort')
+
+def _take(pads, order):
+  return [pads[i] for i in order]
 
-def _make_mods(skip, pad, pads):
+# marker for fields that are not set in the template pad
+_no_value = object()
+
+def _clone_pad(pad_in, remove):
+  remove = set(remove)
+  remove.add('name')
+  return dict([(k, v) for (k, v) in pad_in.items() if k not in remove])
+
+def _make_mods(skip, pad, pads, names=None):
+  if names == None:
+    names = [str(i+1) for i in xrange(len(pads))]
+  # compare the pads with the template one field at a time;
+  # a field missing in a pad is never a modification
+  mods = {}
+  for k in set().union(*pads).difference(skip):
+    if k == 'name':
+      expected = names
+    else:
+      expected = [pad.get(k, _no_value)] * len(pads)
+    column = [item.get(k, e) for (item, e) in izip(pads, expected)]
+    diff = compress(count(), imap(operator.ne, column, expected))
+    for i in diff:
+      if not i in mods: mods[i] = {}
+      mods[i][k] = column[i]
   l = []
-  for (item, i) in zip(pads, range(len(pads))):
-    mod = {}
-    #print "investigating", i, item
-    for (k,v) in item.items():
-      if k in skip: continue
-      if k == 'name' and str(i+1) == v: continue
-      #print 'testing', k, v
-      if k not in pad:
-        mod[k] = v
-      elif pad[k] != v:
-        mod[k] = v
-    if mod != {}:
-      mod['type'] = 'special'
-      if 'shape' in mod:
-        mod['real_shape'] = mod['shape']
-      mod['shape'] = 'mod'
-      mod['index'] = i
-      #print "adding mod", mod
-      l.append(mod)
+  for i in sorted(mods.keys()):
+    mod = mods[i]
+    mod['type'] = 'special'
+    if 'shape' in mod:
+      mod['real_shape'] = mod['shape']
+    mod['shape'] = 'mod'
+    mod['index'] = i
+    l.append(mod)
   return l
 
-def _check_single(orig_pads, horizontal):
+def _check_single(orig_pads, coords, grid, horizontal):
   if horizontal:
     equal_direction = 'y'
     diff_direction = 'x'
@@ -254,18 +269,22 @@ def _check_single(orig_pads, horizontal):
     diff_direction = 'y'
     reverse = True
   # sort pads by decreasing in other direction
-  pads = _sort_by_field(orig_pads, diff_direction, reverse)
+  order = _order(coords[diff_direction], reverse)
+  pads = _take(orig_pads, order)
+  v = coords[diff_direction][order]
   # check if the distance is uniform
-  if not _equidistant(pads, diff_direction):
-    #print "not equidistant", diff_direction
+  if not _equidistant(v, grid):
     return orig_pads
   # check if all x coordinates are equal
-  if not _all_equal(pads, equal_direction):
-    #print "not all equal", equal_direction
+  if not _all_equal(coords[equal_direction]):
     return orig_pads
   # create a pad based on the second pad
   # the first one might be special...
-  pad = _clone_pad(pads[1], [diff_direction])
+  pad = _clone_pad(pads[1], [diff_direction, equal_direction])
+  # the row position from the snapped coordinates, without noise
+  equal = _to_mm(coords[equal_direction][0])
+  if equal != 0.0:
+    pad[equal_direction] = equal
   pad_type = pad['type']
   # create a special pseudo entry
   special = {}
@@ -274,72 +293,58 @@ def _check_single(orig_pads, horizontal):
   special['direction'] = diff_direction
   special['ref'] = pad_type
   special['num'] = len(pads)
-  special['e'] = abs(pads[0][diff_direction] - pads[1][diff_direction])
+  special['e'] = _to_mm(abs(v[0] - v[1]))
   l = [pad, special]
   # check if there are mods needed
-  mods = _make_mods([diff_direction], pad, pads)
+  mods = _make_mods([diff_direction, equal_direction], pad, pads)
   return l + mods
 
-def _split_dual(pads, direction):
-  r1 = []
-  r2 = []
-  for pad in pads:
-    # we assume the dual rows are centered around (0,0)
-    if pad[direction] < 0:
-      r1.append(pad)
-    else:
-      r2.append(pad)
-  return (r1, r2)
-
-def _one_by_one_equal(r1, r2, direction):
-  for (p1, p2) in zip(r1, r2):  
-    if f_neq(p1[direction], p2[direction]):
-      return False
-  return True
-
 def _check_dual_alt(r1, r2):
   i = 1
   for (p1, p2) in zip(r1, r2):
-    n1 = int(p1['name'])
-    n2 = int(p2['name'])
-    print i, n1, n2
+    try:
+      n1 = int(p1['name'])
+      n2 = int(p2['name'])
+    except (KeyError, ValueError):
+      return False
     if not (n1 == i and n2 == i+1):
       return False
     i = i + 2
   return True
 
-def _check_dual(orig_pads, horizontal):
+def _check_dual(orig_pads, coords, grid, horizontal):
   if horizontal:
     split_direction = 'y'
     diff_direction = 'x'
-    print 'dual horizontal?'
+    reverse = False
   else:
     split_direction = 'x'
     diff_direction = 'y'
-    print 'dual vertical?'
+    reverse = True
   # split in two rows
-  (r1, r2) = _split_dual(orig_pads, split_direction)
-  # sort pads in 2 rows
-  r1 = _sort_by_field(r1, diff_direction)
-  r2 = _sort_by_field(r2, diff_direction)
+  # we assume the dual rows are centered around (0,0)
+  in_r1 = coords[split_direction] < 0
+  i1 = np.flatnonzero(in_r1)
+  i2 = np.flatnonzero(~in_r1)
+  # sort pads in 2 rows, in the order the first row is drawn:
+  # top to bottom or left to right
+  i1 = i1[_order(coords[diff_direction][i1], reverse)]
+  i2 = i2[_order(coords[diff_direction][i2], reverse)]
+  d1 = coords[diff_direction][i1]
+  d2 = coords[diff_direction][i2]
   # check if the distance is uniform
-  if not _equidistant(r1, diff_direction):
-    print "r1 not equidistant", diff_direction
-    return orig_pads
-  if not _equidistant(r2, diff_direction):
-    print "r2 not equidistant", diff_direction
+  if not (_equidistant(d1, grid) and _equidistant(d2, grid)):
     return orig_pads
+  s1 = coords[split_direction][i1]
+  s2 = coords[split_direction][i2]
   # check if all coordinates are equal in split_direction
-  if not _all_equal(r1, split_direction):
-    print "r1 not all equal", split_direction
-    return orig_pads
-  if not _all_equal(r2, split_direction):
-    print "r2 not all equal", split_direction
+  if not (_all_equal(s1) and _all_equal(s2)):
     return orig_pads
   # check that the two rows are one by one equal
-  if not _one_by_one_equal(r1, r2, diff_direction):
-    print "r1,r2 not one by one equal", diff_direction
+  if len(d1) != len(d2) or not np.all(d1 == d2):
     return orig_pads
+  r1 = _take(orig_pads, i1)
+  r2 = _take(orig_pads, i2)
   # normal: 1 6 alt: 1 2
   #         2 5      3 4
   #         3 4      5 6
@@ -347,7 +352,7 @@ def _check_dual(orig_pads, horizontal):
   # if it is not pure alt we assume normal and if needed
   # set other names via mods
   is_alt = _check_dual_alt(r1, r2)
-  between = abs(r1[0][split_direction] - r2[0][split_direction])
+  between = _to_mm(abs(s1[0] - s2[0]))
   # create a pad based on the second pad
   # the first one might be special...
   pad = _clone_pad(r1[1], ['x','y'])
@@ -361,15 +366,12 @@ def _check_dual(orig_pads, horizontal):
   special['ref'] = pad_type
   special['num'] = len(orig_pads)
   special['between'] = between
-  special['e'] = abs(r1[0][diff_direction] - r1[1][diff_direction])
+  special['e'] = _to_mm(abs(d1[0] - d1[1]))
   if not is_alt:
-    if diff_direction == 'y':
-      sort_pads = r1 + r2
-    else:
-      r2.reverse()
+    r2.reverse()
     sort_pads = r1 + r2
   else:
-    sort_pads = list_combine(map(lambda (a,b): [a,b], zip(r1, r2)))
+    sort_pads = list_combine(izip(r1, r2))
   mods = _make_mods(['x','y'], pad, sort_pads)
   rot = 0
   if 'rot' in pad: rot = pad['rot']
@@ -381,60 +383,41 @@ def _check_dual(orig_pads, horizontal):
     del pad['rot']
   return [pad, special] + mods
 
-def _split_quad(pads):
-  minx = reduce(lambda a,x: min(a, x['x']) , pads, 0)
-  maxx = reduce(lambda a,x: max(a, x['x']) , pads, 0)
-  miny = reduce(lambda a,x: min(a, x['y']) , pads, 0)
-  maxy = reduce(lambda a,x: max(a, x['y']) , pads, 0)
-  h = {
-    'minx': [],
-    'maxx': [],
-    'miny': [],
-    'maxy': []
-  }
-  for pad in pads:
-    if pad['x'] == minx: h['minx'].append(pad)
-    if pad['x'] == maxx: h['maxx'].append(pad)
-    if pad['y'] == miny: h['miny'].append(pad)
-    if pad['y'] == maxy: h['maxy'].append(pad)
-  h['minx'] = sorted(h['minx'], lambda a,b: cmp(a['y'], b['y']), reverse=True)
-  h['maxx'] = sorted(h['maxx'], lambda a,b: cmp(a['y'], b['y']))
-  h['miny'] = sorted(h['miny'], lambda a,b: cmp(a['x'], b['x']))
-  h['maxy'] = sorted(h['maxy'], lambda a,b: cmp(a['x'], b['x']), reverse=True)
-  return (h['minx'], h['miny'], h['maxx'], h['maxy']) 
-
-
-def _check_quad(orig_pads):
+def _split_quad(coords):
+  xs = coords['x']
+  ys = coords['y']
+  minx = min(0, xs.min())
+  maxx = max(0, xs.max())
+  miny = min(0, ys.min())
+  maxy = max(0, ys.max())
+  def _side(mask, values, reverse=False):
+    i = np.flatnonzero(mask)
+    return i[_order(values[i], reverse)]
+  return (_side(xs == minx, ys, True), _side(ys == miny, xs),
+    _side(xs == maxx, ys), _side(ys == maxy, xs, True))
+
+def _check_quad(orig_pads, coords, grid):
   n = len(orig_pads)
   if not (n % 4 == 0):
-    print 'quad: n not dividable by 4'
     return orig_pads
-  (left_x, down_y, right_x, up_y) = _split_quad(orig_pads)
+  (left_x, down_y, right_x, up_y) = _split_quad(coords)
   if len(left_x) != n/4 or len(down_y) != n/4 or len(right_x) != n/4 or len(up_y) != n/4:
-    print 'quad: some row is not n/4 length'
-    return origpads
-  dx = right_x[0]['x'] - left_x[0]['x']
-  dy = up_y[0]['y'] - down_y[0]['y']
-  if f_neq(dx, dy):
-    print 'quad: distance not equal between x and y rows', dx, dy
-    return orig_pads
-  between = dx   
-  if not _equidistant(left_x, 'y'):
-    print 'quad: left row not equidistant'
     return orig_pads
-  if not _equidistant(right_x, 'y'):
-    print 'quad: right row not equidistant'
+  xs = coords['x']
+  ys = coords['y']
+  dx = xs[right_x[0]] - xs[left_x[0]]
+  dy = ys[up_y[0]] - ys[down_y[0]]
+  if dx != dy:
     return orig_pads
-  if not _equidistant(up_y, 'x'):
-    print 'quad: up row not equidistant'
+  between = _to_mm(dx)
+  if not (_equidistant(ys[left_x], grid) and _equidistant(ys[right_x], grid)):
     return orig_pads
-  if not _equidistant(down_y, 'x'):
-    print 'quad: down row not equidistant'
+  if not (_equidistant(xs[up_y], grid) and _equidistant(xs[down_y], grid)):
     return orig_pads
   # we have a quad!
   # create a pad based on the second pad
   # the first one might be special...
-  pad = _clone_pad(left_x[1], ['x','y'])
+  pad = _clone_pad(orig_pads[left_x[1]], ['x','y'])
   pad_type = pad['type']
   # create a special pseudo entry
   special = {}
@@ -443,24 +426,97 @@ def _check_quad(orig_pads):
   special['ref'] = pad_type
   special['num'] = len(orig_pads)
   special['between'] = between
-  special['e'] = abs(left_x[0]['y'] - left_x[1]['y'])
-  sort_pads = left_x + down_y + right_x + up_y
+  special['e'] = _to_mm(abs(ys[left_x[0]] - ys[left_x[1]]))
+  sort_pads = _take(orig_pads, np.concatenate([left_x, down_y, right_x, up_y]))
   # skipping dx and dy is not entirely correct but deals with
   # footprints that don't use rotate but swap dx and dy instead
   mods = _make_mods(['x','y', 'rot', 'dx', 'dy'], pad, sort_pads)
   return [pad, special] + mods
 
-def _check_sequential(pads):
-  for (i, pad) in zip(range(0, len(pads)), pads):
-    print i, pad
-    if 'name' in pad:
-      if pad['name'] == str(i):
-         del pad['name']
-      else:
-         return pads
-  return pads
+# JEDEC ball grid row names: A..Y without I, O, Q, S, X and Z
+# followed by AA, AB, ...
+_bga_row_letters = 'ABCDEFGHJKLMNPRTUVWY'
+
+def _bga_row_name(i):
+  n = len(_bga_row_letters)
+  if i < n:
+    return _bga_row_letters[i]
+  return _bga_row_name(i/n - 1) + _bga_row_letters[i % n]
+
+def _grid_pitch(values, grid):
+  # the most common distance between neighbouring coordinates
+  # is taken as the pitch; missing rows or columns just show
+  # up as multiples of it
+  u = np.unique(values)
+  (d, inverse) = np.unique(np.diff(u), return_inverse=True)
+  pitch = d[np.argmax(np.bincount(inverse))]
+  # refine it over the whole span for pitches that are not
+  # a multiple of the grid
+  steps = int(round(float(u[-1] - u[0]) / pitch))
+  pitch = float(u[-1] - u[0]) / steps
+  k = (u - u[0]) / pitch
+  if not np.all(np.abs(k - np.round(k)) * pitch <= grid):
+    return None
+  return (u[0], pitch, steps + 1)
+
+def _check_grid(orig_pads, coords, grid):
+  xs = coords['x']
+  ys = coords['y']
+  x_pitch = _grid_pitch(xs, grid)
+  y_pitch = _grid_pitch(ys, grid)
+  if x_pitch == None or y_pitch == None:
+    return orig_pads
+  (x0, ex, nx) = x_pitch
+  (y0, ey, ny) = y_pitch
+  # we assume the grid is centered around (0,0)
+  if abs(x0 + (nx-1)*ex/2) > grid or abs(y0 + (ny-1)*ey/2) > grid:
+    return orig_pads
+  n = len(orig_pads)
+  # don't bother for grids that are mostly empty
+  if 2*n < nx*ny:
+    return orig_pads
+  # rows go from top to bottom, columns from left to right
+  col = np.round((xs - x0) / ex).astype(int)
+  row = (ny - 1) - np.round((ys - y0) / ey).astype(int)
+  position = row * nx + col
+  if len(np.unique(position)) != n:
+    return orig_pads
+  order = np.argsort(position, kind='mergesort')
+  pads = _take(orig_pads, order)
+  populated = set(position.tolist())
+  # names are either numbers counting all positions or
+  # JEDEC style row letter + column number
+  def numeric_name(r, c): return str(r * nx + c + 1)
+  def alpha_name(r, c): return "%s%d" % (_bga_row_name(r), c + 1)
+  def names(f): return [f(row[i], col[i]) for i in order]
+  numeric_names = names(numeric_name)
+  alpha_names = names(alpha_name)
+  def matches(l): return len([1 for (p, name) in zip(pads, l) if p.get('name') == name])
+  alpha = matches(alpha_names) > matches(numeric_names)
+  if alpha:
+    (name_f, pad_names) = (alpha_name, alpha_names)
+  else:
+    (name_f, pad_names) = (numeric_name, numeric_names)
+  skip = [name_f(p / nx, p % nx) for p in range(nx*ny) if p not in populated]
+  # create a pad based on the second pad
+  # the first one might be special...
+  pad = _clone_pad(pads[1], ['x','y'])
+  pad_type = pad['type']
+  # create a special pseudo entry
+  special = {}
+  special['type'] = 'special'
+  special['shape'] = 'grid'
+  special['ref'] = pad_type
+  special['alpha'] = alpha
+  special['nx'] = nx
+  special['ny'] = ny
+  special['ex'] = _to_mm(ex)
+  special['ey'] = _to_mm(ey)
+  special['skip'] = skip
+  mods = _make_mods(['x','y'], pad, pads, pad_names)
+  return [pad, special] + mods
 
-def _find_pad_patterns(pads):
+def _find_pad_patterns(pads, grid=pattern_grid):
   n = len(pads)
   if n == 1:
     if 'name' in pads[0]:
@@ -468,44 +524,56 @@ def _find_pad_patterns(pads):
         del pads[0]['name']
     return pads
 
-  (x_diff, _z) = _count_num_values(pads, 'x')
-  print 'x diff ', x_diff
-  (y_diff, _z) = _count_num_values(pads, 'y')
-  print 'y diff ', y_diff
+  coords = {
+    'x': _quantize([pad['x'] for pad in pads], grid),
+    'y': _quantize([pad['y'] for pad in pads], grid),
+  }
+  x_diff = _count_num_values(coords['x'])
+  y_diff = _count_num_values(coords['y'])
 
   # possibly single row
   if x_diff == 1 and y_diff == n:
-    return _check_single(pads, horizontal=False)
+    return _check_single(pads, coords, grid, horizontal=False)
   if x_diff == n and y_diff == 1:
-    return _check_single(pads, horizontal=True)
+    return _check_single(pads, coords, grid, horizontal=True)
 
   # possibly dual row
   if x_diff == 2 and y_diff == n/2:
-    return _check_dual(pads, horizontal=False)
+    return _check_dual(pads, coords, grid, horizontal=False)
   if x_diff == n/2 and y_diff == 2:
-    return _check_dual(pads, horizontal=True)
+    return _check_dual(pads, coords, grid, horizontal=True)
 
   # possibly a quad
   if x_diff == (n/4)+2 and y_diff == (n/4)+2:
-    return _check_quad(pads)
+    return _check_quad(pads, coords, grid)
+
+  # possibly a (ball) grid
+  if x_diff > 2 and y_diff > 2:
+    return _check_grid(pads, coords, grid)
 
   return pads
 
-def find_pad_patterns(inter):
+def find_pad_patterns(inter, grid=pattern_grid):
   pads = filter(lambda x: x['type'] == 'pad', inter)
   no_pads = filter(lambda x: x['type'] != 'pad', inter)
   if len(pads) > 0:
-    pads = _find_pad_patterns(pads)
+    pads = _find_pad_patterns(pads, grid)
     inter = pads + no_pads
 
   smds = filter(lambda x: x['type'] == 'smd', inter)
   no_smds = filter(lambda x: x['type'] != 'smd', inter)
   if len(smds) > 0:
-    smds = _find_pad_patterns(smds)
+    smds = _find_pad_patterns(smds, grid)
     inter = smds + no_smds
   return inter
 
-def import_footprint(importer, footprint_name):
-  interim = importer.import_footprint(footprint_name) 
+# prepare a freshly imported footprint for code generation
+def import_interim(interim):
   interim = sort_by_type(interim)
   return find_pad_patterns(interim)
+
+def import_footprint(importer, footprint_name):
+  return import_interim(importer.import_footprint(footprint_name))
+
+def import_footprints(importer, footprint_names):
+  return map(import_interim, importer.import_footprints(footprint_names))
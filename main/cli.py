@@ -3,65 +3,143 @@
 # (c) 2013 Joost Yervante Damad <joost@damad.be>
 # License: GPL
 
-import argparse, sys, traceback, os.path, glob
+import argparse, sys, traceback, os.path, glob, multiprocessing
 
 import coffee.pycoffee as pycoffee
 import coffee.generatesimple as generatesimple
-from inter import inter
+from inter import inter, drc
 import coffee.library
-import export.eagle
+import export.eagle, export.eaglelxml
 
-def export_footprint(remaining):
-  parser = argparse.ArgumentParser(prog=sys.argv[0] + ' export')
-  parser.add_argument('footprint', help='footprint file')
-  parser.add_argument('library', help='library file')
-  args = parser.parse_args(remaining)
-  with open(args.footprint, 'r') as f:
+def _compile_footprint(fn):
+  with open(fn, 'r') as f:
     code = f.read()
   (error_txt, status_txt, interim) = pycoffee.compile_coffee(code)
   if interim == None:
-    print >> sys.stderr, error_txt
-    return 1
-  meta = filter(lambda x: x['type'] == 'meta', interim)[0]
-  name = meta['name']
-  print name, 'compiled.'
+    print >> sys.stderr, "%s: %s" % (fn, error_txt)
+  return interim
+
+def _compile_directory(dirname):
+  library = coffee.library.Library('library', dirname)
+  if not library.exists or not library.is_dir:
+    print >> sys.stderr, "%s is not a directory." % (dirname)
+    return None
+  interims = [_compile_footprint(meta.filename) for meta in library.meta_list]
+  if None in interims: return None
+  print len(interims), 'footprints compiled.'
+  return interims
+
+def export_footprint(remaining, eagle):
+  parser = argparse.ArgumentParser(prog=sys.argv[0] + ' export')
+  parser.add_argument('footprint', help='footprint file (or directory with --all)')
+  parser.add_argument('library', help='library file')
+  parser.add_argument('--all', action='store_true', help='export all footprints in the footprint directory')
+  parser.add_argument('--splice', action='store_true', help='only replace the exported packages in the library file, leave the rest untouched')
+  args = parser.parse_args(remaining)
+  if args.all:
+    interims = _compile_directory(args.footprint)
+    if interims == None: return 1
+  else:
+    interim = _compile_footprint(args.footprint)
+    if interim == None: return 1
+    meta = filter(lambda x: x['type'] == 'meta', interim)[0]
+    print meta['name'], 'compiled.'
+    interims = [interim]
   try:
-    version = export.eagle.check_xml_file(args.library)
+    version = eagle.check_xml_file(args.library)
   except Exception as ex:
     print >> sys.stderr, str(ex)
     return 1
-  exporter = export.eagle.Export(args.library)
-  exporter.export_footprint(interim)
-  exporter.save()
+  if args.splice:
+    eagle.splice_footprints(args.library, interims)
+  else:
+    exporter = eagle.Export(args.library)
+    exporter.export_many(interims)
+    exporter.save()
   print "Exported to "+args.library+"."
   return 0
 
-def import_footprint(remaining):
+def sync_library(remaining, eagle):
+  parser = argparse.ArgumentParser(prog=sys.argv[0] + ' sync')
+  parser.add_argument('footprints', help='footprint directory')
+  parser.add_argument('library', help='library file')
+  parser.add_argument('--verbose', action='store_true', help='list the packages per category')
+  args = parser.parse_args(remaining)
+  interims = _compile_directory(args.footprints)
+  if interims == None: return 1
+  try:
+    version = eagle.check_xml_file(args.library)
+  except Exception as ex:
+    print >> sys.stderr, str(ex)
+    return 1
+  report = eagle.sync_footprints(args.library, interims)
+  for k in ['added', 'changed', 'unchanged', 'orphaned']:
+    print "%s: %d" % (k, len(report[k]))
+    if args.verbose:
+      for name in report[k]: print "  " + name
+  if report['added'] == [] and report['changed'] == []:
+    print args.library, "not changed."
+  else:
+    print "Synced to "+args.library+"."
+  return 0
+
+# runs in a worker process, which also writes the file
+def _import_package_xml((name, package_xml, directory)):
+  try:
+    interim = inter.import_interim(export.eagle.import_package_xml(package_xml))
+    return (name, generatesimple.save_coffee(interim, directory), None)
+  except Exception as ex:
+    return (name, None, str(ex) + '\n' + traceback.format_exc())
+
+def _import_all(importer, args):
+  if not os.path.isdir(args.footprint):
+    print >> sys.stderr, "%s is not a directory." % (args.footprint)
+    return 1
+  pool = multiprocessing.Pool(args.jobs)
+  written = 0
+  failed = 0
+  packages = ((name, package_xml, args.footprint) for (name, package_xml) in importer.package_xml())
+  results = pool.imap_unordered(_import_package_xml, packages, 8)
+  for (name, new_file_name, error) in results:
+    if new_file_name == None:
+      print >> sys.stderr, "Footprint %s\nerror: %s" % (name, error)
+      failed = failed + 1
+      continue
+    written = written + 1
+  pool.close()
+  pool.join()
+  print "%d footprints from %s written to %s." % (written, args.library, args.footprint)
+  if failed > 0:
+    print >> sys.stderr, "%d footprints failed." % (failed)
+    return 1
+  return 0
+
+def import_footprint(remaining, eagle):
   parser = argparse.ArgumentParser(prog=sys.argv[0] + ' import')
   parser.add_argument('library', help='library file')
-  parser.add_argument('footprint', help='footprint name')
+  parser.add_argument('footprint', help='footprint name (or output directory with --all)')
+  parser.add_argument('--all', action='store_true', help='import all footprints in the library')
+  parser.add_argument('--jobs', type=int, default=None, help='number of worker processes for --all (default: number of CPUs)')
   args = parser.parse_args(remaining)
   try:
-    version = export.eagle.check_xml_file(args.library)
+    version = eagle.check_xml_file(args.library)
   except Exception as ex:
     print >> sys.stderr, str(ex)
     return 1
-  importer = export.eagle.Import(args.library)
-  names = map(lambda (a,_): a, importer.list_names())
-  if not args.footprint in names:
-    print >> sys.stderr, "Footprint %s not found in %s." % (args.footprint, args.library)
+  importer = eagle.Import(args.library)
+  if args.all:
+    return _import_all(importer, args)
+  try:
+    interim = inter.import_footprint(importer, args.footprint) 
+  except Exception as ex:
+    print >> sys.stderr, str(ex)
     return 1
-  interim = inter.import_footprint(importer, args.footprint) 
   try:
-    coffee = generatesimple.generate_coffee(interim)
+    new_file_name = generatesimple.save_coffee(interim, '')
   except Exception as ex:
     tb = traceback.format_exc()
     print >> sys.stderr, "Footprint %s\nerror: %s" % (args.footprint, str(ex) + '\n' + tb)
     return 1
-  meta = pycoffee.eval_coffee_meta(coffee)
-  new_file_name = "%s.coffee" % (meta['id'])
-  with open(new_file_name, 'w+') as f:
-    f.write(coffee)
   print "%s/%s written to %s." % (args.library, args.footprint, new_file_name)
   return 0
 
@@ -71,33 +149,67 @@ def _list_directory(dirname):
     print meta.id, meta.name
   return 0
 
-def list_library(remaining):
+def list_library(remaining, eagle):
   parser = argparse.ArgumentParser(prog=sys.argv[0] + ' ls')
   parser.add_argument('library', help='library file', nargs='?', default='.')
   args = parser.parse_args(remaining)
   if os.path.isdir(args.library):
     return _list_directory(args.library)
   try:
-    version = export.eagle.check_xml_file(args.library)
+    version = eagle.check_xml_file(args.library)
   except Exception as ex:
     print >> sys.stderr, str(ex)
     return 1
-  importer = export.eagle.Import(args.library)
+  importer = eagle.Import(args.library)
   names = map(lambda (a,_): a, importer.list_names())
   for name in names: print name
   return 0
 
+def drc_footprint(remaining):
+  parser = argparse.ArgumentParser(prog=sys.argv[0] + ' drc')
+  parser.add_argument('footprint', help='footprint file')
+  parser.add_argument('--clearance', type=float, default=drc.default_rules['clearance'], help='minimal copper to copper distance')
+  parser.add_argument('--silk-clearance', type=float, default=drc.default_rules['silk_clearance'], help='minimal silk to copper distance')
+  parser.add_argument('--annular-ring', type=float, default=drc.default_rules['annular_ring'], help='minimal copper around a drill')
+  args = parser.parse_args(remaining)
+  with open(args.footprint, 'r') as f:
+    code = f.read()
+  (error_txt, status_txt, interim) = pycoffee.compile_coffee(code)
+  if interim == None:
+    print >> sys.stderr, error_txt
+    return 1
+  rules = {
+    'clearance': args.clearance,
+    'silk_clearance': args.silk_clearance,
+    'annular_ring': args.annular_ring,
+  }
+  violations = drc.check(interim, rules)
+  for violation in violations:
+    print drc.describe(violation)
+  if violations != []:
+    print >> sys.stderr, "%d design rule violation(s) found." % (len(violations))
+    return 1
+  print "No design rule violations."
+  return 0
+
 def cli_main():
   parser = argparse.ArgumentParser()
   parser.add_argument('command', help='command to execute', 
-    choices=['import','export', 'ls'])
+    choices=['import','export', 'sync', 'ls', 'drc'])
+  parser.add_argument('--lxml', action='store_true', help='use lxml instead of BeautifulSoup for eagle libraries (faster)')
   (args, remaining) = parser.parse_known_args()
+  eagle = export.eagle
+  if args.lxml: eagle = export.eaglelxml
   if args.command == 'import':
-    return import_footprint(remaining)
+    return import_footprint(remaining, eagle)
   elif args.command == 'export':
-    return export_footprint(remaining)
+    return export_footprint(remaining, eagle)
+  elif args.command == 'sync':
+    return sync_library(remaining, eagle)
+  elif args.command == 'drc':
+    return drc_footprint(remaining)
   else:
-    return list_library(remaining)
+    return list_library(remaining, eagle)
 
 if __name__ == '__main__':
   sys.exit(cli_main())
@@ -16,7 +16,7 @@ import coffee.pycoffee as pycoffee
 import coffee.generatesimple as generatesimple
 import coffee.library
 
-from inter import inter
+from inter import inter, drc
 
 from syntax.jssyntax import JSHighlighter
 from syntax.coffeesyntax import CoffeeHighlighter
@@ -54,10 +54,12 @@ class MainWin(QtGui.QMainWindow):
     self.display_restrict = self.setting('gui/displayrestrict') == 'True'
     self.display_stop = self.setting('gui/displaystop') == 'True'
     self.display_keepout = self.setting('gui/displaykeepout') == 'True'
+    self.display_drc = self.setting('gui/displaydrc') == 'True'
     self.docu_action = self.add_action(footprintMenu, "&Display Docu", self.docu_changed, checkable=True, checked=self.display_docu)
     self.restrict_action = self.add_action(footprintMenu, "&Display Restrict", self.restrict_changed, checkable=True, checked=self.display_restrict)
     self.stop_action = self.add_action(footprintMenu, "&Display Stop", self.stop_changed, checkable=True, checked=self.display_stop)
     self.keepout_action = self.add_action(footprintMenu, "&Display Keepout", self.keepout_changed, checkable=True, checked=self.display_keepout)
+    self.drc_action = self.add_action(footprintMenu, "&Display DRC", self.drc_changed, checkable=True, checked=self.display_drc)
 
     footprintMenu.addSeparator()
     self.add_action(footprintMenu, '&Force Compile', self.compile, 'Ctrl+F')
@@ -260,24 +262,14 @@ class MainWin(QtGui.QMainWindow):
     if dialog.exec_() != QtGui.QDialog.Accepted: return
     (footprint_names, importer, selected_library) = dialog.get_data()
     lib_dir = QtCore.QDir(self.explorer.coffee_lib[selected_library].directory)
-    l = []
-    for footprint_name in footprint_names:
-      interim = inter.import_footprint(importer, footprint_name) 
-      l.append((footprint_name, interim))
-    cl = []
+    l = zip(footprint_names, inter.import_footprints(importer, footprint_names))
     for (footprint_name, interim) in l:
       try:
-       coffee = generatesimple.generate_coffee(interim)
-       cl.append((footprint_name, coffee))
+       generatesimple.save_coffee(interim, lib_dir.path())
       except Exception as ex:
         tb = traceback.format_exc()
         s = "warning: skipping footprint %s\nerror: %s" % (footprint_name, str(ex) + '\n' + tb)
         QtGui.QMessageBox.warning(self, "warning", s)
-    for (footprint_name, coffee) in cl:
-      meta = pycoffee.eval_coffee_meta(coffee)
-      new_file_name = lib_dir.filePath("%s.coffee" % (meta['id']))
-      with open(new_file_name, 'w+') as f:
-        f.write(coffee)
     self.explorer.rescan_library(selected_library)
     self.status('Importing done.')
 
@@ -301,6 +293,11 @@ class MainWin(QtGui.QMainWindow):
     self.settings.setValue('gui/displaykeepout', str(self.display_keepout))
     self.compile()
 
+  def drc_changed(self):
+    self.display_drc = self.drc_action.isChecked()
+    self.settings.setValue('gui/displaydrc', str(self.display_drc))
+    self.compile()
+
   ### OTHER METHODS
 
   def update_text(self, new_text):
@@ -354,7 +351,12 @@ class MainWin(QtGui.QMainWindow):
       if not self.display_restrict: filter_out.append('restrict')
       if not self.display_stop: filter_out.append('stop')
       if not self.display_keepout: filter_out.append('keepout')
-      self.glw.set_shapes(inter.prepare_for_display(interim, filter_out))
+      shapes = inter.prepare_for_display(interim, filter_out)
+      if self.display_drc:
+        violations = drc.check(interim)
+        shapes = shapes + drc.markers(violations)
+        self.status("%d design rule violation(s)." % (len(violations)))
+      self.glw.set_shapes(shapes)
       if not self.explorer.active_footprint.readonly:
         with open(self.explorer.active_footprint_file(), "w+") as f:
           f.write(code)
@@ -1,6 +1,8 @@
 # (c) 2013 Joost Yervante Damad <joost@damad.be>
 # License: GPL
 
+from itertools import chain, count
+
 def oget(m, k, d):
   if k in m: return m[k]
   return d
@@ -15,9 +17,9 @@ def eget(m, k, e):
   if k in m: return m[k]
   raise Exception(e)
 
-def generate_ints():
-  for i in xrange(1, 10000):
-    yield i
+# 1, 2, 3, ... without end
+def generate_ints(start = 1):
+  return count(start)
 
 def f_eq(a, b):
   return abs(a-b) < 1E-8
@@ -26,6 +28,4 @@ def f_neq(a, b):
   return not f_eq(a, b)
 
 def list_combine(l):
-  l2 = []
-  for x in l: l2 = l2 + x
-  return l2
+  return list(chain.from_iterable(l))
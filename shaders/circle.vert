@@ -3,12 +3,15 @@
 // (c) 2013 Joost Yervante Damad <joost@damad.be>
 // License: GPL
 
+// the parameters are per vertex attributes instead of uniforms,
+// so a whole batch of circles is drawn in one call
+
 // input
-uniform vec2 move;   // location
-uniform vec2 radius; // radius
-uniform vec2 inner;  // inner radius
-uniform vec2 drill;  // drill diameter
-uniform vec2 drill_offset;
+attribute vec2 move;   // location
+attribute vec2 radius; // radius
+attribute vec2 inner;  // inner radius
+attribute vec2 drill;  // drill diameter
+attribute vec2 drill_offset;
 
 // output
 varying vec2 pos2;    // adjusted position
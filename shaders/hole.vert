@@ -3,9 +3,12 @@
 // (c) 2013 Joost Yervante Damad <joost@damad.be>
 // License: GPL
 
+// the parameters are per vertex attributes instead of uniforms,
+// so a whole batch of holes is drawn in one call
+
 // input
-uniform vec2 move;   // location
-uniform vec2 radius; // radius
+attribute vec2 move;   // location
+attribute vec2 radius; // radius
 
 // output
 varying vec2 pos2;    // adjusted position
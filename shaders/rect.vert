@@ -3,15 +3,15 @@
 // (c) 2013 Joost Yervante Damad <joost@damad.be>
 // License: GPL
 
-// scale unit square to our rect size
-// and move to it's origin
+// the parameters are per vertex attributes instead of uniforms,
+// so a whole batch of rects is drawn in one call
 
 // input:
-uniform vec2 size;  // size in x and y direction
-uniform vec2 move;  // location
-uniform vec2 round; // roundness of corners
-uniform vec2 drill; // drill diameter
-uniform vec2 drill_offset;
+attribute vec2 size;  // size in x and y direction
+attribute vec2 move;  // location
+attribute vec2 round; // roundness of corners
+attribute vec2 drill; // drill diameter
+attribute vec2 drill_offset;
 
 // output:
 varying vec2 pos2;    // adjusted position
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+#
+# (c) 2013 Joost Yervante Damad <joost@damad.be>
+# License: GPL
+#
+# benchmarks on big footprints, run from the top directory:
+#   python test/benchmark.py [name ...]
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from inter import inter
+import mutil.mutil as mutil
+import export.eagle
+
+def _time(f, n=3):
+  t = time.time()
+  for i in range(n):
+    r = f()
+  return ((time.time() - t) / n, r)
+
+def _report(what, t):
+  print "%-50s %8.4fs" % (what, t)
+
+def _big_footprint(n):
+  shapes = [{'type': 'meta', 'name': 'BIG', 'id': '0'*32, 'desc': 'big\nfootprint'}]
+  for i in range(n):
+    x = (i % 100) * 0.5
+    y = (i / 100) * 0.5
+    shapes.append([
+      {'type': 'smd', 'shape': 'rect', 'name': str(i+1), 'x': x, 'y': y, 'dx': 0.3, 'dy': 0.3, 'ro': 50},
+      {'type': 'pad', 'shape': 'disc', 'name': str(i+1), 'x': x, 'y': y, 'r': 0.4, 'drill': 0.3},
+      {'type': 'silk', 'shape': 'line', 'x1': x, 'y1': y, 'x2': x + 0.4, 'y2': y, 'w': 0.1},
+      {'type': 'silk', 'shape': 'circle', 'x': x, 'y': y, 'r': 0.2, 'w': 0.05},
+      {'type': 'docu', 'shape': 'label', 'x': x, 'y': y, 'dy': 0.3, 'value': 'L%d' % (i)},
+    ][i % 5])
+  return shapes
+
+# the bs4 tree that Export builds compared to package_rows + package_xml
+def bench_eagle_package_xml(n=20000):
+  interim = _big_footprint(n)
+  def _bs4():
+    exporter = export.eagle.Export('test/eagle_empty.lbr')
+    name = exporter.export_footprint(interim)
+    return exporter.index[name.lower()].decode().encode('utf-8')
+  def _rows():
+    (name, rows) = export.eagle.package_rows(interim)
+    return export.eagle.package_xml(name, rows)
+  (t1, a) = _time(_bs4)
+  (t2, b) = _time(_rows)
+  assert a == b
+  _report("eagle package, %d shapes, bs4 Export" % (n), t1)
+  _report("eagle package, %d shapes, package_xml" % (n), t2)
+
+def _dual_row(n, alt):
+  pads = []
+  for i in range(n):
+    if alt:
+      (x, y) = ((i / 2) * 0.5, [-2.0, 2.0][i % 2])
+    elif i < n/2:
+      (x, y) = (i * 0.5, -2.0)
+    else:
+      (x, y) = ((n - 1 - i) * 0.5, 2.0)
+    pads.append({'type': 'smd', 'shape': 'rect', 'dx': 0.3, 'dy': 1.0,
+      'name': str(i+1), 'x': x, 'y': y})
+  return pads
+
+def bench_pad_patterns(n=20000):
+  pairs = [[i, i+1] for i in range(0, n, 2)]
+  def _concat():
+    l = []
+    for x in pairs: l = l + x
+    return l
+  (t1, a) = _time(_concat, 1)
+  (t2, b) = _time(lambda: mutil.list_combine(pairs))
+  assert a == b
+  _report("list_combine, %d pairs, list concatenation" % (len(pairs)), t1)
+  _report("list_combine, %d pairs" % (len(pairs)), t2)
+  for alt in [False, True]:
+    pads = _dual_row(n, alt)
+    coords = {
+      'x': inter._quantize([pad['x'] for pad in pads], inter.pattern_grid),
+      'y': inter._quantize([pad['y'] for pad in pads], inter.pattern_grid),
+    }
+    (t, r) = _time(lambda: inter._check_dual(pads, coords, inter.pattern_grid, horizontal=True))
+    assert r[1]['shape'] == 'dual' and r[1]['alt'] == alt
+    _report("_check_dual, %d pads, %s" % (n, ['normal', 'alt'][alt]), t)
+  def _unnamed():
+    pads = [{'type': 'pad', 'shape': 'disc', 'r': 0.5, 'drill': 0.3} for i in range(n)]
+    return inter.add_names(pads)
+  (t, r) = _time(_unnamed)
+  assert r[-1]['name'] == str(n)
+  _report("add_names, %d pads" % (n), t)
+
+benchmarks = {
+  'eagle_package_xml': bench_eagle_package_xml,
+  'pad_patterns': bench_pad_patterns,
+}
+
+if __name__ == '__main__':
+  names = sys.argv[1:]
+  if names == []:
+    names = sorted(benchmarks.keys())
+  for name in names:
+    benchmarks[name]()
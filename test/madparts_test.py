@@ -3,35 +3,39 @@
 
 from nose.tools import *
 from functools import partial
-import copy, shutil, os
+import copy, shutil, os, math
 
 from bs4 import BeautifulSoup
+import numpy as np
 
 import coffee.pycoffee as pycoffee
 import coffee.generatesimple as generatesimple
-from inter import inter
-import export.eagle
+from inter import inter, drc
+import export.eagle, export.eaglelxml
+from gui import glgeom
+
+_backends = [export.eagle, export.eaglelxml]
 
 assert_multi_line_equal.im_class.maxDiff = None
 
-def _export_eagle(code, expected):
+def _export_eagle(code, expected, backend=export.eagle):
   eagle_lib = 'test/eagle_empty.lbr'
   (error_txt, status_txt, interim) = pycoffee.compile_coffee(code)
   assert interim != None
-  version = export.eagle.check_xml_file(eagle_lib)
+  version = backend.check_xml_file(eagle_lib)
   assert version == 'Eagle CAD 6.4 library'
-  exporter = export.eagle.Export(eagle_lib)
+  exporter = backend.Export(eagle_lib)
   exporter.export_footprint(interim)
   data = exporter.get_pretty_data()
   assert_multi_line_equal(expected, data)
 
-def _export_eagle_package(code, expected_name, expected):
+def _export_eagle_package(code, expected_name, expected, backend=export.eagle):
   eagle_lib = 'test/eagle_empty.lbr'
   (error_txt, status_txt, interim) = pycoffee.compile_coffee(code)
   assert interim != None
-  version = export.eagle.check_xml_file(eagle_lib)
+  version = backend.check_xml_file(eagle_lib)
   assert version == 'Eagle CAD 6.4 library'
-  exporter = export.eagle.Export(eagle_lib)
+  exporter = backend.Export(eagle_lib)
   eagle_name = exporter.export_footprint(interim)
   assert eagle_name == expected_name
   data = exporter.get_pretty_footprint(eagle_name)
@@ -44,18 +48,18 @@ def _assert_equal_no_meta(expected, actual):
   e2 = '\n'.join(filter(lambda l: l[0] != '#', expected.splitlines()))
   assert_multi_line_equal(e2, a2)
 
-def _import_eagle_package(eagle_package_xml, import_name, expected):
+def _import_eagle_package(eagle_package_xml, import_name, expected, backend=export.eagle):
   eagle_lib = 'test/foo.lbr'
   shutil.copyfile('test/eagle_empty.lbr', eagle_lib)
   try:
-    importer = export.eagle.Import(eagle_lib)
+    soup = export.eagle._load_xml_file(eagle_lib)
     # trick to get our package xml into the empty eagle library
     package_soup = BeautifulSoup(eagle_package_xml, 'xml')
     package_soup.is_xml = False
-    importer.soup.drawing.packages.append(package_soup)
+    soup.drawing.packages.append(package_soup)
     with open(eagle_lib, 'w+') as f:
-      f.write(str(importer.soup))
-    importer = export.eagle.Import(eagle_lib)
+      f.write(str(soup))
+    importer = backend.Import(eagle_lib)
     interim = inter.import_footprint(importer, import_name) 
     coffee = generatesimple.generate_coffee(interim)
     _assert_equal_no_meta(expected, coffee)
@@ -226,7 +230,8 @@ Id: 2ba395a2e67a49bd9defdf961b264e9f
  </drawing>
 </eagle>"""
 
-   _export_eagle(code, expected)
+   for backend in _backends:
+     yield _export_eagle, code, expected, backend
 
 def test_eagle_footprint1():
   code = """\
@@ -304,7 +309,8 @@ Id: 708e13cc5f4e43f7833af53070ba5078
  <wire layer="21" width="0.15" x1="-1.27" x2="-0.635" y1="-1.905" y2="-2.54"/>
  <wire layer="21" width="0.15" x1="0.635" x2="1.27" y1="-2.54" y2="-1.905"/>
 </package>"""
-  _export_eagle_package(code, 'PIN_1X2', expected)
+  for backend in _backends:
+    yield _export_eagle_package, code, 'PIN_1X2', expected, backend
 
 _one_coffee = """\
 #format 1.1
@@ -390,7 +396,7 @@ def _mod_rotate(rot, code, eagle):
   return (code, eagle)
 
 def test_eagle_export_one():
-  def _eagle_do(d, mod):
+  def _eagle_do(d, mod, backend):
     (code_list, item_list) = mod(*d)
     code_func = code_list[0]
     code_args = code_list[1:]
@@ -404,19 +410,20 @@ def test_eagle_export_one():
     item_args = item_list[1:]
     item_text = item_func(*item_args)
     expected = _one_coffee_eagle % (item_text)
-    data = _export_eagle_package(code, 'TEST_EAGLE', expected)
+    data = _export_eagle_package(code, 'TEST_EAGLE', expected, backend)
   mods = [
     _no_mod, _mod_x, _mod_y, 
     partial(_mod_rotate, 90), partial(_mod_rotate, 180),
     partial(_mod_rotate, 270)
     ]
-  for mod in mods:
-    for d in _one_coffee_tests:
-      d2 = copy.deepcopy(d)
-      yield _eagle_do, d2, mod
+  for backend in _backends:
+    for mod in mods:
+      for d in _one_coffee_tests:
+        d2 = copy.deepcopy(d)
+        yield _eagle_do, d2, mod, backend
 
 def test_eagle_import_one():
-  def _eagle_do(d, mod):
+  def _eagle_do(d, mod, backend):
     (code_list, item_list) = mod(*d)
     code_func = code_list[0]
     code_args = code_list[1:]
@@ -431,17 +438,18 @@ def test_eagle_import_one():
     item_args = item_list[1:]
     item_text = item_func(*item_args)
     eagle_xml = _one_coffee_eagle % (item_text)
-    generated_code = _import_eagle_package(eagle_xml, 'TEST_EAGLE', expected_code)
+    generated_code = _import_eagle_package(eagle_xml, 'TEST_EAGLE', expected_code, backend)
   mods = [
     _no_mod, _mod_x, _mod_y, 
     partial(_mod_rotate, 90), partial(_mod_rotate, 180),
     partial(_mod_rotate, 270)
     ]
   # only do one test, as it fails currently anyway
-  for mod in mods:
-    for d in _one_coffee_tests:
-      d2 = copy.deepcopy(d)
-      yield _eagle_do, d2, mod
+  for backend in _backends:
+    for mod in mods:
+      for d in _one_coffee_tests:
+        d2 = copy.deepcopy(d)
+        yield _eagle_do, d2, mod, backend
 
 def test_eagle_export_empty():
   coffee = """\
@@ -460,4 +468,524 @@ Generated by 'madparts'.&lt;br/&gt;
 Id: 708e13cc5f4e43f7833af53070ba5078
  </description>
 </package>"""
-  _export_eagle_package(coffee, 'TEST_EMPTY', eagle)
+  for backend in _backends:
+    yield _export_eagle_package, coffee, 'TEST_EMPTY', eagle, backend
+
+def test_eagle_export_many():
+  coffee = """\
+#format 1.1
+#name %s
+#id %s
+#desc eagle test
+footprint = () -> []
+"""
+  interims = []
+  for (name, idx) in [('one', '1'*32), ('two', '2'*32), ('ONE', '3'*32)]:
+    (error_txt, status_txt, interim) = pycoffee.compile_coffee(coffee % (name, idx))
+    interims.append(interim)
+  exporter = export.eagle.Export('test/eagle_empty.lbr')
+  assert_equal(['one', 'two', 'ONE'], exporter.export_many(interims))
+  packages = exporter.soup.eagle.drawing.packages('package')
+  # the last one replaced the first one
+  assert_equal(['one', 'two'], [p['name'] for p in packages])
+  assert '3'*32 in packages[0].description.string
+  assert 'Id: 222' in exporter.get_pretty_footprint('TWO')
+
+def test_eagle_save():
+  eagle_lib = 'test/foo.lbr'
+  for backend in _backends:
+    shutil.copyfile('test/eagle_empty.lbr', eagle_lib)
+    try:
+      os.chmod(eagle_lib, 0640)
+      exporter = backend.Export(eagle_lib)
+      data = exporter.get_data()
+      exporter.save(fsync=True)
+      with open(eagle_lib) as f:
+        assert_multi_line_equal(data, f.read())
+      assert_equal(0640, os.stat(eagle_lib).st_mode & 0777)
+      # a failing write leaves the library untouched
+      def _fail(f):
+        f.write('garbage')
+        raise IOError('disk full')
+      assert_raises(IOError, export.eagle._atomic_write, eagle_lib, _fail)
+      with open(eagle_lib) as f:
+        assert_multi_line_equal(data, f.read())
+      assert_equal(['foo.lbr'], [x for x in os.listdir('test') if 'foo.lbr' in x])
+    finally:
+      os.unlink(eagle_lib)
+
+def test_eagle_splice():
+  coffee = """\
+#format 1.1
+#name %s
+#id %s
+#desc eagle test
+footprint = () -> []
+"""
+  def _interim(name, idx):
+    (error_txt, status_txt, interim) = pycoffee.compile_coffee(coffee % (name, idx))
+    return interim
+  eagle_lib = 'test/foo.lbr'
+  shutil.copyfile('test/eagle_empty.lbr', eagle_lib)
+  try:
+    with open(eagle_lib) as f:
+      original = f.read()
+    export.eagle.splice_footprint(eagle_lib, _interim('one', '1'*32))
+    export.eagle.splice_footprint(eagle_lib, _interim('two', '2'*32))
+    export.eagle.splice_footprint(eagle_lib, _interim('ONE', '3'*32))
+    # the same result as a normal export
+    exporter = export.eagle.Export('test/eagle_empty.lbr')
+    exporter.export_many([_interim('one', '3'*32), _interim('two', '2'*32)])
+    assert_multi_line_equal(exporter.get_pretty_data(),
+      export.eagle.Export(eagle_lib).get_pretty_data())
+    # but the rest of the file is untouched
+    with open(eagle_lib) as f:
+      data = f.read()
+    (before, _, after) = original.partition('</packages>')
+    assert data.startswith(before)
+    assert data.endswith('</packages>' + after)
+  finally:
+    os.unlink(eagle_lib)
+
+def test_eagle_sync():
+  coffee = """\
+#format 1.1
+#name %s
+#id %s
+#desc eagle test
+footprint = () -> []
+"""
+  def _interim(name, idx):
+    (error_txt, status_txt, interim) = pycoffee.compile_coffee(coffee % (name, idx))
+    return interim
+  eagle_lib = 'test/foo.lbr'
+  shutil.copyfile('test/eagle_empty.lbr', eagle_lib)
+  try:
+    report = export.eagle.sync_footprints(eagle_lib,
+      [_interim('one', '1'*32), _interim('two', '2'*32)])
+    assert_equal(['one', 'two'], report['added'])
+    # formatting doesn't matter
+    export.eaglelxml.Export(eagle_lib).save()
+    with open(eagle_lib) as f:
+      original = f.read()
+    report = export.eagle.sync_footprints(eagle_lib,
+      [_interim('one', '1'*32), _interim('two', '2'*32)])
+    assert_equal(['one', 'two'], report['unchanged'])
+    with open(eagle_lib) as f:
+      assert_equal(original, f.read())
+    report = export.eagle.sync_footprints(eagle_lib,
+      [_interim('ONE', '3'*32), _interim('three', '4'*32)])
+    assert_equal({ 'added': ['three'], 'changed': ['ONE'], 'unchanged': [], 'orphaned': ['two'] }, report)
+    exporter = export.eagle.Export('test/eagle_empty.lbr')
+    exporter.export_many([_interim('one', '3'*32), _interim('two', '2'*32), _interim('three', '4'*32)])
+    assert_multi_line_equal(exporter.get_pretty_data(),
+      export.eagle.Export(eagle_lib).get_pretty_data())
+  finally:
+    os.unlink(eagle_lib)
+
+def test_eagle_package_xml():
+  code = """\
+#format 1.1
+#name Q"1
+#id 3b6a2a6c0a2c4ed8a63d6b2bd2b3a3b4
+footprint = () ->
+  name = new Name 1
+  label = new Label '<a & b>'
+  pad = new RoundPad 0.6, 0.8
+  smd = new Smd
+  smd.dx = 1
+  smd.dy = 0.5
+  combine [name, label, pad, smd]
+"""
+  (error_txt, status_txt, interim) = pycoffee.compile_coffee(code)
+  (name, rows) = export.eagle.package_rows(interim)
+  soup = BeautifulSoup('', 'xml')
+  package = soup.new_tag('package')
+  package['name'] = name
+  export.eagle._fill_package(soup, package, rows)
+  assert_multi_line_equal(package.decode().encode('utf-8'),
+    export.eagle.package_xml(name, rows))
+
+def test_eagle_list_names():
+  eagle_lib = 'test/foo.lbr'
+  shutil.copyfile('test/eagle_empty.lbr', eagle_lib)
+  try:
+    soup = export.eagle._load_xml_file(eagle_lib)
+    for name in ['A', 'B', 'C']:
+      package_soup = BeautifulSoup("""<package name="%s">
+<description>package %s</description>
+<smd name="1" x="0" y="0" dx="1" dy="1" layer="1"/>
+</package>""" % (name, name), 'xml')
+      package_soup.is_xml = False
+      soup.drawing.packages.append(package_soup)
+    with open(eagle_lib, 'w+') as f:
+      f.write(str(soup))
+    for backend in _backends:
+      importer = backend.Import(eagle_lib)
+      assert_equal([('A', 'package A'), ('B', 'package B'), ('C', 'package C')],
+        importer.list_names())
+      interim = importer.import_footprint('B')
+      assert_equal('package B', interim[0]['desc'])
+      assert_equal(['smd'], [x['type'] for x in interim[1:]])
+      assert_raises(Exception, importer.import_footprint, 'D')
+      interims = importer.import_footprints(['c', 'A', 'C'])
+      assert_equal(['C', 'A', 'C'], [x[0]['name'] for x in interims])
+      assert_raises(Exception, importer.import_footprints, ['A', 'D'])
+      for (name, data) in importer.package_xml():
+        interim = export.eagle.import_package_xml(data)
+        assert_equal(name, interim[0]['name'])
+        assert_equal('package %s' % (name), interim[0]['desc'])
+  finally:
+    os.unlink(eagle_lib)
+
+def test_eagle_import_not_eagle():
+  assert_raises(Exception, export.eagle.Import, 'test/madparts_test.py')
+  assert_raises(Exception, export.eagle.check_xml_file, 'test/madparts_test.py')
+
+def test_eagle_export_parsed():
+  eagle_lib = 'test/eagle_empty.lbr'
+  soup = export.eagle._load_xml_file(eagle_lib)
+  exporter = export.eagle.Export(eagle_lib, soup)
+  assert exporter.soup is soup
+  coffee = """\
+#format 1.1
+#name TEST_EMPTY
+#id 708e13cc5f4e43f7833af53070ba5078
+#desc eagle test
+footprint = () -> []
+"""
+  (error_txt, status_txt, interim) = pycoffee.compile_coffee(coffee)
+  exporter.export_footprint(interim)
+  assert soup.find('package', attrs={'name': 'TEST_EMPTY'}) != None
+
+def _drc_rules(violations):
+  return sorted([v['rule'] for v in violations])
+
+def test_drc_clean():
+  interim = [
+    {'type': 'pad', 'shape': 'disc', 'name': '1', 'r': 0.8, 'drill': 0.8, 'x': -1.27},
+    {'type': 'pad', 'shape': 'disc', 'name': '2', 'r': 0.8, 'drill': 0.8, 'x': 1.27},
+    {'type': 'silk', 'shape': 'line', 'w': 0.15, 'x1': -2.5, 'y1': 1.2, 'x2': 2.5, 'y2': 1.2},
+  ]
+  assert_equal([], drc.check(interim))
+
+def test_drc_violations():
+  interim = [
+    {'type': 'smd', 'shape': 'rect', 'name': '1', 'dx': 1.0, 'dy': 0.5, 'y': 0.3},
+    {'type': 'smd', 'shape': 'rect', 'name': '2', 'dx': 1.0, 'dy': 0.5, 'y': -0.3},
+    {'type': 'pad', 'shape': 'disc', 'name': '3', 'r': 0.5, 'drill': 0.8, 'x': 5.0},
+    {'type': 'silk', 'shape': 'line', 'w': 0.1, 'x1': -1.0, 'y1': 0.6, 'x2': 1.0, 'y2': 0.6},
+  ]
+  violations = drc.check(interim)
+  assert_equal(['annular_ring', 'clearance', 'silk_clearance'], _drc_rules(violations))
+  markers = drc.markers(violations)
+  assert_equal(3, len(markers))
+  assert_equal(['drc'], list(set([m['type'] for m in markers])))
+
+def test_drc_same_name_and_rotation():
+  # same named pads are connected; rotated pads are checked rotated
+  interim = [
+    {'type': 'smd', 'shape': 'rect', 'name': '1', 'dx': 2.0, 'dy': 0.5, 'x': -0.5},
+    {'type': 'smd', 'shape': 'rect', 'name': '1', 'dx': 2.0, 'dy': 0.5, 'x': 0.5},
+    {'type': 'smd', 'shape': 'rect', 'name': '2', 'dx': 2.0, 'dy': 0.5, 'x': 3.0, 'rot': 90},
+  ]
+  assert_equal([], drc.check(interim))
+  assert_equal(['clearance'], _drc_rules(drc.check(interim, {'clearance': 2.0})))
+
+def test_eagle_import_single():
+  pads = ''.join(["""<pad name="%d" x="0" y="%s" drill="1" shape="round"/>\n""" % (i+1, y) 
+    for (i, y) in enumerate([3.81, 1.27, -1.27, -3.81])])
+  eagle_xml = """<package name="PIN_1X4">
+<description>pin header</description>
+%s</package>""" % (pads)
+  expected = """\
+#format 1.2
+#name PIN_1X4
+#desc pin header
+footprint = () ->
+  pad1 = new RoundPad 0.75, 1.0
+  l = single [pad1], 4, 2.54
+  combine [l]
+"""
+  _import_eagle_package(eagle_xml, 'PIN_1X4', expected)
+
+def test_eagle_import_roundness():
+  eagle_xml = """<package name="RO">
+<description>ro</description>
+<smd name="1" x="-1.5" y="0" dx="1.2" dy="0.6" layer="1" roundness="100"/>
+<smd name="2" x="1.5" y="0" dx="1.2" dy="0.6" layer="1" roundness="0"/>
+<text x="0" y="2" size="1.27" layer="21" align="center">REF</text>
+</package>"""
+  expected = """\
+#format 1.2
+#name RO
+#desc ro
+footprint = () ->
+  smd1 = new Smd
+  smd1.dx = 1.2
+  smd1.dy = 0.6
+  l = rot_single [smd1], 2, 3.0
+  l[0].ro = 100
+  label1 = new Label 'REF'
+  label1.x = 0.0
+  label1.y = 2.0
+  label1.dy = 1.27
+  combine [l,label1]
+"""
+  for backend in _backends:
+    yield _import_eagle_package, eagle_xml, 'RO', expected, backend
+
+def test_cli_import_all():
+  import main.cli
+  eagle_lib = 'test/foo.lbr'
+  directory = 'test/import_all'
+  shutil.copyfile('test/eagle_empty.lbr', eagle_lib)
+  os.mkdir(directory)
+  try:
+    soup = export.eagle._load_xml_file(eagle_lib)
+    for (name, wire_layer) in [('GOOD1', 21), ('BAD', 77), ('GOOD2', 51)]:
+      package_soup = BeautifulSoup("""<package name="%s">
+<description>%s</description>
+<smd name="1" x="0" y="0" dx="1" dy="1" layer="1"/>
+<wire x1="0" y1="0" x2="1" y2="1" width="0.1" layer="%d"/>
+</package>""" % (name, name, wire_layer), 'xml')
+      package_soup.is_xml = False
+      soup.drawing.packages.append(package_soup)
+    with open(eagle_lib, 'w+') as f:
+      f.write(str(soup))
+    # the failing package is reported but the others are still written
+    ret = main.cli.import_footprint([eagle_lib, directory, '--all', '--jobs', '1'], export.eagle)
+    assert_equal(1, ret)
+    names = []
+    for fn in os.listdir(directory):
+      with open(os.path.join(directory, fn)) as f:
+        names.append(pycoffee.eval_coffee_meta(f.read())['name'])
+    assert_equal(['GOOD1', 'GOOD2'], sorted(names))
+  finally:
+    os.unlink(eagle_lib)
+    shutil.rmtree(directory)
+
+def test_find_pad_patterns_large_quad():
+  n = 1000
+  e = 0.5
+  between = 130.0
+  pads = []
+  for side in range(4):
+    for i in range(n/4):
+      t = -(n/4-1)*e/2 + i*e
+      (x, y) = [(-between/2, -t), (t, -between/2), (between/2, t), (-t, between/2)][side]
+      pads.append({'type': 'smd', 'shape': 'rect', 'dx': 1.0, 'dy': 0.3,
+        'x': x, 'y': y, 'name': str(len(pads)+1)})
+  l = inter.find_pad_patterns(pads)
+  special = filter(lambda x: x['type'] == 'special', l)
+  assert_equal(1, len(special))
+  assert_equal('quad', special[0]['shape'])
+  assert_equal(n, special[0]['num'])
+  assert_equal(between, special[0]['between'])
+
+def test_find_pad_patterns_rounding():
+  # coordinates as they come out of a library with rounding noise
+  noise = [0.0, 1E-8, -1E-8, 2E-9]
+  pads = []
+  for i in range(4):
+    pads.append({'type': 'smd', 'shape': 'rect', 'dx': 1.55, 'dy': 0.6,
+      'x': -2.7 + noise[i], 'y': 1.905 - i*1.27 - noise[i], 'name': str(i+1)})
+  for i in range(4):
+    pads.append({'type': 'smd', 'shape': 'rect', 'dx': 1.55, 'dy': 0.6,
+      'x': 2.7 - noise[i], 'y': -1.905 + i*1.27 + noise[i], 'name': str(i+5)})
+  l = inter.find_pad_patterns(pads)
+  special = filter(lambda x: x['type'] == 'special', l)
+  # a dual row without any modifications
+  assert_equal(1, len(special))
+  assert_equal('dual', special[0]['shape'])
+  assert_equal(1.27, special[0]['e'])
+  assert_equal(5.4, special[0]['between'])
+  # a single row without any modifications, at the snapped position
+  l = inter.find_pad_patterns(pads[:4])
+  special = filter(lambda x: x['type'] == 'special', l)
+  assert_equal(1, len(special))
+  assert_equal('single', special[0]['shape'])
+  assert_equal(1.27, special[0]['e'])
+  pad = filter(lambda x: x['type'] == 'smd', l)
+  assert_equal(1, len(pad))
+  assert_equal(-2.7, pad[0]['x'])
+  assert not 'y' in pad[0]
+
+def _grid_smds(names, nx, ny, e):
+  smds = []
+  for row in range(ny):
+    for col in range(nx):
+      name = names(row, col)
+      if name == None: continue
+      smds.append("""<smd name="%s" x="%s" y="%s" dx="0.4" dy="0.4" layer="1"/>\n""" % (
+        name, -(nx-1)*e/2 + col*e, (ny-1)*e/2 - row*e))
+  # the order in the eagle file should not matter
+  smds.reverse()
+  return ''.join(smds)
+
+def test_eagle_import_bga():
+  def names(row, col):
+    if (row, col) in [(1, 1), (1, 2)]: return None
+    return "%s%d" % ('ABCD'[row], col+1)
+  eagle_xml = """<package name="BGA14">
+<description>bga</description>
+%s</package>""" % (_grid_smds(names, 4, 4, 0.8))
+  expected = """\
+#format 1.2
+#name BGA14
+#desc bga
+footprint = () ->
+  smd1 = new Smd
+  smd1.dx = 0.4
+  smd1.dy = 0.4
+  l = bga [smd1], 4, 4, 0.8, 0.8, ['B2', 'B3']
+  combine [l]
+"""
+  _import_eagle_package(eagle_xml, 'BGA14', expected)
+
+def test_eagle_import_grid():
+  def names(row, col):
+    return str(row*3 + col + 1)
+  eagle_xml = """<package name="GRID9">
+<description>grid</description>
+%s</package>""" % (_grid_smds(names, 3, 3, 1.0))
+  expected = """\
+#format 1.2
+#name GRID9
+#desc grid
+footprint = () ->
+  smd1 = new Smd
+  smd1.dx = 0.4
+  smd1.dy = 0.4
+  l = grid [smd1], 3, 3, 1.0, 1.0
+  combine [l]
+"""
+  _import_eagle_package(eagle_xml, 'GRID9', expected)
+
+def test_generate_rect_pad():
+  interim = [
+    {'type': 'meta', 'name': 'RECT', 'id': '1'*32, 'desc': None},
+    {'type': 'pad', 'shape': 'rect', 'name': '1', 'dx': 1.0, 'dy': 1.5, 'drill': 0.6, 'x': 1.0},
+  ]
+  expected = """\
+#format 1.2
+#name RECT
+#id 11111111111111111111111111111111
+footprint = () ->
+  pad1 = new Pad
+  pad1.shape = 'rect'
+  pad1.dx = 1.0
+  pad1.dy = 1.5
+  pad1.drill = 0.6
+  pad1.name = '1'
+  pad1.x = 1.0
+  combine [pad1]
+"""
+  code = generatesimple.generate_coffee(interim)
+  assert_multi_line_equal(expected, code)
+  (error_txt, status_txt, compiled) = pycoffee.compile_coffee(code)
+  pad = filter(lambda x: x['type'] == 'pad', compiled)[0]
+  assert_equal((1.0, 1.5, 0.6), (pad['dx'], pad['dy'], pad['drill']))
+
+def test_save_coffee():
+  interim = [
+    {'type': 'meta', 'name': 'SAVE', 'id': '2'*32, 'desc': 'one\ntwo'},
+    {'type': 'smd', 'shape': 'rect', 'name': '1', 'dx': 1.0, 'dy': 1.5},
+  ]
+  fn = generatesimple.save_coffee(interim, 'test')
+  try:
+    assert_equal(os.path.join('test', '2'*32 + '.coffee'), fn)
+    with open(fn) as f:
+      assert_multi_line_equal(generatesimple.generate_coffee(interim), f.read())
+  finally:
+    os.unlink(fn)
+
+def test_add_names_many():
+  pads = [{'type': 'pad', 'shape': 'disc', 'r': 0.5, 'drill': 0.3} for i in range(20000)]
+  pads = inter.add_names(pads)
+  assert_equal([str(i+1) for i in range(20000)], [pad['name'] for pad in pads])
+
+def test_make_mods():
+  pads = [{'type': 'pad', 'shape': 'disc', 'r': 0.5, 'drill': 0.6, 'x': float(i), 'name': str(i+1)}
+    for i in range(100)]
+  pads[0]['shape'] = 'rect'
+  pads[42]['name'] = 'GND'
+  pads[99]['ro'] = 50
+  template = inter._clone_pad(pads[1], ['x'])
+  assert_equal({'type': 'pad', 'shape': 'disc', 'r': 0.5, 'drill': 0.6}, template)
+  mods = inter._make_mods(['x'], template, pads)
+  assert_equal([
+    {'type': 'special', 'shape': 'mod', 'real_shape': 'rect', 'index': 0},
+    {'type': 'special', 'shape': 'mod', 'name': 'GND', 'index': 42},
+    {'type': 'special', 'shape': 'mod', 'ro': 50, 'index': 99},
+    ], mods)
+
+def _triangles_area(vertices):
+  t = vertices.reshape(-1, 3, 2).astype(np.float64)
+  (a, b, c) = (t[:, 0], t[:, 1], t[:, 2])
+  return np.abs((b[:, 0]-a[:, 0])*(c[:, 1]-a[:, 1]) - (b[:, 1]-a[:, 1])*(c[:, 0]-a[:, 0])).sum() / 2
+
+def _polygon_area(r, n):
+  return n * r * r * math.sin(2*math.pi/n) / 2
+
+def test_glgeom_line_round_ends():
+  r = 0.5
+  v = glgeom.tessellate_lines([(0.0, 0.0, 2.0, 0.0, r)])
+  # body, then the half disc around each end
+  caps = glgeom.cap_segments*3
+  assert_equal(6 + 2*caps, len(v))
+  assert_almost_equal(2.0*2*r + _polygon_area(r, 2*glgeom.cap_segments), _triangles_area(v), 5)
+  # the ends point away from the body so nothing is drawn twice
+  assert v[6:6+caps, 0].max() < 1E-6
+  assert v[6+caps:, 0].min() > 2.0 - 1E-6
+
+def test_glgeom_line_zero_length():
+  r = 0.25
+  v = glgeom.tessellate_lines([(1.0, 1.0, 1.0, 1.0, r)])
+  assert np.all(np.isfinite(v))
+  assert_almost_equal(_polygon_area(r, 2*glgeom.cap_segments), _triangles_area(v), 5)
+  assert np.hypot(v[:, 0] - 1.0, v[:, 1] - 1.0).max() < r + 1E-6
+
+def _rows(data, width):
+  return sorted(map(tuple, np.round(data.reshape(-1, width), 4)))
+
+def test_glgeom_tile_batch_permutation():
+  rnd = np.random.RandomState(1)
+  lines = [(a, b, c, d, abs(e)/20) for (a, b, c, d, e) in rnd.uniform(-30, 30, (500, 5))]
+  (data, counts, bounds, sizes) = glgeom.batch_vertices('line', lines)
+  (tiled, index) = glgeom.tile_batch(data, counts, bounds, sizes)
+  assert_equal(_rows(glgeom.tessellate_lines(lines), 6), _rows(tiled, 6))
+  rects = [tuple(r) for r in rnd.uniform(-30, 30, (300, 10))]
+  (data, counts, bounds, sizes) = glgeom.batch_vertices('rect', rects)
+  (tiled, index) = glgeom.tile_batch(data, counts, bounds, sizes)
+  assert_equal(_rows(glgeom.pack_instances(rects), 48), _rows(tiled, 48))
+  everything = (-1E9, -1E9, 1E9, 1E9)
+  assert_equal([(0, len(tiled))], glgeom.visible_ranges(index, everything, 0.0))
+
+def test_glgeom_visible_ranges():
+  # holes (x, y, rx, ry) in 3 tiles, 2 sizes in the middle one
+  holes = [(0.0, 0.0, 0.5, 0.5), (10.0, 0.0, 0.1, 0.1), (10.5, 0.0, 0.5, 0.5), (20.0, 0.0, 0.5, 0.5)]
+  (data, counts, bounds, sizes) = glgeom.batch_vertices('hole', holes)
+  (tiled, index) = glgeom.tile_batch(data, counts, bounds, sizes)
+  def _centers(view, min_size):
+    ranges = glgeom.visible_ranges(index, view, min_size)
+    return sorted([tuple(tiled[i, 2:4]) for (start, end) in ranges for i in range(start, end, 4)])
+  assert_equal([(0.0, 0.0), (10.0, 0.0), (10.5, 0.0), (20.0, 0.0)], _centers((-50.0, -50.0, 50.0, 50.0), 0.0))
+  assert_equal([(10.0, 0.0), (10.5, 0.0)], _centers((8.0, -1.0, 12.0, 1.0), 0.0))
+  assert_equal([(10.5, 0.0)], _centers((8.0, -1.0, 12.0, 1.0), 0.5))
+  assert_equal([], _centers((8.0, -1.0, 12.0, 1.0), 2.0))
+  assert_equal([], _centers((30.0, 30.0, 40.0, 40.0), 0.0))
+  # the round ends of thin lines are left out, their bodies stay
+  lines = [(0.0, 0.0, 1.0, 0.0, 0.05), (0.0, 1.0, 1.0, 1.0, 0.5)]
+  (data, counts, bounds, sizes) = glgeom.batch_vertices('line', lines)
+  (tiled, index) = glgeom.tile_batch(data, counts, bounds, sizes)
+  n = sum([end - start for (start, end) in glgeom.visible_ranges(index, (-5.0, -5.0, 5.0, 5.0), 0.5)])
+  assert_equal(2*6 + 2*glgeom.cap_segments*3, n)
+
+def test_glgeom_dot_field():
+  for (gldx, gldy) in [(200, 200), (201, 7), (3, 200)]:
+    old = np.array([[x,y] for x in range(-gldx/2, gldx/2) for y in range(-gldy/2, gldy/2)], dtype=np.float32)
+    assert np.array_equal(old, glgeom.dot_field(gldx, gldy, 1E6, 1E6))
+  dots = glgeom.dot_field(200, 200, 10.5, 3.0)
+  assert_equal(11*3, len(dots))
+  assert_equal((-5.0, 5.0, -1.0, 1.0), (dots[:, 0].min(), dots[:, 0].max(), dots[:, 1].min(), dots[:, 1].max()))